@@ -12,7 +12,7 @@ CREATE TABLE `students` (
   `student_id` varchar(20) NOT NULL COMMENT '学号',
   `name` varchar(50) NOT NULL COMMENT '姓名',
   `class_name` varchar(50) NOT NULL COMMENT '班级',
-  `face_encoding` text COMMENT '人脸特征数据（JSON格式）',
+  `face_encoding` mediumblob COMMENT '人脸样本数据（二进制格式）',
   `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
   `updated_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`id`),
@@ -41,6 +41,7 @@ CREATE TABLE `student_courses` (
   `id` int(11) NOT NULL AUTO_INCREMENT,
   `student_id` varchar(20) NOT NULL COMMENT '学号',
   `course_id` int(11) NOT NULL COMMENT '课程ID',
+  `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '选课时间',
   PRIMARY KEY (`id`),
   UNIQUE KEY `unique_student_course` (`student_id`,`course_id`),
   CONSTRAINT `student_courses_ibfk_1` FOREIGN KEY (`student_id`) REFERENCES `students` (`student_id`) ON DELETE CASCADE,
@@ -64,6 +65,19 @@ CREATE TABLE `attendance_records` (
   CONSTRAINT `attendance_records_ibfk_2` FOREIGN KEY (`course_id`) REFERENCES `courses` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='考勤记录表';
 
+-- ----------------------------
+-- Table structure for course_session_closures
+-- ----------------------------
+DROP TABLE IF EXISTS `course_session_closures`;
+CREATE TABLE `course_session_closures` (
+  `course_id` int(11) NOT NULL COMMENT '课程ID',
+  `session_date` date NOT NULL COMMENT '上课日期',
+  `absent_count` int(11) NOT NULL DEFAULT 0 COMMENT '新增的缺勤记录数',
+  `closed_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`course_id`,`session_date`),
+  CONSTRAINT `course_session_closures_ibfk_1` FOREIGN KEY (`course_id`) REFERENCES `courses` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='已关闭的课程';
+
 -- ----------------------------
 -- Table structure for users
 -- ----------------------------
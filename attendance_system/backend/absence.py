@@ -0,0 +1,153 @@
+from datetime import date, datetime, timedelta
+
+from backend.timetable import WEEKDAY_NAMES, parse_course_time
+
+ABSENT_STATUS = '缺勤'
+
+# 一门课程一天的缺勤：选课学生中当天该课程没有考勤记录的，插入一条缺勤记录，考勤时间为课程结束时间。
+# 只处理课程、学生和选课关系创建之后的日期（学期中途选课的学生之前的课程不记缺勤）；
+# INSERT IGNORE依靠唯一键unique_student_course_date，重复执行没有影响
+INSERT_ABSENCES_SQL = """
+    INSERT IGNORE INTO attendance_records (student_id, course_id, record_date, record_time, status)
+    SELECT sc.student_id, sc.course_id, %s, %s, %s
+    FROM student_courses sc
+    JOIN students s ON s.student_id = sc.student_id
+    JOIN courses c ON c.id = sc.course_id
+    LEFT JOIN attendance_records ar
+        ON ar.student_id = sc.student_id AND ar.course_id = sc.course_id AND ar.record_date = %s
+    WHERE sc.course_id = %s AND ar.id IS NULL
+        AND DATE(s.created_at) <= %s AND DATE(c.created_at) <= %s AND DATE(sc.created_at) <= %s
+"""
+
+# 已关闭的课程（某天的一次课）：定时任务在课程结束时插入一行并补齐缺勤，
+# 主键保证多个进程同时关闭同一次课程时只有一个执行
+CREATE_CLOSURES_SQL = """
+    CREATE TABLE IF NOT EXISTS course_session_closures (
+        course_id INT NOT NULL COMMENT '课程ID',
+        session_date DATE NOT NULL COMMENT '上课日期',
+        absent_count INT NOT NULL DEFAULT 0 COMMENT '新增的缺勤记录数',
+        closed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (course_id, session_date),
+        FOREIGN KEY (course_id) REFERENCES courses(id) ON DELETE CASCADE
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='已关闭的课程'
+"""
+
+# 旧数据库的student_courses没有选课时间，补上这一列；已有的选课关系的选课时间为补列的时间，
+# 补录这之前的日期时不会为它们记缺勤
+ADD_ENROLLMENT_DATE_SQL = """
+    ALTER TABLE student_courses
+    ADD COLUMN created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '选课时间'
+"""
+
+
+def _insert_absences(cursor, course_id, course_time_end, day) -> int:
+    cursor.execute(INSERT_ABSENCES_SQL, (day, course_time_end, ABSENT_STATUS, day, course_id, day, day, day))
+    return cursor.rowcount
+
+
+def materialize_absences(conn, start_date: date, end_date: date = None, now: datetime = None,
+                         course_ids=None) -> dict:
+    """
+    为日期范围内每天已经结束的课程补齐缺勤记录（只包括当天已经选课的学生，需要student_courses.created_at，
+    见ensure_enrollment_dates）。每门课程每天一条INSERT ... SELECT并提交一次，
+    不需要把学生名单读到Python中；可以重复执行，也可以补录服务器停机期间的日期
+    :param conn: 数据库连接
+    :param start_date: 开始日期
+    :param end_date: 结束日期（包括），默认与开始日期相同
+    :param now: 当前时间，今天只处理已经结束的课程，今天之后的日期不处理
+    :param course_ids: 只处理这些课程，默认全部课程
+    :return: {'days': 处理的天数, 'courses': 处理的课程次数, 'inserted': 新增的缺勤记录数}
+    """
+    now = now or datetime.now()
+    end_date = min(end_date or start_date, now.date())
+
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT id, weekday, course_time_end, created_at FROM courses")
+    courses_by_weekday = {}
+    for course in cursor.fetchall():
+        if course_ids is not None and course['id'] not in course_ids:
+            continue
+        course['course_time_end'] = parse_course_time(course['course_time_end'])
+        courses_by_weekday.setdefault(course['weekday'], []).append(course)
+    cursor.close()
+
+    summary = {'days': 0, 'courses': 0, 'inserted': 0}
+    cursor = conn.cursor()
+    day = start_date
+    while day <= end_date:
+        summary['days'] += 1
+        for course in courses_by_weekday.get(WEEKDAY_NAMES[day.weekday()], []):
+            # 课程还没有结束，或者课程是在这一天之后才添加的
+            if day == now.date() and now.time() <= course['course_time_end']:
+                continue
+            if course['created_at'] and course['created_at'].date() > day:
+                continue
+            inserted = _insert_absences(cursor, course['id'], course['course_time_end'], day)
+            conn.commit()
+            summary['courses'] += 1
+            summary['inserted'] += inserted
+        day += timedelta(days=1)
+    cursor.close()
+    return summary
+
+
+def _has_enrollment_date(cursor) -> bool:
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'student_courses' AND COLUMN_NAME = 'created_at'"
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def ensure_enrollment_dates(conn):
+    """为旧数据库的student_courses添加created_at（选课时间）列，已存在时不做任何事"""
+    cursor = conn.cursor()
+    try:
+        if _has_enrollment_date(cursor):
+            return
+        try:
+            cursor.execute(ADD_ENROLLMENT_DATE_SQL)
+        except Exception:
+            # 另一个进程同时添加了这一列
+            if not _has_enrollment_date(cursor):
+                raise
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def ensure_closures_table(conn):
+    """创建course_session_closures表（已存在时不做任何事）"""
+    cursor = conn.cursor()
+    cursor.execute(CREATE_CLOSURES_SQL)
+    cursor.close()
+    conn.commit()
+
+
+def close_course_session(conn, course_id, course_time_end, session_date: date):
+    """
+    关闭一次课程：登记关闭并补齐这次课的缺勤记录，在同一个事务中完成。
+    其他进程已经关闭（或正在关闭）同一次课程时，登记的插入被主键挡住（等待对方提交），不再补齐
+    :return: 新增的缺勤记录数，已经被关闭时返回None
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "INSERT IGNORE INTO course_session_closures (course_id, session_date) VALUES (%s, %s)",
+            (course_id, session_date)
+        )
+        if cursor.rowcount != 1:
+            conn.rollback()
+            return None
+        inserted = _insert_absences(cursor, course_id, course_time_end, session_date)
+        cursor.execute(
+            "UPDATE course_session_closures SET absent_count = %s WHERE course_id = %s AND session_date = %s",
+            (inserted, course_id, session_date)
+        )
+        conn.commit()
+        return inserted
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
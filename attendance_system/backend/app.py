@@ -1,39 +1,28 @@
 from flask import Flask
 from flask_cors import CORS
 from backend.routes import main
-import threading
-import time
-from datetime import datetime, time as dt_time
+import logging
+import os
+
+# 日志级别：DEBUG输出识别流程的调试信息，默认INFO
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
 app = Flask(__name__)
 CORS(app)
 
+# 请求体大小上限（字节），超过时返回413
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_SIZE', 10 * 1024 * 1024))
+
 # 注册蓝图
 app.register_blueprint(main)
 
-def run_scheduled_absence_check():
-    """运行定时缺勤检查任务"""
-    while True:
-        # 获取当前时间
-        now = datetime.now()
-        current_time = now.time()
-        
-        # 设定检查时间：每晚10点 (22:00)
-        check_time = dt_time(22, 0, 0)
-        
-        # 如果当前时间接近晚上10点，则执行检查
-        if current_time.hour == 22 and current_time.minute == 0:
-            from backend.routes import scheduled_absence_check
-            scheduled_absence_check()
-            # 等待一分钟，避免重复执行
-            time.sleep(60)
-        else:
-            # 每分钟检查一次
-            time.sleep(60)
-
 if __name__ == '__main__':
-    # 启动定时任务线程
-    scheduler_thread = threading.Thread(target=run_scheduled_absence_check, daemon=True)
-    scheduler_thread.start()
+    # 启动时立即在后台加载人脸数据，不阻塞服务启动；加载进度见/api/ready。
+    # 同时启动课程定时任务：课程开始前准备子人脸库，课程结束后补齐缺勤记录
+    # debug模式下重载器的父进程只负责监视文件并重启子进程，不处理请求，只在子进程（WERKZEUG_RUN_MAIN=true）中启动
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        from backend.routes import start_warmup
+        start_warmup()
     
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
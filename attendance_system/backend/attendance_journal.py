@@ -0,0 +1,300 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import date
+
+import mysql.connector
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，不能防止两个进程同时使用一个日志文件
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 今天已有记录时唯一键unique_student_course_date冲突，不插入也不修改，影响行数为0。
+# 不使用INSERT IGNORE：它会把外键错误（学生或课程已被删除）和数据截断也变成警告，当作"已经签到过"
+INSERT_SQL = (
+    "INSERT INTO attendance_records (student_id, course_id, record_date, record_time, status) "
+    "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE id = id"
+)
+
+# 记录本身有问题、重试也无法写入的错误
+REJECTED_ERRORS = (mysql.connector.errors.IntegrityError, mysql.connector.errors.DataError)
+
+
+class AttendanceJournal:
+    """
+    考勤记录的延迟写入：签到先追加到本地的只追加日志文件（fsync后返回，进程崩溃不会丢失），
+    后台线程再把记录分批写入attendance_records，每批一次多行插入和一次提交。
+    写入成功后把已写入的最大序号保存到检查点文件；重启时重放日志中序号大于检查点的记录。
+    已有的记录按唯一键跳过，重放已经写入过的记录没有影响；学生或课程已被删除的记录无法写入，记录日志后丢弃。日志文件在启动时加排他锁，只能由一个进程使用
+
+    是否已签到由内存中的集合判断：每门课程每天第一次签到时查询一次当天已有的记录，
+    之后的签到不访问数据库。其他进程或直接修改数据库在这之后插入的记录不在集合中，
+    这时append仍然报告为新增，稍后写入时被唯一键跳过，计入stats()中的ignored
+    """
+
+    def __init__(self, db, path: str, batch_size: int = 500, flush_interval: float = 0.5,
+                 retry_interval: float = 5.0, compact_size: int = 1024 * 1024):
+        """
+        :param db: 数据库连接池（backend.database.Database）
+        :param path: 日志文件路径，检查点保存在path + '.checkpoint'
+        :param batch_size: 每批写入的最大记录数
+        :param flush_interval: 后台线程等待更多记录合并为一批的时间（秒）
+        :param retry_interval: 写入数据库失败后重试的间隔（秒）
+        :param compact_size: 全部记录写入后日志文件超过这个大小（字节）时清空
+        """
+        self.db = db
+        self.path = path
+        self.checkpoint_path = path + '.checkpoint'
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.compact_size = compact_size
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()  # 同一时间只有一个线程写入数据库
+        self._file = None
+        self._seq = 0  # 最后追加的序号
+        self._checkpoint = 0  # 已写入数据库的最大序号
+        self._pending = deque()  # (序号, 记录行)，按序号排列
+        self._recorded = {}  # (课程ID, 日期) -> 今天已签到的学生ID集合
+        self._started = False
+        self._stats = {'appended': 0, 'flushed': 0, 'batches': 0, 'errors': 0, 'replayed': 0,
+                       'ignored': 0, 'rejected': 0}
+
+    # ---------- 启动和重放 ----------
+
+    def start(self):
+        """
+        打开日志文件，重放没有写入数据库的记录，并启动后台写入线程（只启动一次）
+        :raises RuntimeError: 日志文件正被其他进程使用
+        """
+        with self._lock:
+            if self._started:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # 先加锁再读取：两个进程同时重放同一个日志会重复写入并互相覆盖检查点
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    self._file.close()
+                    self._file = None
+                    raise RuntimeError('考勤日志%s正被其他进程使用' % self.path)
+            self._started = True
+            self._checkpoint = self._read_checkpoint()
+            self._seq = self._checkpoint
+            for seq, row in self._read_journal():
+                self._seq = max(self._seq, seq)
+                if seq > self._checkpoint:
+                    self._pending.append((seq, row))
+            self._stats['replayed'] = len(self._pending)
+        if self._pending:
+            logger.info("Replaying %d journaled check-ins", len(self._pending))
+        threading.Thread(target=self._run, name='attendance-journal', daemon=True).start()
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_checkpoint(self, seq: int):
+        # 先写临时文件再替换，崩溃时检查点要么是旧值要么是新值
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _read_journal(self):
+        """读取日志中的记录。崩溃时没有写完的最后一行被截掉，之后追加的记录从新的一行开始"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            logger.warning("Discarding incomplete journal line in %s", self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(complete)
+        entries = []
+        for line in data[:complete].decode('utf-8').splitlines():
+            entry = json.loads(line)
+            entries.append((entry['seq'], (entry['student_id'], entry['course_id'], entry['record_date'],
+                                           entry['record_time'], entry['status'])))
+        return entries
+
+    # ---------- 签到 ----------
+
+    def _load_recorded(self, conn, course_id, record_date: date):
+        """加载课程当天已签到的学生，每门课程每天只查询一次数据库"""
+        key = (course_id, record_date)
+        with self._lock:
+            if key in self._recorded:
+                return
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT student_id FROM attendance_records WHERE course_id = %s AND record_date = %s",
+            (course_id, record_date)
+        )
+        loaded = {row[0] for row in cursor.fetchall()}
+        cursor.close()
+        with self._lock:
+            # 日期变化后丢弃前一天的集合
+            for stale in [k for k in self._recorded if k[1] < record_date]:
+                del self._recorded[stale]
+            students = self._recorded.setdefault(key, set())
+            students.update(loaded)
+            # 还在日志中没有写入数据库的签到
+            students.update(row[0] for _, row in self._pending if row[1] == course_id and row[2] == str(record_date))
+
+    def recorded(self, conn, course_id, record_date: date) -> set:
+        """
+        课程当天已签到（包括尚未写入数据库）的学生ID集合
+        :param conn: 数据库连接，集合已加载时不使用
+        """
+        self._load_recorded(conn, course_id, record_date)
+        with self._lock:
+            return set(self._recorded.get((course_id, record_date), ()))
+
+    def append(self, conn, records) -> list:
+        """
+        追加签到记录，写入日志文件后返回，不等待数据库
+        :param conn: 数据库连接，只在需要加载当天已签到集合时使用
+        :param records: [(学生ID, 课程ID, 日期, 时间, 状态), ...]
+        :return: 与records对应的是否新增了记录，当天已经签到过的为False。
+                 只根据内存中的集合判断，写入时被唯一键挡住的记录这里仍为True（见类说明）
+        """
+        for course_id, record_date in {(record[1], record[2]) for record in records}:
+            self._load_recorded(conn, course_id, record_date)
+        results = []
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError('考勤日志尚未启动')
+            lines = []
+            for student_id, course_id, record_date, record_time, status in records:
+                students = self._recorded.setdefault((course_id, record_date), set())
+                if student_id in students:
+                    results.append(False)
+                    continue
+                students.add(student_id)
+                self._seq += 1
+                row = (student_id, course_id, str(record_date), record_time.strftime('%H:%M:%S'), status)
+                lines.append(json.dumps({
+                    'seq': self._seq, 'student_id': row[0], 'course_id': row[1], 'record_date': row[2],
+                    'record_time': row[3], 'status': row[4]
+                }, ensure_ascii=False))
+                self._pending.append((self._seq, row))
+                results.append(True)
+            if lines:
+                self._file.write('\n'.join(lines) + '\n')
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._stats['appended'] += len(lines)
+                self._wakeup.notify()
+        return results
+
+    # ---------- 后台写入 ----------
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+            # 等一小段时间，让同一时间段的签到合并为一批
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.warning("Failed to flush attendance journal, retrying in %ss: %s", self.retry_interval, e)
+                time.sleep(self.retry_interval)
+
+    def flush(self) -> int:
+        """
+        把日志中尚未写入的记录全部写入数据库，缺勤检查等需要读取完整考勤记录的任务先调用
+        :return: 实际插入的记录数，不包括已经存在而被跳过的记录和被拒绝的记录
+        """
+        inserted = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    break
+                conn = self.db.get_connection()
+                try:
+                    batch_inserted, rejected = self._insert(conn, [row for _, row in batch])
+                finally:
+                    conn.close()
+                last_seq = batch[-1][0]
+                self._write_checkpoint(last_seq)
+                with self._lock:
+                    for _ in batch:
+                        self._pending.popleft()
+                    self._checkpoint = last_seq
+                    self._stats['flushed'] += len(batch)
+                    self._stats['batches'] += 1
+                    self._stats['ignored'] += len(batch) - batch_inserted - rejected
+                    self._stats['rejected'] += rejected
+                    self._compact()
+                if batch_inserted + rejected < len(batch):
+                    logger.warning("%d journaled check-ins already existed in attendance_records",
+                                   len(batch) - batch_inserted - rejected)
+                inserted += batch_inserted
+        return inserted
+
+    @staticmethod
+    def _insert(conn, rows) -> tuple:
+        """
+        写入一批记录。整批因外键或数据错误失败时逐条重试，无法写入的记录（学生或课程已被删除、数据不合法）
+        记录日志后丢弃，不阻塞后面的记录；连接错误等其他错误向上抛出，稍后整批重试
+        :return: (插入的记录数, 被拒绝的记录数)
+        """
+        cursor = conn.cursor()
+        try:
+            try:
+                cursor.executemany(INSERT_SQL, rows)
+                # 驱动不返回影响行数（-1）时按全部插入计算
+                inserted = cursor.rowcount if cursor.rowcount >= 0 else len(rows)
+                conn.commit()
+                return inserted, 0
+            except REJECTED_ERRORS:
+                conn.rollback()
+            inserted = rejected = 0
+            for row in rows:
+                try:
+                    cursor.execute(INSERT_SQL, row)
+                    inserted += cursor.rowcount
+                except REJECTED_ERRORS as e:
+                    rejected += 1
+                    logger.error("Dropping journaled check-in %s: %s", row, e)
+            conn.commit()
+            return inserted, rejected
+        finally:
+            cursor.close()
+
+    def _compact(self):
+        """全部记录写入后清空过大的日志文件（调用时持有self._lock）"""
+        if self._pending or self._file is None or self._file.tell() < self.compact_size:
+            return
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending), checkpoint=self._checkpoint)
@@ -1,15 +1,102 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 import mysql.connector
 
+from models.metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """等待空闲数据库连接超时"""
+
+
+class PooledConnection:
+    """
+    连接池借出的连接：用法与mysql.connector的连接相同，close()把连接归还连接池而不是断开，
+    重复调用close()没有影响
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise mysql.connector.errors.OperationalError('连接已归还连接池')
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool._release(conn)
+
+    def __del__(self):
+        # 出错时没有执行到close()的连接在被回收时归还，避免连接池的名额泄漏
+        if getattr(self, '_conn', None) is not None:
+            logger.warning('数据库连接未归还，回收时自动归还连接池')
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class Database:
-    def __init__(self):
+    """
+    数据库访问层：有上限的连接池。会话参数在建立连接时设置一次；空闲超过health_check_interval的连接
+    借出前先ping，失效的连接直接丢弃重建；连接用满时最多等待acquire_timeout秒，超时抛出PoolTimeout。
+    归还时回滚未提交的事务，下一个使用者不会看到上一个请求的事务快照
+    """
+
+    # 增加排序缓冲区大小以避免"Out of sort memory"错误，每个连接只设置一次
+    SESSION_SETTINGS = (
+        "SET SESSION sort_buffer_size = 2097152",  # 设置为2MB
+        "SET SESSION read_rnd_buffer_size = 2097152",  # 设置为2MB
+    )
+
+    def __init__(self, host='localhost', user='root', password='9194', database='attendance_system', port=3306,
+                 pool_size=None, acquire_timeout=None, health_check_interval=None):
+        """
+        :param pool_size: 最多同时打开的连接数，默认读取DB_POOL_SIZE（10）
+        :param acquire_timeout: 连接用满时等待空闲连接的时间（秒），默认读取DB_POOL_TIMEOUT（5）
+        :param health_check_interval: 空闲超过这个时间（秒）的连接借出前先检查是否可用，
+            默认读取DB_POOL_HEALTH_CHECK（30），0表示每次借出都检查
+        """
         # 直接在程序中设置数据库连接参数
-        self.host = 'localhost'
-        self.user = 'root'
-        self.password = '9194'  # 使用.env文件中的密码
-        self.database = 'attendance_system'
-        self.port = 3306
-    
-    def get_connection(self):
+        self.host = host
+        self.user = user
+        self.password = password  # 使用.env文件中的密码
+        self.database = database
+        self.port = port
+        self.pool_size = int(pool_size if pool_size is not None else os.environ.get('DB_POOL_SIZE', 10))
+        self.acquire_timeout = float(acquire_timeout if acquire_timeout is not None
+                                     else os.environ.get('DB_POOL_TIMEOUT', 5))
+        self.health_check_interval = float(health_check_interval if health_check_interval is not None
+                                           else os.environ.get('DB_POOL_HEALTH_CHECK', 30))
+
+        self._idle = deque()  # (连接, 归还时间)，后进先出，最近用过的连接最可能仍然可用
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._lock = threading.RLock()  # 连接在回收时归还（PooledConnection.__del__）也不会死锁
+        self._in_use = 0
+        self._stats = {
+            'created': 0,  # 建立的连接数
+            'discarded': 0,  # 健康检查失败或归还时出错而丢弃的连接数
+            'acquired': 0,  # 借出次数
+            'waited': 0,  # 需要等待空闲连接的借出次数
+            'timeouts': 0,  # 等待超时次数
+            'wait_seconds': 0.0,  # 等待空闲连接的总时间
+            'max_wait_seconds': 0.0,
+        }
+
+    def _connect(self):
         connection = mysql.connector.connect(
             host=self.host,
             user=self.user,
@@ -17,9 +104,101 @@ class Database:
             database=self.database,
             port=self.port
         )
-        # 增加排序缓冲区大小以避免"Out of sort memory"错误
         cursor = connection.cursor()
-        cursor.execute("SET SESSION sort_buffer_size = 2097152")  # 设置为2MB
-        cursor.execute("SET SESSION read_rnd_buffer_size = 2097152")  # 设置为2MB
+        for statement in self.SESSION_SETTINGS:
+            cursor.execute(statement)
         cursor.close()
-        return connection
\ No newline at end of file
+        with self._lock:
+            self._stats['created'] += 1
+        return connection
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, idle_since):
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    def get_connection(self):
+        """
+        从连接池借出一个连接，用完后调用close()归还
+        :return: PooledConnection
+        """
+        start = time.monotonic()
+        waited = not self._slots.acquire(blocking=False)
+        if waited and not self._slots.acquire(timeout=self.acquire_timeout):
+            with self._lock:
+                self._stats['waited'] += 1
+                self._stats['timeouts'] += 1
+            raise PoolTimeout('数据库连接池已满，请稍后再试')
+        wait = time.monotonic() - start
+        with self._lock:
+            self._in_use += 1
+            self._stats['acquired'] += 1
+            if waited:
+                self._stats['waited'] += 1
+                self._stats['wait_seconds'] += wait
+                self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], wait)
+        observe_stage('db_acquire', wait)
+
+        try:
+            while True:
+                with self._lock:
+                    conn, idle_since = self._idle.pop() if self._idle else (None, None)
+                if conn is None:
+                    return PooledConnection(self, self._connect())
+                if self._healthy(conn, idle_since):
+                    return PooledConnection(self, conn)
+                self._discard(conn)
+        except Exception:
+            self._free_slot()
+            raise
+
+    def _free_slot(self):
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def _release(self, conn):
+        try:
+            # 结束借出期间的事务（包括只读查询开启的一致性快照），下一个使用者从干净的状态开始
+            if conn.unread_result:
+                conn.consume_results()
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._free_slot()
+
+    @contextmanager
+    def connection(self):
+        """with db.connection() as conn: ...，退出时归还连接"""
+        conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def stats(self):
+        """
+        连接池的使用情况
+        :return: 包括连接池大小、借出中和空闲的连接数，以及等待和建立连接的累计次数
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(size=self.pool_size, in_use=self._in_use, idle=len(self._idle))
+        return stats
+
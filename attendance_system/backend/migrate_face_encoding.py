@@ -0,0 +1,68 @@
+"""
+人脸数据迁移：把students.face_encoding从JSON整数列表转换为二进制格式
+
+用法（在attendance_system目录下运行）：
+    python -m backend.migrate_face_encoding [--batch-size 500]
+"""
+import argparse
+
+from backend.database import Database
+from models.face_recognition_service import decode_face_samples, encode_face_samples, is_legacy_face_data
+
+
+def migrate_face_encodings(batch_size=500):
+    """
+    把face_encoding列改为MEDIUMBLOB并批量转换旧的JSON数据，可以重复执行
+    :param batch_size: 每批转换的行数
+    :return: 转换的行数
+    """
+    db = Database()
+    conn = db.get_connection()
+    cursor = conn.cursor()
+
+    # TEXT转为BLOB时原有的JSON内容按字节保留，读取方两种格式都能识别
+    cursor.execute("ALTER TABLE students MODIFY face_encoding MEDIUMBLOB COMMENT '人脸样本数据（二进制格式）'")
+
+    converted = 0
+    last_id = 0
+    while True:
+        cursor.execute(
+            "SELECT id, face_encoding FROM students WHERE id > %s AND face_encoding IS NOT NULL ORDER BY id LIMIT %s",
+            (last_id, batch_size)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        for row_id, face_encoding in rows:
+            if not face_encoding or not is_legacy_face_data(face_encoding):
+                continue
+            try:
+                updates.append((encode_face_samples(decode_face_samples(face_encoding)), row_id))
+            except Exception as e:
+                print(f"Skipping student row {row_id}: {e}")
+
+        if updates:
+            # 显式保留updated_at，避免迁移让模型快照误以为所有学生都有变化
+            cursor.executemany(
+                "UPDATE students SET face_encoding = %s, updated_at = updated_at WHERE id = %s",
+                updates
+            )
+            conn.commit()
+            converted += len(updates)
+            print(f"Converted {converted} rows (last id {last_id})")
+
+    cursor.close()
+    conn.close()
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='把students.face_encoding从JSON转换为二进制格式')
+    parser.add_argument('--batch-size', type=int, default=500, help='每批转换的行数')
+    args = parser.parse_args()
+
+    total = migrate_face_encodings(args.batch_size)
+    print(f"Migration finished, converted {total} rows")
@@ -1,18 +1,68 @@
-from flask import Blueprint, jsonify, request
-import mysql.connector
+from flask import Blueprint, Request, Response, abort, g, jsonify, request, stream_with_context
 from datetime import datetime, time, timedelta
-from models.face_recognition_service import FaceRecognitionService
+from models.face_recognition_service import FaceRecognitionService, decode_face_samples, encode_face_samples
+from models.recognition_pool import RecognitionPool, RecognitionPoolStale
+from models.face_tracker import FaceTracker
+from models.result_cache import TTLCache
+from models.quality_gate import QUALITY_MESSAGES, QualityGate
+from models.metrics import ATTENDANCE_JOURNAL, DB_POOL, REQUEST_SECONDS, record_outcome, register_collector, render_metrics, stage
+from backend.database import Database
+from backend.timetable import TimetableIndex
+from backend.attendance_journal import INSERT_SQL as INSERT_ATTENDANCE_SQL, AttendanceJournal
+from backend.absence import close_course_session, ensure_closures_table, ensure_enrollment_dates, materialize_absences
+from backend.scheduler import CourseScheduler
 
 import base64
+import csv
+import io
 import json
-import cv2
+import logging
 import numpy as np
+import os
+import tempfile
 import threading
 import time as time_module
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import time as dt_time
 
 main = Blueprint('main', __name__)
-face_service = FaceRecognitionService()
+
+logger = logging.getLogger(__name__)
+
+# 人脸检测配置，可通过环境变量按部署调整（缩小检测分辨率可以显著降低延迟，但小脸的召回率会下降）
+DETECTION_CONFIG = {
+    'detection_width': int(os.environ.get('FACE_DETECTION_WIDTH', 0)),
+    'decode_reduction': int(os.environ.get('FACE_DECODE_REDUCTION', 1)),
+    'scale_factor': float(os.environ.get('FACE_DETECTION_SCALE_FACTOR', 1.1)),
+    'min_neighbors': int(os.environ.get('FACE_DETECTION_MIN_NEIGHBORS', 5)),
+    'min_face_size': int(os.environ.get('FACE_DETECTION_MIN_SIZE', 30)),
+    # 识别后端：opencv（默认）或numpy（向量化匹配，结果一致，批量识别更快）
+    'matcher': os.environ.get('FACE_MATCHER', 'opencv'),
+    # 课程子人脸库中直接采用的匹配距离，超过它（但仍在识别阈值内）的匹配再在全部学生中确认
+    'course_match_threshold': float(os.environ.get('FACE_COURSE_MATCH_THRESHOLD', 70)),
+    # 识别结果缓存时间（秒）：同一张人脸短时间内重复提交时只与缓存学生的样本比较，不再完整识别。
+    # 默认不缓存：只有重复提交同一张图片时才明显命中，节省的时间很少
+    'result_cache_ttl': float(os.environ.get('FACE_RESULT_CACHE_TTL', 0)),
+    # 识别前的人脸质量检查（考勤终端和视频流）：过暗、过曝、模糊或人脸太小时直接返回原因，不做识别
+    'quality_gate': QualityGate(
+        min_brightness=float(os.environ.get('FACE_QUALITY_MIN_BRIGHTNESS', 40)),
+        max_brightness=float(os.environ.get('FACE_QUALITY_MAX_BRIGHTNESS', 220)),
+        min_sharpness=float(os.environ.get('FACE_QUALITY_MIN_SHARPNESS', 25)),
+        min_face_size=int(os.environ.get('FACE_QUALITY_MIN_FACE_SIZE', 48))
+    ) if os.environ.get('FACE_QUALITY_GATE', '1') != '0' else None,
+    # 课堂合照的人脸质量检查：合照中的人脸小，放大到100x100后清晰度也低，默认只检查亮度
+    'class_quality_gate': QualityGate(
+        min_brightness=float(os.environ.get('FACE_QUALITY_MIN_BRIGHTNESS', 40)),
+        max_brightness=float(os.environ.get('FACE_QUALITY_MAX_BRIGHTNESS', 220)),
+        min_sharpness=float(os.environ.get('FACE_CLASS_QUALITY_MIN_SHARPNESS', 0)),
+        min_face_size=int(os.environ.get('FACE_CLASS_QUALITY_MIN_FACE_SIZE', 0))
+    ) if os.environ.get('FACE_QUALITY_GATE', '1') != '0' else None
+}
+
+face_service = FaceRecognitionService(**DETECTION_CONFIG)
 
 # 数据库配置 - 直接在程序中设置
 DB_CONFIG = {
@@ -23,39 +73,556 @@ DB_CONFIG = {
     'port': 3306
 }
 
+# 数据库连接池：所有接口和定时任务通过它访问数据库，连接上限和等待时间见DB_POOL_*
+db = Database(**DB_CONFIG)
+
+def collect_db_pool_metrics():
+    """输出/api/metrics前刷新连接池和考勤日志指标"""
+    for field, value in db.stats().items():
+        DB_POOL.set(field, value)
+    if attendance_journal is not None:
+        for field, value in attendance_journal.stats().items():
+            ATTENDANCE_JOURNAL.set(field, value)
+
+register_collector(collect_db_pool_metrics)
+
+# 人脸模型快照目录
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model_snapshot')
+
+# 最近一次保存的快照水位，以及之后本进程加入模型的学生（学号 -> 加入时的updated_at），保存快照时据此推进水位
+snapshot_state = {'watermark': {'updated_at': None, 'boundary_ids': [], 'student_count': 0}, 'applied': {}}
+snapshot_state_lock = threading.Lock()
+# 加载人脸数据和保存快照互斥，加载到一半的模型不会被保存
+snapshot_lock = threading.Lock()
+
+# 模型更新后等待这段时间（秒）再保存快照，连续的注册只保存一次
+SNAPSHOT_SAVE_DELAY = float(os.environ.get('SNAPSHOT_SAVE_DELAY', 30))
+
+# 考勤延迟写入：ATTENDANCE_WRITE_BEHIND=1时签到先追加到本地日志文件后立即返回，
+# 后台线程每ATTENDANCE_JOURNAL_FLUSH_INTERVAL秒把日志中的记录分批写入数据库，重启时重放没有写入的记录
+ATTENDANCE_JOURNAL_PATH = os.environ.get('ATTENDANCE_JOURNAL') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'attendance_journal', 'journal.log')
+attendance_journal = AttendanceJournal(
+    db, ATTENDANCE_JOURNAL_PATH,
+    batch_size=int(os.environ.get('ATTENDANCE_JOURNAL_BATCH_SIZE', 500)),
+    flush_interval=float(os.environ.get('ATTENDANCE_JOURNAL_FLUSH_INTERVAL', 0.5))
+) if os.environ.get('ATTENDANCE_WRITE_BEHIND', '0') == '1' else None
+
+# 识别进程池：RECOGNITION_WORKERS大于0时把解码、检测和识别分发到多个工作进程
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', 0))
+recognition_pool = None
+if RECOGNITION_WORKERS > 0:
+    recognition_pool = RecognitionPool(
+        SNAPSHOT_DIR, RECOGNITION_WORKERS, DETECTION_CONFIG,
+        max_pending=int(os.environ.get('RECOGNITION_MAX_PENDING', 0)),
+        task_timeout=float(os.environ.get('RECOGNITION_TASK_TIMEOUT', 5))
+    )
+
+_snapshot_event = threading.Event()
+
+def publish_snapshots():
+    """模型更新后合并SNAPSHOT_SAVE_DELAY秒内的连续更新保存一次快照，保存失败时稍后重试"""
+    while True:
+        _snapshot_event.wait()
+        time_module.sleep(SNAPSHOT_SAVE_DELAY)
+        _snapshot_event.clear()
+        try:
+            save_model_snapshot()
+        except Exception as e:
+            logger.warning("Error saving model snapshot, retrying in %ss: %s", SNAPSHOT_SAVE_DELAY, e)
+            _snapshot_event.set()
+
+def save_model_snapshot():
+    """保存当前模型的快照并推进水位，通知识别进程池的工作进程重新加载。模型和水位都没有变化时不保存"""
+    with snapshot_lock:
+        generation = face_service.generation
+        if generation is None:
+            return
+        with snapshot_state_lock:
+            applied = dict(snapshot_state['applied'])
+        conn = db.get_connection()
+        try:
+            watermark = advance_watermark(conn, snapshot_state['watermark'], applied)
+        finally:
+            conn.close()
+        previous = snapshot_state['watermark']
+        if face_service.snapshot_current and watermark['updated_at'] == previous['updated_at'] \
+                and set(watermark['boundary_ids']) == set(previous.get('boundary_ids', [])):
+            return
+        if not face_service.save_snapshot(SNAPSHOT_DIR, watermark):
+            raise RuntimeError('保存模型快照失败')
+        snapshot_state['watermark'] = watermark
+        # 水位之前的学生重启时不再重放，不需要继续记录
+        if watermark.get('updated_at'):
+            covered = datetime.fromisoformat(watermark['updated_at'])
+            with snapshot_state_lock:
+                snapshot_state['applied'] = {student_id: updated_at for student_id, updated_at
+                                             in snapshot_state['applied'].items() if updated_at >= covered}
+    if recognition_pool is not None:
+        recognition_pool.set_snapshot_version(face_service.snapshot_version)
+
+def note_applied_faces(student_ids):
+    """
+    人脸数据写入数据库并加入模型后调用：记录这些学生当前的updated_at，下次保存快照时水位可以推进到它们之后。
+    没有记录的行（其他进程注册的、写入数据库后还没有加入模型的）重启时照常重放
+    """
+    student_ids = list(student_ids)
+    if not student_ids:
+        return
+    try:
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(student_ids), 500):
+                batch = student_ids[start:start + 500]
+                cursor.execute(
+                    "SELECT student_id, updated_at FROM students WHERE student_id IN ({})".format(
+                        ', '.join(['%s'] * len(batch))),
+                    batch
+                )
+                rows = cursor.fetchall()
+                with snapshot_state_lock:
+                    snapshot_state['applied'].update(rows)
+            cursor.close()
+        _snapshot_event.set()
+    except Exception as e:
+        logger.warning("Error recording applied faces for the snapshot watermark: %s", e)
+
+# 启动预热：后台加载人脸数据，加载完成前/api/ready返回503。
+# 导入模块和创建应用没有副作用，预热在第一个请求到达时（或由启动脚本显式调用start_warmup）开始
+WARMUP_RETRY_INTERVAL = float(os.environ.get('WARMUP_RETRY_INTERVAL', 10))
+warmup_state = {
+    'status': 'pending',  # pending、loading、ready、failed（等待重试）
+    'stage': None,  # snapshot、replay、load、train
+    'loaded': 0,  # 已加载的学生数
+    'total': 0,  # 需要加载的学生数
+    'attempts': 0,
+    'error': None,
+    'started_at': None,
+    'ready_at': None
+}
+warmup_lock = threading.Lock()
+
+def update_warmup(**fields):
+    with warmup_lock:
+        warmup_state.update(fields)
+
+def start_warmup():
+    """启动后台预热线程和快照发布线程（只启动一次），立即返回"""
+    global attendance_journal
+    with warmup_lock:
+        if warmup_state['status'] != 'pending':
+            return
+        warmup_state.update(status='loading', started_at=datetime.now().isoformat(timespec='seconds'))
+    if attendance_journal is not None:
+        try:
+            attendance_journal.start()
+        except RuntimeError as e:
+            # 日志文件已被另一个进程使用（例如同一路径的两个实例），本进程直接写入数据库
+            logger.error("Attendance write-behind disabled: %s", e)
+            attendance_journal = None
+    course_scheduler.start()
+    face_service.generation_listeners.append(lambda generation: _snapshot_event.set())
+    threading.Thread(target=publish_snapshots, name='snapshot-publisher', daemon=True).start()
+    threading.Thread(target=warm_up, name='model-warmup', daemon=True).start()
+
+def warm_up():
+    """加载人脸数据直到成功，数据库不可用时每隔WARMUP_RETRY_INTERVAL秒重试"""
+    while True:
+        update_warmup(status='loading', attempts=warmup_state['attempts'] + 1)
+        if load_known_faces():
+            update_warmup(status='ready', stage=None, error=None,
+                          ready_at=datetime.now().isoformat(timespec='seconds'))
+            return
+        update_warmup(status='failed')
+        time_module.sleep(WARMUP_RETRY_INTERVAL)
+
+def model_ready():
+    return warmup_state['status'] == 'ready'
+
+def model_not_ready_response():
+    """
+    人脸数据尚未加载完成时识别接口和修改人脸库的接口（注册、删除学生）的响应。
+    加载过程会重置人脸库，加载期间的修改可能丢失，所以修改人脸库的接口也要等加载完成
+    """
+    return jsonify({'success': False, 'message': '人脸数据正在加载，请稍后再试', 'warmup': dict(warmup_state)}), 503
+
+def recognize_image(image_data, all_faces=False, rosters=None):
+    """
+    识别图片：启用识别进程池、工作进程已经启动并且快照与当前模型一致时交给工作进程，否则在当前线程识别。
+    注册或删除学生后到新快照保存并被工作进程加载之前，工作进程的模型是旧的，这段时间在当前线程识别。
+    给出rosters（课程ID到选课学生ID的映射）时只匹配这些课程的选课学生
+    """
+    if recognition_pool is not None and recognition_pool.ready and face_service.snapshot_current \
+            and recognition_pool.snapshot_version == face_service.snapshot_version:
+        try:
+            return recognition_pool.recognize_image(image_data, all_faces, rosters)
+        except RecognitionPoolStale:
+            pass
+    return face_service.recognize_image(image_data, all_faces, rosters)
+
+def quality_rejection(reason):
+    """图像没有通过质量检查时的响应，reason供考勤终端判断是否立即重拍"""
+    return jsonify({'success': False, 'message': QUALITY_MESSAGES.get(reason, '图像质量不合格'), 'reason': reason})
+
+def read_face_upload():
+    """
+    读取请求参数和人脸图片，支持三种请求格式：
+    - multipart/form-data：图片为face_image文件字段，其他参数为表单字段
+    - application/octet-stream或image/*：请求体就是图片，其他参数在查询字符串中
+    - application/json：face_image为Base64字符串或data URL（兼容旧客户端）
+    二进制格式的图片直接交给cv2.imdecode，不经过JSON解析和Base64解码
+    :return: (参数, 图片数据)，没有图片时图片数据为None
+    """
+    with stage('parse'):
+        if request.mimetype == 'multipart/form-data':
+            upload = request.files.get('face_image')
+            return request.form, (upload.read() or None) if upload is not None else None
+        if request.mimetype == 'application/octet-stream' or request.mimetype.startswith('image/'):
+            return request.args, request.get_data(cache=False) or None
+        
+        data = request.get_json(silent=True) or {}
+    face_image = data.get('face_image')
+    if not face_image:
+        return data, None
+    # 移除Base64头部信息（如果有的话）
+    if face_image.startswith('data:image'):
+        face_image = face_image.split(',', 1)[1]
+    with stage('base64'):
+        return data, base64.b64decode(face_image)
+
+@main.before_request
+def start_request_timer():
+    g.request_started = time_module.perf_counter()
+
+@main.after_request
+def record_request_latency(response):
+    """记录接口的总耗时，按端点区分"""
+    started = g.pop('request_started', None)
+    if started is not None and request.endpoint:
+        REQUEST_SECONDS.observe(request.endpoint, time_module.perf_counter() - started)
+    return response
+
+@main.before_app_request
+def ensure_warmup():
+    """第一个请求到达时开始预热（启动脚本通常已经提前开始）"""
+    if warmup_state['status'] == 'pending':
+        start_warmup()
+
+class UploadRequest(Request):
+    """
+    按端点确定请求体大小上限：批量注册为BULK_MAX_UPLOAD_SIZE，其他接口为MAX_CONTENT_LENGTH。
+    Flask 2.3的Request.max_content_length是只读属性，不能在请求中修改，只能由请求类给出
+    """
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'main.bulk_enroll_students':
+            return BULK_MAX_UPLOAD_SIZE
+        return super().max_content_length
+
+@main.record_once
+def use_upload_request(state):
+    """注册蓝图的应用使用UploadRequest"""
+    state.app.request_class = UploadRequest
+
+@main.before_app_request
+def check_upload_size():
+    """请求体超过上限（见UploadRequest）时在读取之前直接拒绝"""
+    max_length = request.max_content_length
+    if max_length and request.content_length and request.content_length > max_length:
+        abort(413)
+
+@main.app_errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'success': False, 'message': '上传的数据过大'}), 413
+
+# 课程表索引：全部课程按星期和开始时间排序、选课名单按课程和学生保存在内存中，
+# 课程和选课的写接口直接修改索引，每TIMETABLE_REFRESH秒（默认300）从数据库整体重新加载一次
+timetable = TimetableIndex(max_age=float(os.environ.get('TIMETABLE_REFRESH', 300)))
+
+# 已签到缓存：(学生ID, 课程ID, 日期) -> 考勤状态（已有记录的状态未知时为True），命中时不再查询数据库
+checkin_cache = TTLCache(max_entries=4096, ttl=float(os.environ.get('CHECKIN_CACHE_TTL', 600)))
+
+class LazyConnection:
+    """第一次使用时才连接数据库，全部命中缓存的请求不会建立连接"""
+    
+    def __init__(self):
+        self._conn = None
+    
+    def _connect(self):
+        if self._conn is None:
+            self._conn = db.get_connection()
+        return self._conn
+    
+    def cursor(self, *args, **kwargs):
+        return self._connect().cursor(*args, **kwargs)
+    
+    def commit(self):
+        self._connect().commit()
+    
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+def find_active_courses(conn, now, course_id=None):
+    """
+    查找当前时间正在进行的课程，指定course_id时只返回该课程（不检查时间）。
+    在内存中的课程表索引上二分查找，索引已加载时不查询数据库
+    :return: 课程列表，课程时间为time
+    """
+    timetable.ensure_loaded(conn)
+    return timetable.active_courses(now, course_id)
+
+# 考勤状态对应的指标结果
+STATUS_OUTCOMES = {'正常': 'on_time', '迟到': 'late'}
+# 课堂合照中每张人脸的结果对应的指标结果（recorded按考勤状态区分）
+CLASS_RESULT_OUTCOMES = {
+    'low_quality': 'low_quality',
+    'unrecognized': 'unknown',
+    'duplicate': 'duplicate',
+    'not_enrolled': 'not_enrolled',
+    'already_recorded': 'duplicate'
+}
+
+def attendance_status(course_time_start, now):
+    """根据签到时间确定考勤状态：课程开始10分钟后签到为迟到"""
+    current_date = now.date()
+    time_diff = datetime.combine(current_date, now.time()) - datetime.combine(current_date, course_time_start)
+    return '迟到' if time_diff > timedelta(minutes=10) else '正常'
+
+def record_attendance(conn, student_id, course, now):
+    """
+    为学生记录课程今天的考勤
+    :param course: find_active_courses返回的课程
+    :return: (是否新增了记录, 考勤状态)，今天已经签到过时返回(False, None)
+    """
+    current_date = now.date()
+    key = (student_id, course['course_id'], current_date)
+    
+    # 刚签到过的学生重复提交时直接返回，不查询数据库
+    if checkin_cache.get(key) is not None:
+        return False, None
+    
+    # 一条语句完成检查和插入：今天已有记录时唯一键unique_student_course_date冲突，不插入，影响行数为0。
+    # 两个考勤终端同时提交同一学生时也只有一个插入成功，不会出现重复键错误；
+    # 其他错误（例如学生或课程刚被删除）照常抛出，不会当作已经签到过
+    status = attendance_status(course['course_time_start'], now)
+    if attendance_journal is not None:
+        # 延迟写入模式：写入本地日志后立即返回，不等待数据库提交
+        inserted = attendance_journal.append(conn, [(student_id, course['course_id'], current_date, now.time(), status)])[0]
+    else:
+        cursor = conn.cursor()
+        cursor.execute(
+            INSERT_ATTENDANCE_SQL,
+            (student_id, course['course_id'], current_date, now.time(), status)
+        )
+        inserted = cursor.rowcount == 1
+        conn.commit()
+        cursor.close()
+    if not inserted:
+        checkin_cache.set(key, True)
+        return False, None
+    checkin_cache.set(key, status)
+    return True, status
+
+def get_course_rosters(conn, course_ids):
+    """获取课程的选课学生名单（课程ID -> frozenset(学生ID)），识别结果所在的课程只需要一次集合查找"""
+    timetable.ensure_loaded(conn)
+    return timetable.rosters(course_ids)
+
+def invalidate_course_rosters(course_id=None):
+    """选课关系变化后丢弃课程（course_id为None时为全部课程）的子人脸库，下次识别时按新名单重新构建"""
+    face_service.invalidate_galleries(None if course_id is None else int(course_id))
+
+def prepare_course_galleries(lead_minutes=15):
+    """
+    为正在进行和即将开始的课程预先构建子人脸库，识别时不需要再临时构建。由课程定时任务在课程开始前调用
+    :param lead_minutes: 提前构建的时间（分钟）
+    :return: 准备好的课程数量
+    """
+    if not face_service.trained:
+        return 0
+    try:
+        now = datetime.now()
+        upcoming = min(now + timedelta(minutes=lead_minutes), datetime.combine(now.date(), dt_time.max))
+        conn = LazyConnection()
+        timetable.ensure_loaded(conn)
+        conn.close()
+        course_ids = [course['course_id'] for course in timetable.active_courses(now, until=upcoming)]
+        rosters = timetable.rosters(course_ids)
+        for course_id, student_ids in rosters.items():
+            face_service.course_gallery(course_id, student_ids)
+        return len(rosters)
+    except Exception as e:
+        logger.warning("Error preparing course galleries: %s", e)
+        return 0
+
+def compute_watermark(rows, student_count):
+    """根据已加载的行计算快照水位：最大updated_at、该时刻更新的学生以及学生数量"""
+    updated = [row['updated_at'] for row in rows if row.get('updated_at')]
+    if not updated:
+        return {'updated_at': None, 'boundary_ids': [], 'student_count': student_count}
+    max_updated = max(updated)
+    return {
+        'updated_at': max_updated.isoformat(),
+        # 与水位同一时刻更新的学生，重放时跳过以避免重复加载
+        'boundary_ids': [row['student_id'] for row in rows if row.get('updated_at') == max_updated],
+        'student_count': student_count
+    }
+
+def advance_watermark(conn, watermark, applied):
+    """
+    推进快照水位：按updated_at顺序检查水位之后变化的行，直到第一行没有加入本进程的模型
+    :param watermark: 当前水位
+    :param applied: 学号 -> 加入模型时的updated_at
+    :return: 新水位，新水位之前的行（以及水位时刻boundary_ids中的学生）都已经在模型中
+    """
+    cursor = conn.cursor(dictionary=True)
+    if watermark.get('updated_at'):
+        cursor.execute(
+            "SELECT student_id, updated_at FROM students WHERE face_encoding IS NOT NULL AND updated_at >= %s ORDER BY updated_at",
+            (datetime.fromisoformat(watermark['updated_at']),)
+        )
+    else:
+        cursor.execute("SELECT student_id, updated_at FROM students WHERE face_encoding IS NOT NULL ORDER BY updated_at")
+    rows = cursor.fetchall()
+    cursor.close()
+    
+    advanced = dict(watermark, student_count=len(face_service.known_faces))
+    boundary_ids = set(watermark.get('boundary_ids', []))
+    index = 0
+    while index < len(rows):
+        updated_at = rows[index]['updated_at']
+        group = []
+        while index < len(rows) and rows[index]['updated_at'] == updated_at:
+            group.append(rows[index]['student_id'])
+            index += 1
+        done = [student_id for student_id in group if applied.get(student_id) == updated_at
+                or (updated_at.isoformat() == watermark.get('updated_at') and student_id in boundary_ids)]
+        if not done:
+            break
+        advanced.update(updated_at=updated_at.isoformat(), boundary_ids=done)
+        if len(done) < len(group):
+            break
+    return advanced
+
 # 初始化时加载已有人脸数据
-def load_known_faces():
+def load_known_faces(full=False):
+    """
+    加载人脸数据。优先从快照恢复，只重放快照水位之后变化的行；
+    没有可用快照或full=True时从数据库完整加载并重新训练。进度记录在warmup_state中
+    :return: 是否加载成功
+    """
+    with snapshot_lock:
+        loaded = _load_known_faces(full)
+        # 加载期间记录的学生可能不在新模型中，之后保存快照时照常重放
+        with snapshot_state_lock:
+            snapshot_state['applied'] = {}
+    return loaded
+
+def _load_known_faces(full):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        update_warmup(stage='snapshot', loaded=0, total=0, error=None)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
-        cursor.execute("SELECT student_id, face_encoding FROM students WHERE face_encoding IS NOT NULL")
-        faces = cursor.fetchall()
+        watermark = None if full else face_service.load_snapshot(SNAPSHOT_DIR)
         
-        for face in faces:
-            if face['face_encoding']:
-                # 从数据库加载人脸数据
-                face_service.load_face_data(face['face_encoding'], face['student_id'])
+        if watermark and watermark.get('updated_at'):
+            # 删除的学生：快照中有但数据库中已没有人脸数据
+            cursor.execute("SELECT student_id FROM students WHERE face_encoding IS NOT NULL")
+            current_ids = {row['student_id'] for row in cursor.fetchall()}
+            removed = [sid for sid in list(face_service.known_faces.values()) if sid not in current_ids]
+            for student_id in removed:
+                face_service.remove_face(student_id)
+            
+            # 只重放水位之后变化的行
+            cursor.execute(
+                "SELECT student_id, face_encoding, updated_at FROM students WHERE face_encoding IS NOT NULL AND updated_at >= %s",
+                (datetime.fromisoformat(watermark['updated_at']),)
+            )
+            rows = cursor.fetchall()
+            boundary_ids = set(watermark.get('boundary_ids', []))
+            boundary_time = watermark['updated_at']
+            changed = [row for row in rows
+                       if not (row['updated_at'].isoformat() == boundary_time and row['student_id'] in boundary_ids)]
+            
+            update_warmup(stage='replay', total=len(changed))
+            for i, row in enumerate(changed, 1):
+                # 更新过人脸的学生先移除旧样本
+                face_service.remove_face(row['student_id'])
+                face_service.load_face_data(row['face_encoding'], row['student_id'])
+                if i % 100 == 0:
+                    update_warmup(loaded=i)
+            update_warmup(stage='train', loaded=len(changed))
+            face_service.update_model(wait=True)
+            # 快照之后删除的学生仍残留在模型中，需要时完整重建清除
+            face_service.purge_removed(wait=True)
+            
+            logger.info("Replayed %s changed and %s removed students since snapshot", len(changed), len(removed))
+            snapshot_state['watermark'] = watermark
+            if changed or removed:
+                new_watermark = compute_watermark(rows, len(current_ids)) if rows else dict(watermark, student_count=len(current_ids))
+                snapshot_state['watermark'] = new_watermark
+                face_service.save_snapshot(SNAPSHOT_DIR, new_watermark)
+        else:
+            face_service.reset()
+            # 按主键顺序加载，没有快照时新分配的标签也是确定的
+            cursor.execute("SELECT student_id, face_encoding, updated_at FROM students WHERE face_encoding IS NOT NULL ORDER BY id")
+            faces = cursor.fetchall()
+            
+            update_warmup(stage='load', total=len(faces))
+            for i, face in enumerate(faces, 1):
+                if face['face_encoding']:
+                    # 从数据库加载人脸数据
+                    face_service.load_face_data(face['face_encoding'], face['student_id'])
+                if i % 100 == 0:
+                    update_warmup(loaded=i)
+            
+            # 训练模型并保存快照
+            update_warmup(stage='train', loaded=len(faces))
+            face_service.train_model(wait=True)
+            snapshot_state['watermark'] = compute_watermark(faces, len(faces))
+            if len(face_service.face_samples) > 0:
+                face_service.save_snapshot(SNAPSHOT_DIR, snapshot_state['watermark'])
         
-        # 训练模型
-        if len(face_service.face_samples) > 0:
-            face_service.train_model()
+        if recognition_pool is not None and face_service.snapshot_version:
+            recognition_pool.set_snapshot_version(face_service.snapshot_version)
         
         cursor.close()
         conn.close()
         
-        print(f"Loaded {len(face_service.known_faces)} known faces")
+        logger.info("Loaded %s known faces", len(face_service.known_faces))
+        return True
     except Exception as e:
-        print(f"Error loading known faces: {e}")
-
-# 在应用启动时加载人脸数据
-load_known_faces()
+        logger.error("Error loading known faces: %s", e)
+        update_warmup(error=str(e))
+        return False
 
 # 测试路由
 @main.route('/api/')
 def index():
     return jsonify({'message': '学生人脸识别考勤系统API'})
 
+# 识别流程各阶段耗时和考勤结果计数（Prometheus文本格式）
+@main.route('/api/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# 数据库连接池的使用情况：借出和空闲的连接数、等待次数和时间
+@main.route('/api/db_pool')
+def db_pool_stats():
+    return jsonify(db.stats())
+
+# 就绪检查：人脸数据加载完成前返回503，负载均衡器据此决定是否转发识别请求
+@main.route('/api/ready')
+def ready():
+    with warmup_lock:
+        state = dict(warmup_state)
+    state.update(ready=state['status'] == 'ready', known_faces_count=len(face_service.known_faces))
+    return jsonify(state), 200 if state['ready'] else 503
+
 # 调试接口：检查人脸识别状态
 @main.route('/api/face_status')
 def face_status():
@@ -63,14 +630,32 @@ def face_status():
         'trained': face_service.trained,
         'known_faces_count': len(face_service.known_faces),
         'face_samples_count': len(face_service.face_samples),
-        'ids_count': len(face_service.ids)
+        'ids_count': len(face_service.ids),
+        'pending_samples_count': len(face_service.pending_samples),
+        'stale_samples_count': face_service.stale_samples,
+        'model_generation': face_service.generation.number if face_service.generation else 0
     })
 
+# 完整重建人脸识别模型（从数据库重新加载，清除已删除学生残留的样本并刷新快照）
+@main.route('/api/face_model/rebuild', methods=['POST'])
+def rebuild_face_model():
+    try:
+        if not load_known_faces(full=True):
+            return jsonify({'success': False, 'message': warmup_state['error']})
+        trained = face_service.trained
+        return jsonify({
+            'success': trained,
+            'message': '模型重建完成' if trained else '没有可用于训练的人脸数据',
+            'face_samples_count': len(face_service.face_samples)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
 # 调试接口：检查特定学生的人脸数据
 @main.route('/api/debug/student/<student_id>')
 def debug_student(student_id):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("SELECT id, student_id, name, class_name, face_encoding FROM students WHERE student_id = %s", (student_id,))
@@ -101,7 +686,7 @@ def debug_student(student_id):
 @main.route('/api/debug/courses')
 def debug_courses():
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("SELECT * FROM courses")
@@ -118,7 +703,7 @@ def debug_courses():
 @main.route('/api/debug/student/<student_id>/courses')
 def debug_student_courses_by_id(student_id):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         # 获取当前星期
@@ -148,7 +733,7 @@ def debug_student_courses_by_id(student_id):
 @main.route('/api/debug/student_courses')
 def debug_student_courses():
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("SELECT * FROM student_courses")
@@ -165,31 +750,24 @@ def debug_student_courses():
 @main.route('/api/test_recognize', methods=['POST'])
 def test_recognize():
     try:
-        data = request.get_json()
-        face_image = data.get('face_image')  # Base64格式的人脸图片
+        data, image_data = read_face_upload()  # 人脸图片：二进制上传或Base64
         
-        if not face_image:
+        if image_data is None:
             return jsonify({'success': False, 'message': '未提供人脸图片'})
         
-        # 移除Base64头部信息（如果有的话）
-        if face_image.startswith('data:image'):
-            face_image_data = face_image.split(',')[1]
-        else:
-            face_image_data = face_image
-        
-        # 解码Base64字符串
-        image_data = base64.b64decode(face_image_data)
-        
-        # 调试：检查是否能检测到人脸
-        nparr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        faces = face_service.detect_faces(img)
+        # 只解码一次，检测结果直接用于识别
+        results = recognize_image(image_data)
+        if results is None:
+            return jsonify({'success': False, 'message': '无法解码图像数据'})
         
-        if len(faces) == 0:
+        if len(results) == 0:
             return jsonify({'success': False, 'message': '未检测到人脸，请确保人脸清晰可见'})
         
+        if results[0].get('quality'):
+            return quality_rejection(results[0]['quality'])
+        
         # 识别人脸
-        student_id = face_service.recognize_face(image_data)
+        student_id = results[0]['student_id']
         
         if not student_id:
             return jsonify({'success': False, 'message': '未识别到学生，请确保已添加该学生的人脸数据'})
@@ -206,13 +784,7 @@ def test_recognize():
 @main.route('/api/students', methods=['GET'])
 def get_students():
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        # 增加排序缓冲区大小以避免"Out of sort memory"错误
-        cursor = conn.cursor()
-        cursor.execute("SET SESSION sort_buffer_size = 2097152")  # 设置为2MB
-        cursor.execute("SET SESSION read_rnd_buffer_size = 2097152")  # 设置为2MB
-        cursor.close()
-        
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("""
@@ -243,48 +815,39 @@ def get_students():
 @main.route('/api/students', methods=['POST'])
 def add_student():
     try:
-        data = request.get_json()
+        data, image_data = read_face_upload()  # 人脸图片：二进制上传或Base64
+        if image_data is not None and not model_ready():
+            # 加载过程会重置人脸库，加载期间添加的人脸会丢失
+            return model_not_ready_response()
         student_id = data.get('student_id')
         name = data.get('name')
         class_name = data.get('class_name')
-        face_image = data.get('face_image')  # Base64格式的人脸图片
         
-        print(f"Adding student: {student_id}, {name}, {class_name}")
+        logger.debug("Adding student: %s, %s, %s", student_id, name, class_name)
         
         face_encoding = None
-        if face_image:
-            print("Processing face image...")
-            # 移除Base64头部信息（如果有的话）
-            if face_image.startswith('data:image'):
-                face_image_data = face_image.split(',')[1]
-            else:
-                face_image_data = face_image
-            
-            # 解码Base64字符串
-            image_data = base64.b64decode(face_image_data)
-            print(f"Image data size: {len(image_data)} bytes")
+        if image_data is not None:
+            logger.debug("Processing face image...")
+            logger.debug("Image data size: %s bytes", len(image_data))
             
-            # 添加人脸数据
-            face_added = face_service.add_face(image_data, student_id)
-            print(f"Face added: {face_added}")
+            # 解码并检测一次，提取的人脸同时用于训练和存储（注册样本使用全分辨率）
+            frame = face_service.decode_frame(image_data, reduced=False)
+            faces = face_service.detect_faces(frame) if frame is not None else []
+            face_added = False
+            if len(faces) > 0:
+                face_roi = face_service.extract_face(frame, faces[0])
+                face_added = face_service.add_face_roi(face_roi, student_id)
+            logger.debug("Face added: %s", face_added)
             
             if face_added:
-                # 重新训练模型
-                trained = face_service.train_model()
-                print(f"Model trained: {trained}")
+                # 增量更新模型（只训练新增的样本）
+                trained = face_service.update_model()
+                logger.debug("Model updated: %s", trained)
                 
-                # 直接使用已经添加的人脸数据而不是重新提取
-                # 注意：这里需要获取最新添加的人脸数据
-                if len(face_service.face_samples) > 0:
-                    last_face_roi = face_service.face_samples[-1]  # 获取最新添加的人脸样本
-                    # 检查方法是否存在
-                    if hasattr(face_service, 'serialize_face'):
-                        face_encoding = face_service.serialize_face(last_face_roi)
-                        print(f"Face encoding generated, length: {len(face_encoding) if face_encoding else 0}")
-                    else:
-                        print("serialize_face method not found!")
-        
-        conn = mysql.connector.connect(**DB_CONFIG)
+                face_encoding = face_service.serialize_face(face_roi)
+                logger.debug("Face encoding generated, length: %s", len(face_encoding) if face_encoding else 0)
+        
+        conn = db.get_connection()
         cursor = conn.cursor()
         
         cursor.execute(
@@ -298,18 +861,193 @@ def add_student():
         cursor.close()
         conn.close()
         
+        if face_encoding:
+            note_applied_faces([student_id])
+        
         return jsonify({'success': True, 'message': '学生添加成功', 'student_id': student_id_db})
     except Exception as e:
-        print(f"Error adding student: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error adding student")
         return jsonify({'success': False, 'message': str(e)})
 
+# 批量注册配置：压缩包大小上限、并行检测的线程数
+BULK_MAX_UPLOAD_SIZE = int(os.environ.get('BULK_MAX_UPLOAD_SIZE', 512 * 1024 * 1024))
+BULK_ENROLL_WORKERS = int(os.environ.get('BULK_ENROLL_WORKERS', 0)) or min(8, os.cpu_count() or 1)
+BULK_PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+BULK_MAX_PHOTO_SIZE = 20 * 1024 * 1024
+# 每条批量INSERT语句的最大数据量，低于MySQL默认的max_allowed_packet
+BULK_INSERT_BYTES = 4 * 1024 * 1024
+
+def read_bulk_manifest(archive):
+    """读取压缩包根目录的students.csv（student_id,name,class_name），没有时返回空字典"""
+    try:
+        content = archive.read('students.csv').decode('utf-8-sig')
+    except KeyError:
+        return {}
+    manifest = {}
+    for row in csv.DictReader(io.StringIO(content)):
+        student_id = (row.get('student_id') or '').strip()
+        if student_id:
+            manifest[student_id] = ((row.get('name') or '').strip() or student_id, (row.get('class_name') or '').strip())
+    return manifest
+
+def iter_bulk_photos(archive):
+    """按顺序读取压缩包中的照片，照片所在目录名为学号：(文件名, 学号, 图片数据或None, 错误)"""
+    for info in archive.infolist():
+        name = info.filename
+        parts = [part for part in name.split('/') if part]
+        if info.is_dir() or not parts or parts[0] == '__MACOSX' or parts[-1].startswith('.'):
+            continue
+        if not parts[-1].lower().endswith(BULK_PHOTO_EXTENSIONS):
+            continue
+        if len(parts) < 2:
+            yield name, None, None, 'no_student_dir'
+        elif len(parts[-2]) > 20:
+            yield name, parts[-2], None, 'invalid_student_id'
+        elif info.file_size > BULK_MAX_PHOTO_SIZE:
+            yield name, parts[-2], None, 'too_large'
+        else:
+            yield name, parts[-2], archive.read(info), None
+
+def write_bulk_students(samples, manifest, default_class):
+    """
+    把批量注册的学生和人脸样本分批写入数据库：已有学生追加样本，新学生一并插入
+    :param samples: 学号 -> 人脸区域列表
+    :return: (新增学生数, 更新学生数)
+    """
+    student_ids = list(set(samples) | set(manifest))
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    
+    # 分批查询已有学生及其人脸数据
+    existing = {}
+    for start in range(0, len(student_ids), 500):
+        batch = student_ids[start:start + 500]
+        cursor.execute(
+            "SELECT student_id, face_encoding FROM students WHERE student_id IN ({})".format(
+                ', '.join(['%s'] * len(batch))),
+            batch
+        )
+        existing.update(cursor.fetchall())
+    
+    rows = []
+    for student_id in student_ids:
+        face_encoding = None
+        if samples.get(student_id):
+            stacked = np.stack(samples[student_id])
+            if existing.get(student_id):
+                stacked = np.concatenate([decode_face_samples(existing[student_id]), stacked])
+            face_encoding = encode_face_samples(stacked)
+        name, class_name = manifest.get(student_id, (student_id, default_class))
+        rows.append((student_id, name, class_name, face_encoding))
+    
+    # 按数据量分批插入，已有学生只更新人脸数据
+    query = (
+        "INSERT INTO students (student_id, name, class_name, face_encoding) VALUES (%s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE face_encoding = COALESCE(VALUES(face_encoding), face_encoding)"
+    )
+    batch, batch_bytes = [], 0
+    for row in rows:
+        batch.append(row)
+        batch_bytes += len(row[3] or b'')
+        if batch_bytes >= BULK_INSERT_BYTES:
+            cursor.executemany(query, batch)
+            batch, batch_bytes = [], 0
+    if batch:
+        cursor.executemany(query, batch)
+    conn.commit()
+    cursor.close()
+    conn.close()
+    
+    updated = sum(1 for student_id in student_ids if student_id in existing)
+    return len(student_ids) - updated, updated
+
+# 批量注册学生：上传按学号分目录的照片压缩包，逐张照片流式返回处理结果（每行一个JSON）
+@main.route('/api/students/bulk', methods=['POST'])
+def bulk_enroll_students():
+    if not model_ready():
+        return model_not_ready_response()
+    upload = request.files.get('archive')
+    if upload is None:
+        return jsonify({'success': False, 'message': '未提供照片压缩包'})
+    # 请求结束后上传文件会被关闭，复制到流式响应自己管理的临时文件
+    spool = tempfile.TemporaryFile()
+    upload.save(spool)
+    try:
+        archive = zipfile.ZipFile(spool)
+        manifest = read_bulk_manifest(archive)
+    except (zipfile.BadZipFile, UnicodeDecodeError, csv.Error) as e:
+        spool.close()
+        return jsonify({'success': False, 'message': f'无法读取压缩包: {e}'})
+    default_class = request.form.get('class_name', '')
+    
+    def report(name, student_id, result, faces=0):
+        return json.dumps({'photo': name, 'student_id': student_id, 'result': result, 'faces': faces},
+                          ensure_ascii=False) + '\n'
+    
+    def generate():
+        try:
+            yield from enroll()
+        finally:
+            archive.close()
+            spool.close()
+    
+    def enroll():
+        samples = {}  # 学号 -> 人脸区域列表
+        photos = enrolled = 0
+        # 解码和检测在线程池中并行（OpenCV执行期间释放GIL），最多同时处理线程数4倍的照片
+        with ThreadPoolExecutor(BULK_ENROLL_WORKERS, thread_name_prefix='bulk-enroll') as executor:
+            pending = deque()
+            
+            def finish(item):
+                name, student_id, future = item
+                face_roi, faces = future.result()
+                if face_roi is None:
+                    return report(name, student_id, 'decode_failed' if faces < 0 else 'no_face')
+                samples.setdefault(student_id, []).append(face_roi)
+                return report(name, student_id, 'ok', faces)
+            
+            for name, student_id, image_data, error in iter_bulk_photos(archive):
+                photos += 1
+                if error:
+                    yield report(name, student_id, error)
+                    continue
+                pending.append((name, student_id, executor.submit(face_service.extract_enrollment_face, image_data)))
+                while len(pending) > BULK_ENROLL_WORKERS * 4:
+                    yield finish(pending.popleft())
+            while pending:
+                yield finish(pending.popleft())
+        
+        enrolled = sum(len(rois) for rois in samples.values())
+        summary = {'summary': True, 'photos': photos, 'enrolled_photos': enrolled, 'students': len(samples)}
+        try:
+            with stage('db_write'):
+                summary['new_students'], summary['updated_students'] = write_bulk_students(
+                    samples, manifest, default_class)
+        except Exception as e:
+            logger.exception("Error writing bulk enrollment")
+            summary.update(success=False, message=str(e))
+            yield json.dumps(summary, ensure_ascii=False) + '\n'
+            return
+        
+        # 数据库写入成功后加入人脸库，全部样本只训练一次
+        for student_id, face_rois in samples.items():
+            for face_roi in face_rois:
+                face_service.add_face_roi(face_roi, student_id)
+        if samples:
+            face_service.update_model()
+            note_applied_faces(samples)
+        summary.update(success=True, message=f'处理 {photos} 张照片，注册 {len(samples)} 名学生的 {enrolled} 个人脸样本')
+        yield json.dumps(summary, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # 删除学生
 @main.route('/api/students/<student_id>', methods=['DELETE'])
 def delete_student(student_id):
+    if not model_ready():
+        return model_not_ready_response()
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor()
         
         # 删除学生（相关的课程关联和考勤记录会自动通过外键约束删除）
@@ -322,6 +1060,14 @@ def delete_student(student_id):
         conn.close()
         
         if rows_affected > 0:
+            # 从人脸库中移除该学生，并在后台重建模型清除其残留样本（连续删除时合并为一次）
+            face_service.remove_face(student_id)
+            face_service.purge_removed()
+            # 没有重建模型时也要保存新快照，识别工作进程才会停止识别该学生
+            _snapshot_event.set()
+            timetable.remove_student(student_id)
+            invalidate_course_rosters()
+            checkin_cache.clear()
             return jsonify({'success': True, 'message': '学生删除成功'})
         else:
             return jsonify({'success': False, 'message': '未找到该学生'})
@@ -332,7 +1078,7 @@ def delete_student(student_id):
 @main.route('/api/courses', methods=['GET'])
 def get_courses():
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("SELECT id, course_name, course_time_start, course_time_end, weekday FROM courses")
@@ -366,7 +1112,7 @@ def add_course():
         course_time_end = data.get('course_time_end')
         weekday = data.get('weekday')
         
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor()
         
         cursor.execute(
@@ -376,6 +1122,15 @@ def add_course():
         conn.commit()
         
         course_id = cursor.lastrowid
+        cursor.close()
+        
+        # 读回数据库保存的课程时间，更新课程表索引
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT id, course_name, course_time_start, course_time_end, weekday FROM courses WHERE id = %s",
+            (course_id,)
+        )
+        timetable.add_course(cursor.fetchone())
         
         cursor.close()
         conn.close()
@@ -388,7 +1143,7 @@ def add_course():
 @main.route('/api/courses/<course_id>', methods=['DELETE'])
 def delete_course(course_id):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor()
         
         # 删除课程（相关的学生课程关联和考勤记录会自动通过外键约束删除）
@@ -401,6 +1156,9 @@ def delete_course(course_id):
         conn.close()
         
         if rows_affected > 0:
+            timetable.remove_course(course_id)
+            invalidate_course_rosters(course_id)
+            checkin_cache.clear()
             return jsonify({'success': True, 'message': '课程删除成功'})
         else:
             return jsonify({'success': False, 'message': '未找到该课程'})
@@ -415,7 +1173,7 @@ def assign_course_to_student():
         student_id = data.get('student_id')
         course_id = data.get('course_id')
         
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor()
         
         # 检查是否已经存在该选课记录
@@ -430,11 +1188,15 @@ def assign_course_to_student():
             conn.close()
             return jsonify({'success': False, 'message': '该学生已选择此课程'})
         
+        # created_at记录选课时间，补录缺勤时选课之前的课程不记缺勤（旧数据库先补上这一列）
+        ensure_absence_schema(conn)
         cursor.execute(
-            "INSERT INTO student_courses (student_id, course_id) VALUES (%s, %s)",
+            "INSERT INTO student_courses (student_id, course_id, created_at) VALUES (%s, %s, NOW())",
             (student_id, course_id)
         )
         conn.commit()
+        timetable.enroll(student_id, course_id)
+        invalidate_course_rosters(course_id)
         
         cursor.close()
         conn.close()
@@ -447,7 +1209,7 @@ def assign_course_to_student():
 @main.route('/api/student_courses/<student_id>/<course_id>', methods=['DELETE'])
 def delete_student_course(student_id, course_id):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor()
         
         # 删除学生课程关联
@@ -463,6 +1225,8 @@ def delete_student_course(student_id, course_id):
         conn.close()
         
         if rows_affected > 0:
+            timetable.unenroll(student_id, course_id)
+            invalidate_course_rosters(course_id)
             return jsonify({'success': True, 'message': '学生课程关联删除成功'})
         else:
             return jsonify({'success': False, 'message': '未找到该学生课程关联'})
@@ -473,7 +1237,7 @@ def delete_student_course(student_id, course_id):
 @main.route('/api/student_courses/<student_id>', methods=['GET'])
 def get_student_courses(student_id):
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("""
@@ -514,7 +1278,7 @@ def test_course_query(student_id):
         }
         current_weekday = weekdays_chinese[datetime.now().weekday()]
         
-        conn = mysql.connector.connect(**DB_CONFIG)
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         # 查询学生当天的课程
@@ -543,121 +1307,58 @@ def test_course_query(student_id):
 # 人脸识别考勤
 @main.route('/api/attendance/recognize', methods=['POST'])
 def recognize_attendance():
+    if not model_ready():
+        return model_not_ready_response()
     try:
-        data = request.get_json()
-        face_image = data.get('face_image')  # Base64格式的人脸图片
+        data, image_data = read_face_upload()  # 人脸图片：二进制上传或Base64
         
-        if not face_image:
+        if image_data is None:
             return jsonify({'success': False, 'message': '未提供人脸图片'})
         
-        # 移除Base64头部信息（如果有的话）
-        if face_image.startswith('data:image'):
-            face_image_data = face_image.split(',')[1]
-        else:
-            face_image_data = face_image
-        
-        # 解码Base64字符串
-        image_data = base64.b64decode(face_image_data)
-        
-        # 识别人脸
-        student_id = face_service.recognize_face(image_data)
-        
-        if not student_id:
-            return jsonify({'success': False, 'message': '未识别到学生'})
-        
-        # 获取当前时间和星期几
+        # 获取当前时间
         now = datetime.now()
-        current_time = now.time()
-        current_date = now.date()
-        
-        # 获取星期名称（与数据库中的格式一致）
-        weekdays_chinese = {
-            0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday',
-            4: 'Friday', 5: 'Saturday', 6: 'Sunday'
-        }
-        current_weekday = weekdays_chinese[now.weekday()]
-        
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
-        # 查找该学生当天的课程
-        cursor.execute("""
-            SELECT c.id as course_id, c.course_name, c.course_time_start, c.course_time_end
-            FROM courses c
-            JOIN student_courses sc ON c.id = sc.course_id
-            WHERE sc.student_id = %s AND c.weekday = %s
-        """, (student_id, current_weekday))
         
-        courses = cursor.fetchall()
-        
-        if not courses:
-            cursor.close()
-            conn.close()
-            return jsonify({'success': False, 'message': '今天没有课程'})
-        
-        # 查找最适合的课程（当前时间范围内的课程）
-        target_course = None
-        for course in courses:
-            # 处理时间格式
-            course_time_start = course['course_time_start']
-            course_time_end = course['course_time_end']
-            
-            # 如果是timedelta类型，转换为time类型
-            if isinstance(course_time_start, timedelta):
-                course_time_start = (datetime.min + course_time_start).time()
-            if isinstance(course_time_end, timedelta):
-                course_time_end = (datetime.min + course_time_end).time()
-            
-            # 确保比较的是相同类型
-            if isinstance(course_time_start, str):
-                course_time_start = datetime.strptime(course_time_start, '%H:%M:%S').time()
-            if isinstance(course_time_end, str):
-                course_time_end = datetime.strptime(course_time_end, '%H:%M:%S').time()
-            
-            # 更新课程时间（确保类型正确）
-            course['course_time_start'] = course_time_start
-            course['course_time_end'] = course_time_end
-            
-            if course_time_start <= current_time <= course_time_end:
-                target_course = course
-                break
+        # 课程表、选课名单、识别结果和已签到状态都命中缓存时，重复提交不会连接数据库
+        conn = LazyConnection()
         
-        if not target_course:
-            cursor.close()
+        # 先确定正在进行的课程（考勤终端可以指定课程），只在这些课程的选课学生中识别
+        with stage('course_lookup'):
+            active_courses = find_active_courses(conn, now, data.get('course_id'))
+            rosters = get_course_rosters(conn, [course['course_id'] for course in active_courses]) if active_courses else {}
+        if not active_courses:
             conn.close()
+            record_outcome('no_course')
             return jsonify({'success': False, 'message': '当前时间不在课程时间范围内'})
         
-        # 检查是否已存在今天的考勤记录
-        cursor.execute(
-            "SELECT id FROM attendance_records WHERE student_id = %s AND course_id = %s AND record_date = %s",
-            (student_id, target_course['course_id'], current_date)
-        )
-        
-        existing_record = cursor.fetchone()
-        
-        if existing_record:
-            cursor.close()
+        # 识别人脸
+        results = recognize_image(image_data, rosters=rosters)
+        if results and results[0].get('quality'):
             conn.close()
-            return jsonify({'success': False, 'message': '今天该课程已经签到过了', 'student_id': student_id})
+            record_outcome('low_quality')
+            return quality_rejection(results[0]['quality'])
+        student_id = results[0]['student_id'] if results else None
         
-        # 确定考勤状态
-        status = '正常'
-        # 计算是否迟到（课程开始10分钟后签到为迟到）
-        if current_time > target_course['course_time_start']:
-            time_diff = datetime.combine(current_date, current_time) - datetime.combine(current_date, target_course['course_time_start'])
-            if time_diff > timedelta(minutes=10):
-                status = '迟到'
+        if not student_id:
+            conn.close()
+            record_outcome('unknown' if results else 'no_face')
+            return jsonify({'success': False, 'message': '未识别到学生'})
         
-        # 插入新的考勤记录
-        cursor.execute(
-            "INSERT INTO attendance_records (student_id, course_id, record_date, record_time, status) VALUES (%s, %s, %s, %s, %s)",
-            (student_id, target_course['course_id'], current_date, current_time, status)
-        )
-        conn.commit()
+        # 识别结果所在的课程（缓存的识别结果可能来自名单变化之前）
+        target_course = next((course for course in active_courses if student_id in rosters[course['course_id']]), None)
+        if target_course is None:
+            conn.close()
+            record_outcome('not_enrolled')
+            return jsonify({'success': False, 'message': '该学生未选择当前课程', 'student_id': student_id})
         
-        cursor.close()
+        with stage('db_write'):
+            recorded, status = record_attendance(conn, student_id, target_course, now)
         conn.close()
         
+        if not recorded:
+            record_outcome('duplicate')
+            return jsonify({'success': False, 'message': '今天该课程已经签到过了', 'student_id': student_id})
+        record_outcome(STATUS_OUTCOMES[status])
+        
         return jsonify({
             'success': True, 
             'message': f'考勤成功，状态：{status}', 
@@ -666,135 +1367,375 @@ def recognize_attendance():
             'status': status
         })
     except Exception as e:
-        print(f"Error in recognize_attendance: {e}")  # 调试信息
+        logger.exception("Error in recognize_attendance")
         return jsonify({'success': False, 'message': str(e)})
 
-# 自动检查并添加缺勤记录
-@main.route('/api/attendance/check_absences', methods=['POST'])
-def check_and_add_absences():
+# 课堂合照考勤：一张照片识别所有人脸并批量记录考勤
+@main.route('/api/attendance/recognize_class', methods=['POST'])
+def recognize_class_attendance():
+    if not model_ready():
+        return model_not_ready_response()
     try:
-        # 获取当前日期和星期几
-        now = datetime.now()
-        current_date = now.date()
+        data, image_data = read_face_upload()  # 人脸图片：二进制上传或Base64
+        course_id = data.get('course_id')  # 可选，指定课程
         
-        # 获取星期名称（与数据库中的格式一致）
-        weekdays_chinese = {
-            0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday',
-            4: 'Friday', 5: 'Saturday', 6: 'Sunday'
-        }
-        current_weekday = weekdays_chinese[now.weekday()]
+        if image_data is None:
+            return jsonify({'success': False, 'message': '未提供人脸图片'})
+        
+        now = datetime.now()
         current_time = now.time()
+        current_date = now.date()
         
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
+        conn = LazyConnection()
         
-        # 查找今天有课但还没有考勤记录的学生
-        cursor.execute("""
-            SELECT DISTINCT sc.student_id, c.id as course_id, c.course_time_start, c.course_time_end
-            FROM student_courses sc
-            JOIN courses c ON sc.course_id = c.id
-            WHERE c.weekday = %s
-            AND sc.student_id NOT IN (
-                SELECT ar.student_id 
-                FROM attendance_records ar 
-                WHERE ar.record_date = %s AND ar.course_id = c.id
-            )
-        """, (current_weekday, current_date))
+        # 只解析一次课程：指定的课程或当前时间正在进行的课程
+        with stage('course_lookup'):
+            candidate_courses = find_active_courses(conn, now, course_id)
+            rosters = get_course_rosters(conn, [c['course_id'] for c in candidate_courses]) if candidate_courses else {}
+        if not candidate_courses:
+            conn.close()
+            record_outcome('no_course')
+            return jsonify({'success': False, 'message': '当前时间不在课程时间范围内'})
         
-        courses_without_attendance = cursor.fetchall()
+        # 一次解码、一次检测，只在候选课程的选课学生中识别所有人脸
+        results = recognize_image(image_data, all_faces=True, rosters=rosters)
+        if results is None:
+            conn.close()
+            return jsonify({'success': False, 'message': '无法解码图像数据'})
         
-        absent_records_added = 0
+        if not results:
+            conn.close()
+            record_outcome('no_face')
+            return jsonify({'success': False, 'message': '未检测到人脸，请确保人脸清晰可见'})
         
-        # 为每一条记录检查是否应该标记为缺勤
-        for course in courses_without_attendance:
-            course_time_end = course['course_time_end']
-            
-            # 如果课程已经结束，则添加缺勤记录
-            if isinstance(course_time_end, str):
-                course_time_end = datetime.strptime(course_time_end, '%H:%M:%S').time()
-            elif isinstance(course_time_end, timedelta):
-                course_time_end = (datetime.min + course_time_end).time()
-            
-            # 如果当前时间已经超过了课程结束时间，则标记为缺勤
-            if current_time > course_time_end:
+        recognized_ids = {r['student_id'] for r in results if r['student_id']}
+        
+        # 同时段有多门课时，选择识别出的选课学生最多的课程
+        target_course = max(candidate_courses, key=lambda c: len(recognized_ids.intersection(rosters[c['course_id']])))
+        enrolled_ids = set(rosters[target_course['course_id']])
+        course_time_start = target_course['course_time_start']
+        
+        # 识别出的选课学生今天已有的考勤记录：先查已签到缓存，其余的一次查询
+        present_ids = recognized_ids & enrolled_ids
+        existing_ids = {student_id for student_id in present_ids
+                        if checkin_cache.get((student_id, target_course['course_id'], current_date)) is not None}
+        unknown_ids = present_ids - existing_ids
+        if unknown_ids and attendance_journal is not None:
+            # 延迟写入模式：数据库中还没有日志里的签到，按内存中的当天已签到集合判断
+            with stage('attendance_lookup'):
+                existing_ids |= unknown_ids & attendance_journal.recorded(conn, target_course['course_id'], current_date)
+        elif unknown_ids:
+            with stage('attendance_lookup'):
+                cursor = conn.cursor(dictionary=True)
                 cursor.execute(
-                    "INSERT INTO attendance_records (student_id, course_id, record_date, record_time, status) VALUES (%s, %s, %s, %s, %s)",
-                    (course['student_id'], course['course_id'], current_date, current_time, '缺勤')
+                    "SELECT student_id, status FROM attendance_records WHERE course_id = %s AND record_date = %s AND student_id IN ({})".format(
+                        ', '.join(['%s'] * len(unknown_ids))),
+                    [target_course['course_id'], current_date] + list(unknown_ids)
                 )
-                absent_records_added += 1
+                for row in cursor.fetchall():
+                    existing_ids.add(row['student_id'])
+                    checkin_cache.set((row['student_id'], target_course['course_id'], current_date), row['status'])
+                cursor.close()
+        
+        # 确定考勤状态（课程开始10分钟后签到为迟到）
+        status = attendance_status(course_time_start, now)
+        
+        faces = []
+        new_records = []
+        seen_ids = set()
+        for i, result in enumerate(results):
+            x, y, w, h = result['box']
+            face = {
+                'face_id': i,
+                'x': x,
+                'y': y,
+                'width': w,
+                'height': h,
+                'student_id': result['student_id'],
+                'confidence': result['confidence'],
+                'status': None
+            }
+            student_id = result['student_id']
+            if result.get('quality'):
+                face['result'] = 'low_quality'
+                face['reason'] = result['quality']
+                face['message'] = QUALITY_MESSAGES.get(result['quality'], '图像质量不合格')
+            elif not student_id:
+                face['result'] = 'unrecognized'
+                face['message'] = '未识别到学生'
+            elif student_id in seen_ids:
+                face['result'] = 'duplicate'
+                face['message'] = '同一学生在照片中出现多次'
+            elif student_id not in enrolled_ids:
+                face['result'] = 'not_enrolled'
+                face['message'] = '该学生未选择此课程'
+            elif student_id in existing_ids:
+                face['result'] = 'already_recorded'
+                face['message'] = '今天该课程已经签到过了'
+            else:
+                face['result'] = 'recorded'
+                face['status'] = status
+                face['message'] = f'考勤成功，状态：{status}'
+                new_records.append((student_id, target_course['course_id'], current_date, current_time, status))
+            if student_id:
+                seen_ids.add(student_id)
+            faces.append(face)
+        
+        # 批量插入考勤记录（查询之后其他终端刚记录的学生按唯一键跳过，不会让整批插入失败）
+        if new_records:
+            with stage('db_write'):
+                if attendance_journal is not None:
+                    attendance_journal.append(conn, new_records)
+                else:
+                    cursor = conn.cursor()
+                    cursor.executemany(INSERT_ATTENDANCE_SQL, new_records)
+                    conn.commit()
+                    cursor.close()
+            for record in new_records:
+                checkin_cache.set(record[:3], record[4])
         
-        conn.commit()
-        cursor.close()
         conn.close()
         
+        for face in faces:
+            record_outcome(CLASS_RESULT_OUTCOMES.get(face['result']) or STATUS_OUTCOMES[face['status']])
+        
         return jsonify({
             'success': True,
-            'message': f'成功添加了 {absent_records_added} 条缺勤记录'
+            'message': f'检测到 {len(faces)} 张人脸，成功签到 {len(new_records)} 人',
+            'course_id': target_course['course_id'],
+            'course_name': target_course['course_name'],
+            'time': now.strftime('%Y-%m-%d %H:%M:%S'),
+            'recorded_count': len(new_records),
+            'faces': faces
         })
     except Exception as e:
+        logger.exception("Error in recognize_class_attendance")
         return jsonify({'success': False, 'message': str(e)})
 
-# 定时任务：每天晚上10点检查并添加缺勤记录
-def scheduled_absence_check():
-    """定时任务：检查并添加缺勤记录"""
+# 视频流考勤配置：每隔几帧完整检测一次、确认身份需要的票数、会话空闲超时（秒）
+STREAM_CONFIG = {
+    'detect_interval': int(os.environ.get('STREAM_DETECT_INTERVAL', 5)),
+    'vote_threshold': int(os.environ.get('STREAM_VOTE_THRESHOLD', 3)),
+    'session_timeout': int(os.environ.get('STREAM_SESSION_TIMEOUT', 60))
+}
+
+# 正在进行的视频流考勤会话：会话ID -> 会话状态
+stream_sessions = {}
+stream_sessions_lock = threading.Lock()
+
+class StreamSession:
+    """一个考勤终端的视频流会话：人脸跟踪状态和当前课程"""
+    
+    def __init__(self, course_id=None):
+        self.course_id = course_id  # 考勤终端指定的课程
+        self.tracker = FaceTracker(face_service, STREAM_CONFIG['detect_interval'], STREAM_CONFIG['vote_threshold'])
+        self.lock = threading.Lock()  # 同一会话的帧按顺序处理
+        self.last_seen = time_module.time()
+        self.courses = []
+        self.rosters = {}
+        self.courses_checked_at = 0
+
+def expire_stream_sessions():
+    """清理空闲超时的视频流会话"""
+    deadline = time_module.time() - STREAM_CONFIG['session_timeout']
+    with stream_sessions_lock:
+        for session_id in [sid for sid, session in stream_sessions.items() if session.last_seen < deadline]:
+            del stream_sessions[session_id]
+
+# 开始视频流考勤会话
+@main.route('/api/attendance/stream', methods=['POST'])
+def start_attendance_stream():
+    if not model_ready():
+        return model_not_ready_response()
     try:
-        # 获取当前日期和时间
-        now = datetime.now()
-        current_date = now.date()
-        current_time = now.time()
-        
-        # 获取星期名称（与数据库中的格式一致）
-        weekdays_chinese = {
-            0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday',
-            4: 'Friday', 5: 'Saturday', 6: 'Sunday'
-        }
-        current_weekday = weekdays_chinese[now.weekday()]
-        
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor(dictionary=True)
-        
-        # 查找今天有课但还没有考勤记录的学生
-        cursor.execute("""
-            SELECT DISTINCT sc.student_id, c.id as course_id, c.course_time_start, c.course_time_end
-            FROM student_courses sc
-            JOIN courses c ON sc.course_id = c.id
-            WHERE c.weekday = %s
-            AND sc.student_id NOT IN (
-                SELECT ar.student_id 
-                FROM attendance_records ar 
-                WHERE ar.record_date = %s AND ar.course_id = c.id
-            )
-        """, (current_weekday, current_date))
-        
-        courses_without_attendance = cursor.fetchall()
+        data = request.get_json(silent=True) or request.args
+        expire_stream_sessions()
+        session_id = uuid.uuid4().hex
+        with stream_sessions_lock:
+            stream_sessions[session_id] = StreamSession(data.get('course_id'))
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'detect_interval': STREAM_CONFIG['detect_interval'],
+            'vote_threshold': STREAM_CONFIG['vote_threshold']
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+# 提交视频流的一帧：跟踪人脸并累计识别投票，身份确认后记录考勤
+@main.route('/api/attendance/stream/<session_id>', methods=['POST'])
+def stream_attendance_frame(session_id):
+    if not model_ready():
+        return model_not_ready_response()
+    try:
+        with stream_sessions_lock:
+            session = stream_sessions.get(session_id)
+        if session is None:
+            return jsonify({'success': False, 'message': '会话不存在或已过期'}), 404
         
-        absent_records_added = 0
+        _, image_data = read_face_upload()
+        if image_data is None:
+            return jsonify({'success': False, 'message': '未提供人脸图片'})
+        frame = face_service.decode_frame(image_data)
+        if frame is None:
+            return jsonify({'success': False, 'message': '无法解码图像数据'})
         
-        # 为每一条记录检查是否应该标记为缺勤
-        for course in courses_without_attendance:
-            course_time_end = course['course_time_end']
-            
-            # 如果课程已经结束，则添加缺勤记录
-            if isinstance(course_time_end, str):
-                course_time_end = datetime.strptime(course_time_end, '%H:%M:%S').time()
-            elif isinstance(course_time_end, timedelta):
-                course_time_end = (datetime.min + course_time_end).time()
-            
-            # 如果当前时间已经超过了课程结束时间，则标记为缺勤
-            if current_time > course_time_end:
-                cursor.execute(
-                    "INSERT INTO attendance_records (student_id, course_id, record_date, record_time, status) VALUES (%s, %s, %s, %s, %s)",
-                    (course['student_id'], course['course_id'], current_date, current_time, '缺勤')
-                )
-                absent_records_added += 1
+        now = datetime.now()
+        records = []
+        with session.lock:
+            session.last_seen = time_module.time()
+            conn = None
+            try:
+                # 当前课程和选课名单每30秒刷新一次，不必每帧查询数据库
+                if time_module.time() - session.courses_checked_at > 30:
+                    conn = db.get_connection()
+                    with stage('course_lookup'):
+                        session.courses = find_active_courses(conn, now, session.course_id)
+                        session.rosters = get_course_rosters(conn, [c['course_id'] for c in session.courses])
+                    session.courses_checked_at = time_module.time()
+                
+                if not session.courses:
+                    return jsonify({'success': False, 'message': '当前时间不在课程时间范围内', 'faces': []})
+                
+                galleries = [face_service.course_gallery(course_id, student_ids)
+                             for course_id, student_ids in session.rosters.items()]
+                confirmed = session.tracker.process(frame, galleries)
+                
+                for track in confirmed:
+                    if conn is None:
+                        conn = db.get_connection()
+                    course = next((c for c in session.courses if track.student_id in session.rosters[c['course_id']]), None)
+                    if course is None:
+                        # 名单刷新后学生已不在当前课程中
+                        record_outcome('not_enrolled')
+                        continue
+                    with stage('db_write'):
+                        recorded, status = record_attendance(conn, track.student_id, course, now)
+                    record_outcome(STATUS_OUTCOMES[status] if recorded else 'duplicate')
+                    records.append({
+                        'track_id': track.track_id,
+                        'student_id': track.student_id,
+                        'course_id': course['course_id'],
+                        'course_name': course['course_name'],
+                        'result': 'recorded' if recorded else 'already_recorded',
+                        'status': status,
+                        'message': f'考勤成功，状态：{status}' if recorded else '今天该课程已经签到过了'
+                    })
+            finally:
+                if conn is not None:
+                    conn.close()
+            faces = [track.to_dict() for track in session.tracker.tracks.values()]
         
-        conn.commit()
-        cursor.close()
+        return jsonify({
+            'success': True,
+            'frame': session.tracker.frame_count,
+            'time': now.strftime('%Y-%m-%d %H:%M:%S'),
+            'faces': faces,
+            'records': records
+        })
+    except Exception as e:
+        logger.exception("Error in stream_attendance_frame")
+        return jsonify({'success': False, 'message': str(e)})
+
+# 结束视频流考勤会话
+@main.route('/api/attendance/stream/<session_id>', methods=['DELETE'])
+def stop_attendance_stream(session_id):
+    with stream_sessions_lock:
+        session = stream_sessions.pop(session_id, None)
+    if session is None:
+        return jsonify({'success': False, 'message': '会话不存在或已过期'})
+    return jsonify({'success': True, 'message': '会话已结束', 'frames': session.tracker.frame_count})
+
+# 启动时补做之前ABSENCE_CATCHUP_DAYS天内错过的课程关闭（服务器停机期间结束的课程），手动缺勤检查也补录这些天
+ABSENCE_CATCHUP_DAYS = int(os.environ.get('ABSENCE_CATCHUP_DAYS', 1))
+# 一次补录的最大天数
+ABSENCE_MAX_RANGE_DAYS = 366
+
+absence_schema_state = {'ready': False}
+
+def ensure_absence_schema(conn):
+    """补齐缺勤记录需要的表和列（旧数据库）：course_session_closures表和student_courses.created_at"""
+    if not absence_schema_state['ready']:
+        ensure_closures_table(conn)
+        ensure_enrollment_dates(conn)
+        absence_schema_state['ready'] = True
+
+def run_absence_materialization(start_date, end_date=None):
+    """
+    补齐日期范围内已结束课程的缺勤记录，延迟写入模式下先把日志中的签到写入数据库
+    :return: materialize_absences的汇总
+    """
+    if attendance_journal is not None:
+        attendance_journal.flush()
+    conn = db.get_connection()
+    try:
+        ensure_absence_schema(conn)
+        return materialize_absences(conn, start_date, end_date)
+    finally:
         conn.close()
+
+# 自动检查并添加缺勤记录：默认今天，请求体可以给出start_date和end_date（YYYY-MM-DD）补录之前的日期
+@main.route('/api/attendance/check_absences', methods=['POST'])
+def check_and_add_absences():
+    try:
+        data = request.get_json(silent=True) or {}
+        today = datetime.now().date()
+        try:
+            start_date = datetime.strptime(data['start_date'], '%Y-%m-%d').date() if data.get('start_date') else today
+            end_date = datetime.strptime(data['end_date'], '%Y-%m-%d').date() if data.get('end_date') else today
+        except ValueError:
+            return jsonify({'success': False, 'message': '日期格式应为YYYY-MM-DD'}), 400
+        if start_date > end_date:
+            return jsonify({'success': False, 'message': '开始日期不能晚于结束日期'}), 400
+        if (end_date - start_date).days >= ABSENCE_MAX_RANGE_DAYS:
+            return jsonify({'success': False, 'message': f'一次最多补录{ABSENCE_MAX_RANGE_DAYS}天'}), 400
+        
+        summary = run_absence_materialization(start_date, end_date)
         
-        print(f"[定时任务] 成功添加了 {absent_records_added} 条缺勤记录")
+        return jsonify({
+            'success': True,
+            'message': f'成功添加了 {summary["inserted"]} 条缺勤记录',
+            **summary
+        })
     except Exception as e:
-        print(f"[定时任务] 添加缺勤记录时发生错误: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)})
+
+# 缺勤检查：课程结束时由course_scheduler逐门关闭，这里一次补齐今天和之前ABSENCE_CATCHUP_DAYS天的缺勤记录
+def scheduled_absence_check():
+    """补齐今天和之前ABSENCE_CATCHUP_DAYS天的缺勤记录"""
+    try:
+        today = datetime.now().date()
+        summary = run_absence_materialization(today - timedelta(days=ABSENCE_CATCHUP_DAYS), today)
+        logger.info("[定时任务] 成功添加了 %s 条缺勤记录", summary['inserted'])
+    except Exception:
+        logger.exception("[定时任务] 添加缺勤记录时发生错误")
+
+def close_session(course, session_date):
+    """
+    课程结束后关闭这次课：补齐缺勤记录。多个进程都会调用，由course_session_closures表保证只执行一次
+    :param course: 课程表索引中的课程
+    :param session_date: 上课日期
+    """
+    if attendance_journal is not None:
+        attendance_journal.flush()
+    conn = db.get_connection()
+    try:
+        ensure_absence_schema(conn)
+        inserted = close_course_session(conn, course['course_id'], course['course_time_end'], session_date)
+    finally:
+        conn.close()
+    if inserted is not None:
+        logger.info("Closed course %s (%s) on %s, %d absences recorded",
+                    course['course_id'], course['course_name'], session_date, inserted)
+
+# 课程定时任务：按课程表在课程开始前15分钟准备子人脸库，在课程结束ABSENCE_CLOSE_DELAY秒（默认60）后关闭课程。
+# 由start_warmup启动，每个进程都运行
+course_scheduler = CourseScheduler(
+    timetable, LazyConnection, close_session, prepare=prepare_course_galleries,
+    prepare_lead=timedelta(minutes=15),
+    close_delay=timedelta(seconds=float(os.environ.get('ABSENCE_CLOSE_DELAY', 60))),
+    catchup_days=ABSENCE_CATCHUP_DAYS
+)
 
 # 手动触发定时任务（用于测试）
 @main.route('/api/attendance/run_check', methods=['POST'])
@@ -810,13 +1751,7 @@ def run_absence_check():
 @main.route('/api/attendance', methods=['GET'])
 def get_attendance():
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        # 增加排序缓冲区大小以避免"Out of sort memory"错误
-        cursor = conn.cursor()
-        cursor.execute("SET SESSION sort_buffer_size = 2097152")  # 设置为2MB
-        cursor.execute("SET SESSION read_rnd_buffer_size = 2097152")  # 设置为2MB
-        cursor.close()
-        
+        conn = db.get_connection()
         cursor = conn.cursor(dictionary=True)
         
         cursor.execute("""
@@ -853,34 +1788,23 @@ def get_attendance():
 @main.route('/api/debug/face_detection', methods=['POST'])
 def debug_face_detection():
     try:
-        data = request.get_json()
-        face_image = data.get('face_image')  # Base64格式的人脸图片
+        data, image_data = read_face_upload()  # 人脸图片：二进制上传或Base64
         
-        if not face_image:
+        if image_data is None:
             return jsonify({'success': False, 'message': '未提供人脸图片'})
         
-        # 移除Base64头部信息（如果有的话）
-        if face_image.startswith('data:image'):
-            face_image_data = face_image.split(',')[1]
-        else:
-            face_image_data = face_image
-        
-        # 解码Base64字符串
-        image_data = base64.b64decode(face_image_data)
-        
         # 调试：检查是否能检测到人脸
-        nparr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        frame = face_service.decode_frame(image_data)
         
         # 检查图像是否成功解码
-        if img is None:
+        if frame is None:
             return jsonify({'success': False, 'message': '无法解码图像数据'})
         
-        print(f"Image shape: {img.shape}")
+        logger.debug("Image shape: %s", frame.shape)
         
         # 检测人脸
-        faces = face_service.detect_faces(img)
-        print(f"Detected faces: {len(faces)}")
+        faces = face_service.detect_faces(frame)
+        logger.debug("Detected faces: %s", len(faces))
         
         face_details = []
         for i, (x, y, w, h) in enumerate(faces):
@@ -897,69 +1821,61 @@ def debug_face_detection():
             'message': f'检测到 {len(faces)} 张人脸',
             'face_count': len(faces),
             'faces': face_details,
-            'image_shape': img.shape
+            'image_shape': frame.shape
         })
     except Exception as e:
-        print(f"Error in debug_face_detection: {e}")
+        logger.exception("Error in debug_face_detection")
         return jsonify({'success': False, 'message': str(e)})
 
 # 调试接口：测试人脸添加过程
 @main.route('/api/debug/add_face', methods=['POST'])
 def debug_add_face():
+    if not model_ready():
+        return model_not_ready_response()
     try:
-        data = request.get_json()
+        data, image_data = read_face_upload()  # 人脸图片：二进制上传或Base64
         student_id = data.get('student_id')
-        face_image = data.get('face_image')  # Base64格式的人脸图片
         
-        if not face_image:
+        if image_data is None:
             return jsonify({'success': False, 'message': '未提供人脸图片'})
         
         if not student_id:
             return jsonify({'success': False, 'message': '未提供学生ID'})
         
-        # 移除Base64头部信息（如果有的话）
-        if face_image.startswith('data:image'):
-            face_image_data = face_image.split(',')[1]
-        else:
-            face_image_data = face_image
-        
-        # 解码Base64字符串
-        image_data = base64.b64decode(face_image_data)
-        print(f"Image data size: {len(image_data)} bytes")
+        logger.debug("Image data size: %s bytes", len(image_data))
         
         # 调试：检查是否能检测到人脸
-        nparr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        frame = face_service.decode_frame(image_data, reduced=False)
         
         # 检查图像是否成功解码
-        if img is None:
+        if frame is None:
             return jsonify({'success': False, 'message': '无法解码图像数据'})
         
-        print(f"Image shape: {img.shape}")
+        logger.debug("Image shape: %s", frame.shape)
         
         # 检测人脸
-        faces = face_service.detect_faces(img)
-        print(f"Detected faces: {len(faces)}")
+        faces = face_service.detect_faces(frame)
+        logger.debug("Detected faces: %s", len(faces))
         
         if len(faces) == 0:
             return jsonify({'success': False, 'message': '未检测到人脸，请确保人脸清晰可见'})
         
         # 提取人脸
-        face_roi = face_service.extract_face(img, faces[0])
-        print(f"Extracted face shape: {face_roi.shape}")
+        face_roi = face_service.extract_face(frame, faces[0])
+        logger.debug("Extracted face shape: %s", face_roi.shape)
         
-        # 添加人脸数据
-        face_added = face_service.add_face(image_data, student_id)
-        print(f"Face added: {face_added}")
+        # 添加人脸数据（直接使用已提取的人脸，不再重新解码检测）
+        face_added = face_service.add_face_roi(face_roi, student_id)
+        logger.debug("Face added: %s", face_added)
         
-        # 训练模型
+        # 增量更新模型
         if face_added:
-            trained = face_service.train_model()
-            print(f"Model trained: {trained}")
+            trained = face_service.update_model()
+            logger.debug("Model updated: %s", trained)
         
         # 序列化人脸数据
         serialized_face = face_service.serialize_face(face_roi)
-        print(f"Serialized face data length: {len(serialized_face) if serialized_face else 0}")
+        logger.debug("Serialized face data length: %s", len(serialized_face) if serialized_face else 0)
         
         return jsonify({
             'success': True,
@@ -970,76 +1886,68 @@ def debug_add_face():
             'serialized_data_length': len(serialized_face) if serialized_face else 0
         })
     except Exception as e:
-        print(f"Error in debug_add_face: {e}")
+        logger.exception("Error in debug_add_face")
         return jsonify({'success': False, 'message': str(e)})
 
 # 调试接口：完整测试人脸添加流程
 @main.route('/api/debug/full_add_face', methods=['POST'])
 def debug_full_add_face():
+    if not model_ready():
+        return model_not_ready_response()
     try:
-        data = request.get_json()
+        data, image_data = read_face_upload()  # 人脸图片：二进制上传或Base64
         student_id = data.get('student_id')
         name = data.get('name', 'Test Student')
         class_name = data.get('class_name', 'Test Class')
-        face_image = data.get('face_image')  # Base64格式的人脸图片
         
-        if not face_image:
+        if image_data is None:
             return jsonify({'success': False, 'message': '未提供人脸图片'})
         
         if not student_id:
             return jsonify({'success': False, 'message': '未提供学生ID'})
         
-        print(f"Full add face test for student: {student_id}")
-        
-        # 移除Base64头部信息（如果有的话）
-        if face_image.startswith('data:image'):
-            face_image_data = face_image.split(',')[1]
-        else:
-            face_image_data = face_image
+        logger.debug("Full add face test for student: %s", student_id)
         
-        # 解码Base64字符串
-        image_data = base64.b64decode(face_image_data)
-        print(f"Image data size: {len(image_data)} bytes")
+        logger.debug("Image data size: %s bytes", len(image_data))
         
         # 调试：检查是否能检测到人脸
-        nparr = np.frombuffer(image_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        frame = face_service.decode_frame(image_data, reduced=False)
         
         # 检查图像是否成功解码
-        if img is None:
+        if frame is None:
             return jsonify({'success': False, 'message': '无法解码图像数据'})
         
-        print(f"Image shape: {img.shape}")
+        logger.debug("Image shape: %s", frame.shape)
         
         # 检测人脸
-        faces = face_service.detect_faces(img)
-        print(f"Detected faces: {len(faces)}")
+        faces = face_service.detect_faces(frame)
+        logger.debug("Detected faces: %s", len(faces))
         
         if len(faces) == 0:
             return jsonify({'success': False, 'message': '未检测到人脸，请确保人脸清晰可见'})
         
         # 提取人脸
-        face_roi = face_service.extract_face(img, faces[0])
-        print(f"Extracted face shape: {face_roi.shape}")
+        face_roi = face_service.extract_face(frame, faces[0])
+        logger.debug("Extracted face shape: %s", face_roi.shape)
         
-        # 添加人脸数据
-        face_added = face_service.add_face(image_data, student_id)
-        print(f"Face added: {face_added}")
+        # 添加人脸数据（直接使用已提取的人脸，不再重新解码检测）
+        face_added = face_service.add_face_roi(face_roi, student_id)
+        logger.debug("Face added: %s", face_added)
         
         # 训练模型
         model_trained = False
         if face_added:
-            model_trained = face_service.train_model()
-            print(f"Model trained: {model_trained}")
+            model_trained = face_service.update_model()
+            logger.debug("Model trained: %s", model_trained)
         
         # 序列化人脸数据
         serialized_face = face_service.serialize_face(face_roi)
-        print(f"Serialized face data length: {len(serialized_face) if serialized_face else 0}")
+        logger.debug("Serialized face data length: %s", len(serialized_face) if serialized_face else 0)
         
         # 模拟数据库插入
-        print("Simulating database insert...")
+        logger.debug("Simulating database insert...")
         has_face_encoding = serialized_face is not None and len(serialized_face) > 0
-        print(f"Has face encoding: {has_face_encoding}")
+        logger.debug("Has face encoding: %s", has_face_encoding)
         
         return jsonify({
             'success': True,
@@ -1054,7 +1962,5 @@ def debug_full_add_face():
             'face_encoding_length': len(serialized_face) if serialized_face else 0
         })
     except Exception as e:
-        print(f"Error in debug_full_add_face: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in debug_full_add_face")
         return jsonify({'success': False, 'message': str(e)})
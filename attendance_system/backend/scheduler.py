@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from backend.timetable import WEEKDAY_NAMES
+
+logger = logging.getLogger(__name__)
+
+
+class CourseScheduler:
+    """
+    按课程表触发的定时任务：每门课程开始前prepare_lead准备子人脸库，结束后close_delay关闭课程（补齐缺勤）。
+    所有课程的下一次事件放在一个按时间排序的堆里，线程一直睡到最早的事件，不再每分钟轮询；
+    醒来晚了（例如系统休眠）到期的事件仍然会执行。课程变化后立即重新计算计划。
+    启动时补做之前catchup_days天内错过的关闭；关闭是否已执行记录在数据库中，多个进程同时运行也只执行一次
+    """
+
+    def __init__(self, timetable, connect, close_session, prepare=None,
+                 prepare_lead: timedelta = timedelta(minutes=15), close_delay: timedelta = timedelta(minutes=1),
+                 catchup_days: int = 1, max_wait: float = 300, retry_interval: float = 30):
+        """
+        :param timetable: 课程表索引（TimetableIndex）
+        :param connect: 返回数据库连接的函数，用于加载课程表
+        :param close_session: close_session(course, session_date)，关闭一次课程
+        :param prepare: prepare()，为即将开始的课程准备子人脸库
+        :param prepare_lead: 课程开始前多久准备子人脸库
+        :param close_delay: 课程结束后多久关闭，留出写入延迟写入日志中签到的时间
+        :param catchup_days: 启动时补做之前多少天内错过的关闭
+        :param max_wait: 最长睡眠时间（秒），到时重新加载过期的课程表
+        :param retry_interval: 关闭失败（例如数据库不可用）后重试的间隔（秒）
+        """
+        self.timetable = timetable
+        self.connect = connect
+        self.close_session = close_session
+        self.prepare = prepare
+        self.prepare_lead = prepare_lead
+        self.close_delay = close_delay
+        self.catchup_days = catchup_days
+        self.max_wait = max_wait
+        self.retry_interval = retry_interval
+        self._wakeup = threading.Condition()
+        self._changed = False
+        self._started = False
+        self._sequence = itertools.count()  # 同一时间的事件按加入顺序执行
+
+    def start(self):
+        """启动调度线程（只启动一次）"""
+        with self._wakeup:
+            if self._started:
+                return
+            self._started = True
+        self.timetable.course_listeners.append(self.reschedule)
+        threading.Thread(target=self._run, name='course-scheduler', daemon=True).start()
+
+    def reschedule(self):
+        """课程变化后调用，调度线程立即重新计算计划"""
+        with self._wakeup:
+            self._changed = True
+            self._wakeup.notify()
+
+    @staticmethod
+    def _next_time(weekday: str, at, after: datetime) -> datetime:
+        """课程在after之后（不包括after）下一次到达at时刻的时间"""
+        day = after.date() + timedelta(days=(WEEKDAY_NAMES.index(weekday) - after.weekday()) % 7)
+        run_at = datetime.combine(day, at)
+        return run_at if run_at > after else run_at + timedelta(days=7)
+
+    def _plan(self, after: datetime) -> list:
+        """
+        每门课程在after之后的下一次准备和关闭事件
+        :return: 堆，元素为(执行时间, 序号, 类型, 课程, 上课时间)
+        """
+        heap = []
+        for course in self.timetable.courses():
+            end = self._next_time(course['weekday'], course['course_time_end'], after - self.close_delay)
+            heap.append((end + self.close_delay, next(self._sequence), 'close', course, end))
+            if self.prepare is not None:
+                start = self._next_time(course['weekday'], course['course_time_start'], after + self.prepare_lead)
+                heap.append((start - self.prepare_lead, next(self._sequence), 'prepare', course, start))
+        heapq.heapify(heap)
+        return heap
+
+    def _run(self):
+        # 已处理到的时间：启动时从catchup_days天前开始，补做错过的关闭
+        processed = datetime.now() - timedelta(days=self.catchup_days)
+        while True:
+            timeout = self.max_wait
+            try:
+                conn = self.connect()
+                try:
+                    self.timetable.ensure_loaded(conn)
+                finally:
+                    conn.close()
+                heap = self._plan(processed)
+                now = datetime.now()
+                while heap and heap[0][0] <= now:
+                    run_at, _, kind, course, session_at = heapq.heappop(heap)
+                    if kind == 'close':
+                        self.close_session(course, session_at.date())
+                    elif session_at > now:
+                        # 补做时只准备还没有开始的课程
+                        self.prepare()
+                    # 同一时刻可能还有没执行的事件，失败重试时从这一时刻重新开始（关闭和准备都可以重复执行）
+                    processed = run_at - timedelta(microseconds=1)
+                    heapq.heappush(heap, (run_at + timedelta(days=7), next(self._sequence), kind, course,
+                                          session_at + timedelta(days=7)))
+                processed = now
+                if heap:
+                    timeout = min(self.max_wait, (heap[0][0] - now).total_seconds())
+            except Exception as e:
+                # processed停在最后一个成功的事件，重试时从失败的事件继续
+                logger.warning("Course scheduler failed, retrying in %ss: %s", self.retry_interval, e)
+                timeout = self.retry_interval
+            with self._wakeup:
+                if not self._changed:
+                    self._wakeup.wait(max(timeout, 0))
+                self._changed = False
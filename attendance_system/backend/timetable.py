@@ -0,0 +1,264 @@
+import bisect
+import threading
+import time
+from datetime import datetime, timedelta
+
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def parse_course_time(value):
+    """把数据库返回的课程时间（time、timedelta或字符串）转换为time"""
+    if isinstance(value, timedelta):
+        return (datetime.min + value).time()
+    if isinstance(value, str):
+        return datetime.strptime(value, '%H:%M:%S').time()
+    return value
+
+
+def _seconds(value) -> int:
+    """一天中的秒数，用于比较课程时间"""
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+class _WeekdayTimetable:
+    """一天的课程，按开始时间排序"""
+
+    def __init__(self, courses):
+        self.courses = sorted(courses, key=lambda c: (c['start'], c['course_id']))
+        self.starts = [c['start'] for c in self.courses]
+        # 最长的课程时长：开始时间早于 t - longest 的课程不可能在t时还在进行
+        self.longest = max((c['end'] - c['start'] for c in self.courses), default=0)
+
+    def overlapping(self, begin: int, end: int) -> list:
+        """与[begin, end]时间段有重叠的课程，按开始时间排序"""
+        found = []
+        for index in range(bisect.bisect_right(self.starts, end) - 1, -1, -1):
+            course = self.courses[index]
+            if course['start'] < begin - self.longest:
+                break
+            if course['end'] >= begin:
+                found.append(course)
+        found.reverse()
+        return found
+
+
+class TimetableIndex:
+    """
+    内存中的课程表索引：每个星期几的课程按开始时间排序，另有每门课程的选课名单和每名学生的已选课程。
+    "某时刻正在进行的课程"是一次二分查找，"学生现在在上哪门课"再加一次集合查找，都不查询数据库。
+    第一次使用时从数据库整体加载，课程和选课的写接口直接修改索引；
+    超过max_age秒后重新加载，其他进程或直接修改数据库的变化也会生效
+    """
+
+    def __init__(self, max_age: float = 300):
+        """
+        :param max_age: 整体重新加载的间隔（秒），0表示只在invalidate()后重新加载
+        """
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._version = 0  # 每次修改加1，加载期间发生修改时重新加载
+        self._loaded_at = None
+        self._courses = {}  # 课程ID -> 课程
+        self._weekdays = {}  # 星期 -> _WeekdayTimetable
+        self._rosters = {}  # 课程ID -> frozenset(学生ID)
+        self._enrollments = {}  # 学生ID -> set(课程ID)
+        self.course_listeners = []  # 课程（时间）变化后调用的函数，例如定时任务重新计算计划
+
+    # ---------- 加载 ----------
+
+    def ensure_loaded(self, conn):
+        """
+        索引尚未加载、已过期或已失效时从数据库加载
+        :param conn: 数据库连接（可以是LazyConnection，不需要加载时不会建立连接）
+        """
+        while True:
+            with self._lock:
+                if self._loaded_at is not None and (
+                        not self.max_age or time.monotonic() - self._loaded_at < self.max_age):
+                    return
+                version = self._version
+            courses, enrollments = self._query(conn)
+            with self._lock:
+                # 查询期间有写接口修改了索引时，查询结果可能不包括这次修改，重新查询
+                built = self._version == version
+                if built:
+                    self._build(courses, enrollments)
+            if built:
+                self._courses_changed()
+                return
+
+    @staticmethod
+    def _query(conn):
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT id, course_name, course_time_start, course_time_end, weekday FROM courses")
+        courses = cursor.fetchall()
+        cursor.close()
+        cursor = conn.cursor()
+        cursor.execute("SELECT student_id, course_id FROM student_courses")
+        enrollments = cursor.fetchall()
+        cursor.close()
+        return courses, enrollments
+
+    def _build(self, courses, enrollments):
+        self._courses = {}
+        for row in courses:
+            course = self._course(row)
+            self._courses[course['course_id']] = course
+        rosters = {course_id: set() for course_id in self._courses}
+        self._enrollments = {}
+        for student_id, course_id in enrollments:
+            if course_id in rosters:
+                rosters[course_id].add(student_id)
+                self._enrollments.setdefault(student_id, set()).add(course_id)
+        self._rosters = {course_id: frozenset(ids) for course_id, ids in rosters.items()}
+        self._weekdays = {}
+        for weekday in {course['weekday'] for course in self._courses.values()}:
+            self._reindex(weekday)
+        self._loaded_at = time.monotonic()
+        self._version += 1
+
+    @staticmethod
+    def _course(row) -> dict:
+        start = parse_course_time(row['course_time_start'])
+        end = parse_course_time(row['course_time_end'])
+        return {
+            'course_id': row['id'],
+            'course_name': row['course_name'],
+            'course_time_start': start,
+            'course_time_end': end,
+            'weekday': row['weekday'],
+            'start': _seconds(start),
+            'end': _seconds(end),
+        }
+
+    def _reindex(self, weekday):
+        courses = [course for course in self._courses.values() if course['weekday'] == weekday]
+        if courses:
+            self._weekdays[weekday] = _WeekdayTimetable(courses)
+        else:
+            self._weekdays.pop(weekday, None)
+
+    def _courses_changed(self):
+        for listener in self.course_listeners:
+            listener()
+
+    def invalidate(self):
+        """下次使用时从数据库重新加载"""
+        with self._lock:
+            self._loaded_at = None
+            self._version += 1
+
+    # ---------- 查询 ----------
+
+    @staticmethod
+    def _public(course) -> dict:
+        return {
+            'course_id': course['course_id'],
+            'course_name': course['course_name'],
+            'course_time_start': course['course_time_start'],
+            'course_time_end': course['course_time_end'],
+        }
+
+    def _overlapping(self, now, until=None) -> list:
+        timetable = self._weekdays.get(WEEKDAY_NAMES[now.weekday()])
+        if timetable is None:
+            return []
+        begin = _seconds(now.time())
+        return timetable.overlapping(begin, _seconds(until.time()) if until else begin)
+
+    def active_courses(self, now, course_id=None, until=None) -> list:
+        """
+        正在进行的课程，指定course_id时只返回该课程（不检查时间）
+        :param now: 当前时间
+        :param course_id: 考勤终端指定的课程
+        :param until: 给出时返回在now和until之间任意时刻进行的课程（同一天）
+        :return: 课程列表（course_id、course_name、course_time_start、course_time_end）
+        """
+        with self._lock:
+            if course_id:
+                course = self._courses.get(int(course_id))
+                return [self._public(course)] if course else []
+            return [self._public(course) for course in self._overlapping(now, until)]
+
+    def courses(self) -> list:
+        """全部课程（course_id、course_name、course_time_start、course_time_end、weekday）"""
+        with self._lock:
+            return [dict(self._public(course), weekday=course['weekday']) for course in self._courses.values()]
+
+    def student_course(self, student_id, now, course_id=None):
+        """
+        学生现在正在上的课程
+        :return: 课程，学生当前没有课时返回None
+        """
+        with self._lock:
+            enrolled = self._enrollments.get(student_id)
+            if not enrolled:
+                return None
+            if course_id:
+                course = self._courses.get(int(course_id))
+                candidates = [course] if course else []
+            else:
+                candidates = self._overlapping(now)
+            for course in candidates:
+                if course['course_id'] in enrolled:
+                    return self._public(course)
+        return None
+
+    def rosters(self, course_ids) -> dict:
+        """
+        课程的选课学生名单
+        :return: 课程ID -> frozenset(学生ID)
+        """
+        with self._lock:
+            return {course_id: self._rosters.get(course_id, frozenset()) for course_id in course_ids}
+
+    # ---------- 写接口调用的修改 ----------
+
+    def add_course(self, row):
+        """
+        添加或更新一门课程
+        :param row: courses表的一行（id、course_name、course_time_start、course_time_end、weekday）
+        """
+        course = self._course(row)
+        with self._lock:
+            previous = self._courses.get(course['course_id'])
+            self._courses[course['course_id']] = course
+            self._rosters.setdefault(course['course_id'], frozenset())
+            if previous and previous['weekday'] != course['weekday']:
+                self._reindex(previous['weekday'])
+            self._reindex(course['weekday'])
+            self._version += 1
+        self._courses_changed()
+
+    def remove_course(self, course_id):
+        """删除课程及其选课关系"""
+        course_id = int(course_id)
+        with self._lock:
+            course = self._courses.pop(course_id, None)
+            for student_id in self._rosters.pop(course_id, frozenset()):
+                self._enrollments.get(student_id, set()).discard(course_id)
+            if course:
+                self._reindex(course['weekday'])
+            self._version += 1
+        self._courses_changed()
+
+    def enroll(self, student_id, course_id):
+        course_id = int(course_id)
+        with self._lock:
+            self._rosters[course_id] = self._rosters.get(course_id, frozenset()) | {student_id}
+            self._enrollments.setdefault(student_id, set()).add(course_id)
+            self._version += 1
+
+    def unenroll(self, student_id, course_id):
+        course_id = int(course_id)
+        with self._lock:
+            self._rosters[course_id] = self._rosters.get(course_id, frozenset()) - {student_id}
+            self._enrollments.get(student_id, set()).discard(course_id)
+            self._version += 1
+
+    def remove_student(self, student_id):
+        """删除学生的全部选课关系"""
+        with self._lock:
+            for course_id in self._enrollments.pop(student_id, set()):
+                self._rosters[course_id] = self._rosters.get(course_id, frozenset()) - {student_id}
+            self._version += 1
@@ -0,0 +1,256 @@
+"""
+人脸识别服务的性能基准：测量各项操作随人脸库规模（注册学生数）的变化。
+人脸样本在本地合成，不需要下载数据集；结果输出为JSON，可以与之前的结果比较。
+
+用法（在attendance_system目录下运行）：
+    python -m benchmarks.face_service_bench --sizes 100,1000,5000 --output bench.json
+    python -m benchmarks.face_service_bench --baseline bench.json
+
+opencv后端每个样本的LBP直方图约64KB，训练时还要同时保存备用识别器，
+20000名学生需要数GB内存，按需在--sizes中加入
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from models.face_recognition_service import (
+    MATCH_THRESHOLD, FaceRecognitionService, RECOGNIZER_FILES, decode_face_samples, encode_face_samples
+)
+
+FACE_SIZE = 100
+
+
+class SyntheticFaces:
+    """
+    合成人脸样本：所有学生共享一个人脸轮廓（脸型、眼睛、嘴），叠加每个学生固定的平滑纹理；
+    同一学生的不同样本和识别探针只在噪声、亮度和轻微平移上不同
+    """
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        template = np.full((FACE_SIZE, FACE_SIZE), 90, dtype=np.float32)
+        cv2.ellipse(template, (50, 52), (34, 44), 0, 0, 360, 170, -1)
+        for eye_x in (36, 64):
+            cv2.ellipse(template, (eye_x, 42), (8, 4), 0, 0, 360, 60, -1)
+        cv2.line(template, (50, 46), (47, 62), 120, 2)
+        cv2.ellipse(template, (50, 74), (12, 4), 0, 0, 360, 80, -1)
+        self.template = cv2.GaussianBlur(template, (0, 0), 2)
+
+    def identity(self, index: int) -> np.ndarray:
+        """第index个学生的基础人脸"""
+        rng = np.random.default_rng((self.seed, index))
+        texture = cv2.GaussianBlur(rng.normal(0, 50, (FACE_SIZE, FACE_SIZE)).astype(np.float32), (0, 0), 1.5)
+        return self.template + texture
+
+    def sample(self, index: int, variant: int) -> np.ndarray:
+        """第index个学生的第variant个样本（variant不同则噪声和平移不同）"""
+        rng = np.random.default_rng((self.seed, index, variant + 1))
+        face = self.identity(index)
+        dx, dy = rng.integers(-1, 2, 2)
+        face = np.roll(face, (int(dy), int(dx)), axis=(0, 1))
+        face = face * rng.uniform(0.9, 1.1) + rng.normal(0, 4, face.shape)
+        return np.clip(face, 0, 255).astype(np.uint8)
+
+    def frame(self, width: int = 640, height: int = 480, face_index: int = 0) -> bytes:
+        """把一张合成人脸放大贴到背景上，编码为JPEG，用于测量解码和检测"""
+        rng = np.random.default_rng((self.seed, 0, 0, 1))
+        background = cv2.GaussianBlur(rng.integers(0, 256, (height, width), dtype=np.uint8), (0, 0), 8)
+        face = cv2.resize(self.sample(face_index, 0), (height // 2, height // 2))
+        y, x = height // 4, (width - height // 2) // 2
+        background[y:y + face.shape[0], x:x + face.shape[1]] = face
+        return cv2.imencode('.jpg', background)[1].tobytes()
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _latency(samples: list) -> dict:
+    """单次操作耗时的统计（秒）"""
+    ordered = sorted(samples)
+    return {
+        'mean': statistics.fmean(ordered),
+        'p50': ordered[len(ordered) // 2],
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+    }
+
+
+def _new_service(matcher: str) -> FaceRecognitionService:
+    service = FaceRecognitionService(matcher=matcher)
+    service.coalesce_delay = 0  # 基准测试不需要合并连续注册
+    return service
+
+
+def run_size(faces: SyntheticFaces, matcher: str, size: int, samples_per_student: int,
+             probes: int, enrollments: int, frame: bytes, course_size: int = 50) -> dict:
+    """在size名学生的人脸库上测量各项操作"""
+    student_ids = [f'S{i:06d}' for i in range(size)]
+    blobs = [encode_face_samples(np.stack([faces.sample(i, v) for v in range(samples_per_student)]))
+             for i in range(size)]
+    probe_indices = np.random.default_rng((faces.seed, size)).integers(0, size, probes)
+    probe_rois = [faces.sample(int(i), samples_per_student + 1) for i in probe_indices]
+    timings = {}
+
+    # 序列化：编码和解码全部学生的人脸数据
+    timings['serialize'], _ = _timed(
+        lambda: [encode_face_samples(decode_face_samples(blob)) for blob in blobs])
+    timings['deserialize'], _ = _timed(lambda: [decode_face_samples(blob) for blob in blobs])
+
+    # 启动加载：从数据库行恢复人脸数据并训练第一代模型
+    service = _new_service(matcher)
+    timings['startup_load'], _ = _timed(
+        lambda: [service.load_face_data(blob, student_id) for blob, student_id in zip(blobs, student_ids)])
+    timings['startup_train'], _ = _timed(service.train_model, wait=True)
+
+    # 完整重建（包括同步训练备用识别器）
+    timings['full_retrain'], _ = _timed(service.train_model, wait=True)
+
+    # 注册一名新学生直到新模型可用（增量训练）
+    enroll = []
+    for n in range(enrollments):
+        index = size + n
+        start = time.perf_counter()
+        service.add_face_roi(faces.sample(index, 0), f'N{index:06d}')
+        service.update_model(wait=True)
+        enroll.append(time.perf_counter() - start)
+    timings['enroll'] = _latency(enroll)
+
+    # 单张识别和批量识别
+    single = [_timed(service.predict_face, roi)[0] for roi in probe_rois]
+    timings['predict_single'] = _latency(single)
+    batch_seconds, matches = _timed(service.match_faces, probe_rois, 1)
+    timings['predict_batch'] = {'total': batch_seconds, 'per_face': batch_seconds / len(probe_rois)}
+
+    # 课程考勤：在前course_size名学生的子人脸库中逐张识别选课学生和未选课学生
+    roster = set(student_ids[:course_size])
+    gallery = service.course_gallery(1, roster)
+    enrolled_rois = [faces.sample(i, samples_per_student + 1) for i in range(min(course_size, size, probes))]
+    other_rois = [faces.sample(i, samples_per_student + 1) for i in range(course_size, min(size, course_size + probes))]
+    course = [_timed(service.match_faces, [roi], 1, [gallery]) for roi in enrolled_rois]
+    timings['predict_course'] = _latency([seconds for seconds, _ in course])
+    course_hits = sum(1 for i, (_, [candidates]) in enumerate(course)
+                      if candidates and candidates[0][0] == student_ids[i] and candidates[0][1] < MATCH_THRESHOLD)
+    false_accepts = 0
+    if other_rois:
+        others = [_timed(service.match_faces, [roi], 1, [gallery]) for roi in other_rois]
+        timings['predict_course_non_enrolled'] = _latency([seconds for seconds, _ in others])
+        false_accepts = sum(1 for _, [candidates] in others
+                            if candidates and candidates[0][0] in roster and candidates[0][1] < MATCH_THRESHOLD)
+
+    # 端到端识别（解码、检测、提取、识别）
+    recognize = [_timed(service.recognize_face, frame)[0] for _ in range(5)]
+    timings['recognize_face'] = _latency(recognize)
+
+    expected = [student_ids[i] for i in probe_indices]
+    hits = sum(1 for candidates, student_id in zip(matches, expected)
+               if candidates and candidates[0][0] == student_id)
+    return {
+        'matcher': matcher,
+        'gallery_size': size,
+        'samples_per_student': samples_per_student,
+        'probes': probes,
+        'top1_accuracy': hits / len(expected),
+        'course_accuracy': course_hits / len(enrolled_rois),
+        'course_false_accepts': false_accepts,
+        'timings': timings,
+    }
+
+
+def run_detection(frame: bytes, repeats: int = 10) -> dict:
+    """检测耗时与人脸库规模无关，只测一次"""
+    service = FaceRecognitionService()
+    decoded = service.decode_frame(frame)
+    decode = [_timed(service.decode_frame, frame)[0] for _ in range(repeats)]
+    detect = [_timed(service.detect_faces, service.decode_frame(frame))[0] for _ in range(repeats)]
+    return {'frame_shape': list(decoded.shape), 'decode': _latency(decode), 'detect_faces': _latency(detect)}
+
+
+def _flatten(timings: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in timings.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(report: dict, baseline: dict):
+    """按(后端, 人脸库规模)对齐两次结果，打印每项耗时的变化"""
+    previous = {(r['matcher'], r['gallery_size']): _flatten(r['timings']) for r in baseline['results']}
+    for result in report['results']:
+        old = previous.get((result['matcher'], result['gallery_size']))
+        if old is None:
+            continue
+        print(f"{result['matcher']} x {result['gallery_size']}:")
+        for key, value in _flatten(result['timings']).items():
+            if old.get(key):
+                print(f"  {key:28s} {old[key] * 1000:10.2f}ms -> {value * 1000:10.2f}ms ({value / old[key] - 1:+.1%})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FaceRecognitionService benchmark')
+    parser.add_argument('--sizes', default='100,1000,5000', help='人脸库规模（学生数），逗号分隔')
+    parser.add_argument('--matchers', default=','.join(RECOGNIZER_FILES), help='识别后端，逗号分隔')
+    parser.add_argument('--samples-per-student', type=int, default=1)
+    parser.add_argument('--probes', type=int, default=50, help='识别探针数量')
+    parser.add_argument('--enrollments', type=int, default=5, help='测量增量注册的次数')
+    parser.add_argument('--course-size', type=int, default=50, help='课程考勤测量中的选课学生数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--image', help='用于测量解码和检测的图片，默认使用合成图片')
+    parser.add_argument('--output', help='结果JSON文件，默认输出到标准输出')
+    parser.add_argument('--baseline', help='之前的结果JSON文件，打印与它的比较')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    faces = SyntheticFaces(args.seed)
+    if args.image:
+        with open(args.image, 'rb') as f:
+            frame = f.read()
+    else:
+        frame = faces.frame()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args),
+        },
+        'detection': run_detection(frame),
+        'results': [],
+    }
+    for matcher in args.matchers.split(','):
+        for size in (int(s) for s in args.sizes.split(',')):
+            print(f"Benchmarking {matcher} with {size} students...", file=sys.stderr)
+            report['results'].append(run_size(faces, matcher, size, args.samples_per_student,
+                                              args.probes, args.enrollments, frame, args.course_size))
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 // 全局变量
 let currentStream = null;
+let photoCaptured = false;  // 学生信息页面是否已经拍照
+let streamSessionId = null;  // 视频流自动签到会话
+const STREAM_FRAME_INTERVAL = 200;  // 自动签到时发送视频帧的间隔（毫秒）
 
 // 页面加载完成后初始化
 document.addEventListener('DOMContentLoaded', function() {
@@ -15,6 +18,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // 绑定识别按钮事件
     document.getElementById('recognize-btn').addEventListener('click', recognizeAttendance);
     
+    // 绑定自动签到按钮事件
+    document.getElementById('stream-btn').addEventListener('click', toggleAttendanceStream);
+    
     // 绑定课程表单提交事件
     document.getElementById('course-form').addEventListener('submit', addCourse);
     
@@ -104,18 +110,23 @@ function captureImage() {
     
     // 绘制当前视频帧到画布
     context.drawImage(video, 0, 0, canvas.width, canvas.height);
+    photoCaptured = true;
     
     // 显示消息
     showMessage('拍照成功', 'success', 'student-message');
 }
 
+// 把画布内容编码为JPEG二进制数据，直接上传比Base64的data URL小约三分之一
+function canvasToBlob(canvas) {
+    return new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg'));
+}
+
 // 调试人脸检测
 async function debugFaceDetection() {
     // 获取图片数据
     const canvas = document.getElementById('canvas');
-    const imageData = canvas.toDataURL('image/jpeg');
     
-    if (imageData === 'data:image/jpeg;base64,/9j/4AAQSkZJRgABAQEAYABgAAD/2wBDAAEBAQEBAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQH/2wBDAQEBAQEBAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQH/wAARCAAEAAQDASIAAhEBAxEB/8QAFQABAQAAAAAAAAAAAAAAAAAAAAr/xAAUEAEAAAAAAAAAAAAAAAAAAAAA/8QAFQEBAQAAAAAAAAAAAAAAAAAAAAX/xAAUEQEAAAAAAAAAAAAAAAAAAAAA/9oADAMBAAIRAxEAPwCdABmX/9k=') {
+    if (!photoCaptured) {
         showMessage('请先拍照', 'error', 'student-message');
         return;
     }
@@ -124,12 +135,7 @@ async function debugFaceDetection() {
     try {
         const response = await fetch('/api/debug/face_detection', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                face_image: imageData
-            })
+            body: await canvasToBlob(canvas)
         });
         
         const result = await response.json();
@@ -156,26 +162,23 @@ async function addStudent(event) {
     
     // 获取图片数据
     const canvas = document.getElementById('canvas');
-    const imageData = canvas.toDataURL('image/jpeg');
     
-    if (imageData === 'data:image/jpeg;base64,/9j/4AAQSkZJRgABAQEAYABgAAD/2wBDAAEBAQEBAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQH/2wBDAQEBAQEBAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQECAQH/wAARCAAEAAQDASIAAhEBAxEB/8QAFQABAQAAAAAAAAAAAAAAAAAAAAr/xAAUEAEAAAAAAAAAAAAAAAAAAAAA/8QAFQEBAQAAAAAAAAAAAAAAAAAAAAX/xAAUEQEAAAAAAAAAAAAAAAAAAAAA/9oADAMBAAIRAxEAPwCdABmX/9k=') {
+    if (!photoCaptured) {
         showMessage('请先拍照', 'error', 'student-message');
         return;
     }
     
-    // 发送数据到后端
+    // 发送数据到后端（multipart表单，人脸图片为二进制文件）
     try {
+        const formData = new FormData();
+        formData.append('student_id', studentId);
+        formData.append('name', name);
+        formData.append('class_name', className);
+        formData.append('face_image', await canvasToBlob(canvas), 'face.jpg');
+        
         const response = await fetch('/api/students', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                student_id: studentId,
-                name: name,
-                class_name: className,
-                face_image: imageData
-            })
+            body: formData
         });
         
         const result = await response.json();
@@ -498,9 +501,6 @@ async function recognizeAttendance() {
     // 绘制当前视频帧到画布
     context.drawImage(video, 0, 0, canvas.width, canvas.height);
     
-    // 获取图片数据
-    const imageData = canvas.toDataURL('image/jpeg');
-    
     // 显示正在识别消息
     showMessage('正在识别...', 'success', 'attendance-message');
     
@@ -508,12 +508,7 @@ async function recognizeAttendance() {
     try {
         const response = await fetch('/api/attendance/recognize', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                face_image: imageData
-            })
+            body: await canvasToBlob(canvas)
         });
         
         const result = await response.json();
@@ -536,6 +531,81 @@ async function recognizeAttendance() {
     }
 }
 
+// 开始或停止视频流自动签到
+async function toggleAttendanceStream() {
+    const button = document.getElementById('stream-btn');
+    
+    if (streamSessionId) {
+        const sessionId = streamSessionId;
+        streamSessionId = null;
+        button.textContent = '自动签到';
+        fetch(`/api/attendance/stream/${sessionId}`, { method: 'DELETE' });
+        showMessage('已停止自动签到', 'success', 'attendance-message');
+        return;
+    }
+    
+    try {
+        const response = await fetch('/api/attendance/stream', { method: 'POST' });
+        const result = await response.json();
+        
+        if (!result.success) {
+            showMessage('无法开始自动签到: ' + result.message, 'error', 'attendance-message');
+            return;
+        }
+        
+        streamSessionId = result.session_id;
+        button.textContent = '停止自动签到';
+        showMessage('自动签到中，请面对摄像头', 'success', 'attendance-message');
+        sendStreamFrame(result.session_id);
+    } catch (error) {
+        console.error('Error:', error);
+        showMessage('网络错误，请稍后再试', 'error', 'attendance-message');
+    }
+}
+
+// 发送一帧视频到自动签到会话，收到结果后再发送下一帧
+async function sendStreamFrame(sessionId) {
+    if (streamSessionId !== sessionId) {
+        return;
+    }
+    
+    const video = document.getElementById('attendance-video');
+    const canvas = document.getElementById('attendance-canvas');
+    canvas.getContext('2d').drawImage(video, 0, 0, canvas.width, canvas.height);
+    
+    try {
+        const response = await fetch(`/api/attendance/stream/${sessionId}`, {
+            method: 'POST',
+            body: await canvasToBlob(canvas)
+        });
+        const result = await response.json();
+        
+        if (response.status === 404) {
+            // 会话已过期
+            streamSessionId = null;
+            document.getElementById('stream-btn').textContent = '自动签到';
+            showMessage('自动签到已停止: ' + result.message, 'error', 'attendance-message');
+            return;
+        }
+        
+        if (result.success) {
+            result.records.forEach(record => {
+                showMessage(`${record.message}！学号：${record.student_id}，课程：${record.course_name}`,
+                    record.result === 'recorded' ? 'success' : 'error', 'attendance-message');
+            });
+            if (result.records.some(record => record.result === 'recorded')) {
+                loadAttendanceRecords();
+            }
+        } else {
+            showMessage(result.message, 'error', 'attendance-message');
+        }
+    } catch (error) {
+        console.error('Error:', error);
+    }
+    
+    setTimeout(() => sendStreamFrame(sessionId), STREAM_FRAME_INTERVAL);
+}
+
 // 测试人脸识别功能
 async function testRecognize() {
     const video = document.getElementById('attendance-video');
@@ -545,9 +615,6 @@ async function testRecognize() {
     // 绘制当前视频帧到画布
     context.drawImage(video, 0, 0, canvas.width, canvas.height);
     
-    // 获取图片数据
-    const imageData = canvas.toDataURL('image/jpeg');
-    
     // 显示正在识别消息
     showMessage('正在测试识别...', 'success', 'attendance-message');
     
@@ -555,12 +622,7 @@ async function testRecognize() {
     try {
         const response = await fetch('/api/test_recognize', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                face_image: imageData
-            })
+            body: await canvasToBlob(canvas)
         });
         
         const result = await response.json();
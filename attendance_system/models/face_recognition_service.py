@@ -1,70 +1,388 @@
 import cv2
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import Dict, Iterable, List, Tuple, Optional
 import base64
 import json
+import logging
+import os
+import shutil
+import struct
+import threading
+import time
+
+from models.label_registry import LabelRegistry
+from models.lbp_matcher import LBPHistogramMatcher, chi_square_distances, lbp_histograms
+from models.metrics import stage
+from models.quality_gate import QualityGate
+from models.result_cache import FingerprintCache, face_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# 模型快照格式版本，格式变化时递增，旧版本快照会被忽略并从数据库完整重建
+SNAPSHOT_VERSION = 2
+
+# 识别距离阈值，距离越小越相似
+MATCH_THRESHOLD = 100
+
+# 课程子人脸库中距离小于这个值的匹配直接采用；在它和MATCH_THRESHOLD之间的匹配再在完整模型中确认
+COURSE_MATCH_THRESHOLD = 70
+
+# numpy后端中已删除学生的残留样本超过模型样本数的这个比例时完整重建（opencv后端有残留就重建）
+MASKED_REBUILD_RATIO = 0.1
+
+# 识别结果缓存命中后，人脸与缓存中学生自己样本的距离最多比缓存时的距离大这么多，否则重新识别。
+# 指纹相同的不同学生与缓存学生样本的距离明显更大，同一学生的重复提交距离几乎不变
+CACHE_VERIFY_MARGIN = 1.0
+
+# 最多缓存的课程子人脸库数量
+MAX_COURSE_GALLERIES = 64
+
+# 可选的识别后端及其快照文件名：opencv为OpenCV的LBPH识别器，numpy为向量化的LBP直方图匹配器
+RECOGNIZER_FILES = {'opencv': 'recognizer.yml', 'numpy': 'recognizer.npz'}
+
+# 人脸样本二进制存储格式：魔数、版本、保留字节、样本数、高、宽，后面紧跟uint8原始像素
+FACE_DATA_MAGIC = b'FACE'
+FACE_DATA_VERSION = 1
+FACE_DATA_HEADER = struct.Struct('<4sBBHHH')
+
+
+def encode_face_samples(face_rois) -> bytes:
+    """
+    将一个或多个人脸样本编码为二进制格式
+    :param face_rois: 单个(h, w)人脸图像或(n, h, w)人脸图像数组
+    :return: 二进制人脸数据
+    """
+    samples = np.ascontiguousarray(face_rois, dtype=np.uint8)
+    if samples.ndim == 2:
+        samples = samples[np.newaxis]
+    count, height, width = samples.shape
+    header = FACE_DATA_HEADER.pack(FACE_DATA_MAGIC, FACE_DATA_VERSION, 0, count, height, width)
+    return header + samples.tobytes()
+
+
+def decode_face_samples(face_data) -> np.ndarray:
+    """
+    解码数据库中的人脸数据，同时支持二进制格式和旧的JSON格式
+    :param face_data: bytes/bytearray（二进制或迁移后的JSON）或str（JSON）
+    :return: (n, h, w)的人脸图像数组，二进制格式直接引用原缓冲区不做拷贝
+    """
+    if isinstance(face_data, (bytes, bytearray, memoryview)) and bytes(face_data[:4]) == FACE_DATA_MAGIC:
+        magic, version, _, count, height, width = FACE_DATA_HEADER.unpack_from(face_data)
+        if version != FACE_DATA_VERSION:
+            raise ValueError(f"Unsupported face data version: {version}")
+        samples = np.frombuffer(face_data, dtype=np.uint8, count=count * height * width,
+                                offset=FACE_DATA_HEADER.size)
+        return samples.reshape(count, height, width)
+    
+    # 旧格式：JSON整数列表
+    face_info = json.loads(face_data)
+    face_array = np.array(face_info['face'], dtype=np.uint8)
+    shape = face_info.get('shape', (100, 100))  # 默认形状
+    return face_array.reshape((-1,) + tuple(shape[-2:]))
+
+
+def is_legacy_face_data(face_data) -> bool:
+    """判断人脸数据是否为旧的JSON格式"""
+    if isinstance(face_data, str):
+        return True
+    return bytes(face_data[:4]) != FACE_DATA_MAGIC
+
+class Frame:
+    """
+    解码后的图像帧。检测、提取和识别共用同一个帧对象，
+    图像只解码一次，灰度图也只计算一次
+    """
+    
+    def __init__(self, image: np.ndarray, scale: int = 1):
+        self.image = image
+        self.scale = scale  # 原图像素与解码后像素的比例（缩小解码时大于1）
+        self._gray = image if image.ndim == 2 else None
+    
+    @property
+    def gray(self) -> np.ndarray:
+        """灰度图，首次访问时计算并缓存"""
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+    
+    @property
+    def shape(self):
+        return self.image.shape
+
+
+# 缩小解码倍数对应的OpenCV解码参数
+REDUCED_DECODE_FLAGS = {
+    2: (cv2.IMREAD_REDUCED_GRAYSCALE_2, cv2.IMREAD_REDUCED_COLOR_2),
+    4: (cv2.IMREAD_REDUCED_GRAYSCALE_4, cv2.IMREAD_REDUCED_COLOR_4),
+    8: (cv2.IMREAD_REDUCED_GRAYSCALE_8, cv2.IMREAD_REDUCED_COLOR_8),
+}
+
+
+def create_recognizer(matcher: str = 'opencv'):
+    """创建人脸识别器，opencv后端在没有opencv-contrib-python时返回None"""
+    if matcher == 'numpy':
+        return LBPHistogramMatcher()
+    try:
+        return cv2.face.LBPHFaceRecognizer_create()
+    except AttributeError:
+        return None
+
+
+class ModelGeneration:
+    """
+    一代识别模型。识别请求只读取当前代，训练线程构建好新一代后原子替换；
+    被替换的旧一代在所有读取结束后才会被训练线程复用，读取期间模型不会被修改
+    """
+    
+    def __init__(self, number: int, recognizer, labels: list, samples: list, ids: list):
+        self.number = number
+        self.recognizer = recognizer
+        self.labels = labels  # 标签到学号的数组，下标为标签，不参与识别的标签为None（只读）
+        self.samples = samples  # 模型中包含的样本（只读）
+        self.ids = ids  # 样本对应的标签（只读）
+        self._readers = 0
+        self._retired = False
+        self._cond = threading.Condition()
+    
+    def student_for(self, label: int) -> Optional[str]:
+        """标签对应的学号，未知标签返回None"""
+        if 0 <= label < len(self.labels):
+            return self.labels[label]
+        return None
+    
+    def acquire(self) -> bool:
+        """开始读取，已退役的一代返回False"""
+        with self._cond:
+            if self._retired:
+                return False
+            self._readers += 1
+            return True
+    
+    def release(self):
+        """结束读取"""
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+    
+    def retire(self):
+        """标记为退役并等待所有读取结束"""
+        with self._cond:
+            self._retired = True
+            while self._readers > 0:
+                self._cond.wait()
+
 
 class FaceRecognitionService:
-    def __init__(self):
-        # 使用OpenCV的Haar级联分类器进行人脸检测
-        self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-        # 使用LBPH人脸识别器
-        try:
-            self.recognizer = cv2.face.LBPHFaceRecognizer_create()
-        except AttributeError:
-            # 如果没有opencv-contrib-python，则使用简化版本
-            self.recognizer = None
+    def __init__(self, detection_width: int = 0, decode_reduction: int = 1,
+                 scale_factor: float = 1.1, min_neighbors: int = 5, min_face_size: int = 30,
+                 matcher: str = 'opencv', result_cache_ttl: float = 0, result_cache_size: int = 512,
+                 quality_gate: Optional[QualityGate] = None, class_quality_gate: Optional[QualityGate] = None,
+                 course_match_threshold: float = COURSE_MATCH_THRESHOLD):
+        """
+        :param detection_width: 检测时把图像缩小到的最大宽度，0表示按原分辨率检测
+        :param decode_reduction: 缩小解码倍数（1、2、4、8），在JPEG解码阶段直接降低分辨率
+        :param scale_factor: Haar检测的图像金字塔缩放比例，越大越快但漏检越多
+        :param min_neighbors: Haar检测的最小邻居数
+        :param min_face_size: 最小人脸尺寸（原图像素）
+        :param matcher: 识别后端，opencv或numpy（两者结果一致，numpy支持批量识别和前k个候选）
+        :param result_cache_ttl: 识别结果缓存时间（秒），同一张人脸在这段时间内重复提交时直接返回缓存结果，0表示不缓存
+        :param result_cache_size: 识别结果缓存的最大条目数
+        :param quality_gate: 识别前的图像质量检查，为None时不检查（注册学生时不检查）
+        :param class_quality_gate: 课堂合照（识别所有人脸）使用的质量检查，合照中的人脸通常更小，为None时不检查
+        :param course_match_threshold: 课程子人脸库中直接采用的匹配距离，超过它的匹配在完整模型中确认；
+            设为MATCH_THRESHOLD时从不确认，设为0时总是确认
+        """
+        if matcher not in RECOGNIZER_FILES:
+            raise ValueError(f"matcher must be one of {', '.join(RECOGNIZER_FILES)}, got {matcher}")
+        if decode_reduction not in (1, 2, 4, 8):
+            raise ValueError(f"decode_reduction must be 1, 2, 4 or 8, got {decode_reduction}")
+        self.detection_width = detection_width
+        self.decode_reduction = decode_reduction
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_face_size = min_face_size
+        self.matcher = matcher
+        self.quality_gate = quality_gate
+        self.class_quality_gate = class_quality_gate
+        self.course_match_threshold = course_match_threshold
+        # Haar级联分类器不保证线程安全，每个线程使用自己的实例
+        self._local = threading.local()
+        # 使用LBPH人脸识别器（opencv后端没有opencv-contrib-python时不可用）
+        self.recognizer_available = create_recognizer(matcher) is not None
         self.known_faces = {}  # 存储已知人脸特征和对应的学号
+        self.registry = LabelRegistry()  # 学号与稠密标签的映射，随快照保存，重启和工作进程间保持一致
         self.face_samples = []  # 存储人脸样本
         self.ids = []  # 存储对应的标签
-        self.trained = False
+        self.pending_samples = []  # 尚未加入模型的人脸样本（增量训练用）
+        self.pending_ids = []  # 尚未加入模型的样本标签
+        self.stale_samples = 0  # 已删除学生仍残留在模型中的样本数，完整重建后清零
+        self.removed_labels = set()  # 已删除但可能仍在当前模型中的标签
+        self._masked_counts = {}  # 已删除学生的标签 -> 仍在当前模型中的样本数，完整重建后清空
+        
+        # 当前模型代，识别只读取它；由后台训练线程原子替换
+        self.generation = None
+        # 保护上面的样本和标签状态
+        self._lock = threading.RLock()
+        self._train_cond = threading.Condition(self._lock)
+        self._queued_version = 0  # 已提交的训练请求序号
+        self._applied_version = 0  # 已完成的训练请求序号
+        self._rebuild_requested = False
+        self._trainer = None
+        # 合并短时间内连续注册的等待时间（秒）
+        self.coalesce_delay = 0.2
+        # 备用识别器：只由训练线程使用，比当前代落后 _standby_lag 中的批次
+        self._standby = None
+        self._standby_lag = []
+        # 新一代模型替换后的回调（在训练线程中调用，需要尽快返回）
+        self.generation_listeners = []
+        # 最近一次保存或加载的快照名称及其对应的模型代
+        self.snapshot_version = None
+        self.snapshot_generation = 0
+        # 影响识别结果的修改次数（新一代模型、删除学生），快照对应的修改次数，两者相同时快照与当前模型一致
+        self.changes = 0
+        self.snapshot_changes = 0
+        # 课程子人脸库缓存：课程ID -> (学生名单, 构建时的模型代, 子人脸库)
+        self._galleries = {}
+        # 识别结果缓存：(范围, 人脸指纹) -> (候选结果, 学生样本的直方图)，模型或名单变化时清空
+        self.result_cache = FingerprintCache(result_cache_size, result_cache_ttl) if result_cache_ttl > 0 else None
+        self._result_epoch = 0  # 每次清空缓存时递增，清空前开始的识别不会再写入缓存
+    
+    @property
+    def face_cascade(self):
+        """当前线程的Haar级联分类器"""
+        cascade = getattr(self._local, 'face_cascade', None)
+        if cascade is None:
+            cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+            self._local.face_cascade = cascade
+        return cascade
+    
+    @property
+    def trained(self) -> bool:
+        return self.generation is not None
+    
+    @property
+    def snapshot_current(self) -> bool:
+        """最近保存或加载的快照是否与当前模型一致（之后没有注册或删除学生）"""
+        return self.snapshot_version is not None and self.snapshot_changes == self.changes
+    
+    def _label_for(self, student_id: str) -> int:
+        """
+        获取学生对应的标签，已有标签的学生沿用原标签
+        :param student_id: 学生ID
+        :return: 标签
+        """
+        return self.registry.label_for(student_id)
+    
+    def _label_table(self, roster=None) -> list:
+        """
+        当前已知人脸的标签数组（调用方持有锁）
+        :param roster: 只保留这些学生，为None时保留全部已知人脸
+        :return: 下标为标签的学号数组，已删除或不在名单中的标签为None
+        """
+        return [student_id if label in self.known_faces and (roster is None or student_id in roster) else None
+                for label, student_id in enumerate(self.registry.to_list())]
+    
+    def reset(self):
+        """
+        清空人脸库，用于从数据库完整重新加载。标签映射保持不变，
+        当前模型代继续提供识别，直到重新训练的新一代替换它
+        """
+        with self._lock:
+            self.known_faces = {}
+            self.face_samples = []
+            self.ids = []
+            self.pending_samples = []
+            self.pending_ids = []
+    
+    def decode_frame(self, image_data, grayscale: bool = True, reduced: bool = True) -> Optional[Frame]:
+        """
+        解码图片数据为帧对象
+        :param image_data: 图片数据（bytes或numpy缓冲区）
+        :param grayscale: 是否直接解码为灰度图，识别流程只需要灰度图，可以省去颜色转换
+        :param reduced: 是否按配置的倍数缩小解码
+        :return: 帧对象，解码失败返回None
+        """
+        nparr = np.frombuffer(image_data, np.uint8)
+        scale = self.decode_reduction if reduced else 1
+        with stage('decode'):
+            if scale > 1:
+                gray_flag, color_flag = REDUCED_DECODE_FLAGS[scale]
+                img = cv2.imdecode(nparr, gray_flag if grayscale else color_flag)
+            else:
+                img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+        if img is None:
+            logger.warning("Failed to decode image")
+            return None
+        return Frame(img, scale)
+    
+    @staticmethod
+    def _gray_of(image) -> np.ndarray:
+        """获取帧对象或numpy图像的灰度图"""
+        if isinstance(image, Frame):
+            return image.gray
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
     
     def detect_faces(self, image) -> List[Tuple[int, int, int, int]]:
         """
-        检测图像中的人脸
-        :param image: 输入图像
-        :return: 人脸边界框列表 (x, y, w, h)
+        检测图像中的人脸。配置了detection_width时在缩小后的图像上检测，
+        再把边界框映射回原图坐标
+        :param image: 帧对象或numpy图像
+        :return: 人脸边界框列表 (x, y, w, h)，均为原图坐标
         """
         try:
             # 检查图像
             if image is None:
-                print("Error: Image is None")
+                logger.warning("detect_faces called without an image")
                 return []
             
-            print(f"Image shape: {image.shape if hasattr(image, 'shape') else 'Unknown'}")
-            print(f"Image dtype: {image.dtype if hasattr(image, 'dtype') else 'Unknown'}")
+            logger.debug("Image shape: %s", getattr(image, 'shape', 'Unknown'))
             
-            # 转换为灰度图
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image
+            # 获取灰度图（帧对象只计算一次）
+            gray = self._gray_of(image)
             
-            print(f"Gray image shape: {gray.shape}")
+            # 原图像素与检测图像像素的比例
+            scale = image.scale if isinstance(image, Frame) else 1
+            height, width = gray.shape[:2]
+            if self.detection_width and width > self.detection_width:
+                ratio = self.detection_width / width
+                gray = cv2.resize(gray, (self.detection_width, max(1, int(round(height * ratio)))),
+                                  interpolation=cv2.INTER_AREA)
+                scale = scale / ratio
             
-            # 检测人脸
-            faces = self.face_cascade.detectMultiScale(
-                gray,
-                scaleFactor=1.1,
-                minNeighbors=5,
-                minSize=(30, 30)
-            )
-            
-            print(f"Detected {len(faces)} faces")
+            # 检测人脸，最小尺寸按检测图像的缩放换算
+            min_size = max(1, int(self.min_face_size / scale))
+            with stage('detect'):
+                faces = self.face_cascade.detectMultiScale(
+                    gray,
+                    scaleFactor=self.scale_factor,
+                    minNeighbors=self.min_neighbors,
+                    minSize=(min_size, min_size)
+                )
+            
+            # 映射回原图坐标
+            if scale != 1 and len(faces) > 0:
+                faces = np.round(np.asarray(faces) * scale).astype(int)
+            
+            logger.debug("Detected %d faces", len(faces))
             return faces
-        except Exception as e:
-            print(f"Error in detect_faces: {e}")
+        except Exception:
+            logger.exception("Error in detect_faces")
             return []
     
     def extract_face(self, image, face_coords) -> np.ndarray:
         """
         从图像中提取人脸区域
-        :param image: 输入图像
-        :param face_coords: 人脸坐标 (x, y, w, h)
+        :param image: 帧对象或numpy图像
+        :param face_coords: 人脸坐标 (x, y, w, h)，原图坐标
         :return: 人脸区域图像
         """
         (x, y, w, h) = face_coords
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+        gray = self._gray_of(image)
+        # 缩小解码的帧需要把原图坐标换算到帧坐标
+        scale = image.scale if isinstance(image, Frame) else 1
+        if scale != 1:
+            x, y, w, h = (int(v / scale) for v in (x, y, w, h))
         face_roi = gray[y:y+h, x:x+w]
         # 调整尺寸以统一处理
         face_roi = cv2.resize(face_roi, (100, 100))
@@ -84,23 +402,39 @@ class FaceRecognitionService:
             # 解码Base64字符串
             image_data = base64.b64decode(base64_image)
             
-            # 转换为numpy数组
-            nparr = np.frombuffer(image_data, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            frame = self.decode_frame(image_data)
+            if frame is None:
+                return None
             
             # 检测人脸
-            faces = self.detect_faces(img)
+            faces = self.detect_faces(frame)
             
             if len(faces) > 0:
                 # 取第一张人脸
-                face_roi = self.extract_face(img, faces[0])
+                face_roi = self.extract_face(frame, faces[0])
                 return face_roi
             
             return None
-        except Exception as e:
-            print(f"Error extracting face from base64: {e}")
+        except Exception:
+            logger.exception("Error extracting face from base64")
             return None
     
+    def extract_enrollment_face(self, image_data: bytes) -> Tuple[Optional[np.ndarray], int]:
+        """
+        从注册照片中提取人脸样本：全分辨率解码并检测，照片中有多张人脸时取最大的一张。
+        只使用线程各自的检测器，可以在多个线程中并行调用
+        :param image_data: 图片数据
+        :return: (人脸区域图像, 检测到的人脸数)，解码失败时人脸数为-1
+        """
+        frame = self.decode_frame(image_data, reduced=False)
+        if frame is None:
+            return None, -1
+        faces = self.detect_faces(frame)
+        if len(faces) == 0:
+            return None, 0
+        largest = max(faces, key=lambda face: face[2] * face[3])
+        return self.extract_face(frame, largest), len(faces)
+    
     def add_face(self, image_data: bytes, student_id: str) -> bool:
         """
         添加学生人脸数据到已知人脸库
@@ -109,62 +443,263 @@ class FaceRecognitionService:
         :return: 是否添加成功
         """
         try:
-            print(f"Adding face for student: {student_id}")
+            logger.debug("Adding face for student: %s", student_id)
             
-            # 将字节数据转换为numpy数组
-            nparr = np.frombuffer(image_data, np.uint8)
-            print(f"Numpy array shape: {nparr.shape}")
-            
-            # 解码图像
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            # 解码图像（注册样本使用全分辨率，保证样本质量）
+            frame = self.decode_frame(image_data, reduced=False)
             
             # 检查图像是否成功解码
-            if img is None:
-                print("Error: Failed to decode image")
+            if frame is None:
                 return False
             
-            print(f"Decoded image shape: {img.shape}")
+            logger.debug("Decoded image shape: %s", frame.shape)
             
             # 检测人脸
-            faces = self.detect_faces(img)
+            faces = self.detect_faces(frame)
             
             if len(faces) > 0:
-                print(f"Found {len(faces)} faces, using the first one")
+                logger.debug("Found %d faces, using the first one", len(faces))
                 # 取第一张人脸
-                face_roi = self.extract_face(img, faces[0])
-                print(f"Extracted face ROI shape: {face_roi.shape}")
+                face_roi = self.extract_face(frame, faces[0])
+                logger.debug("Extracted face ROI shape: %s", face_roi.shape)
                 
-                # 存储人脸数据用于训练
-                self.face_samples.append(face_roi)
-                label = hash(student_id) % 10000  # 简化的标签生成
-                self.ids.append(label)
-                self.known_faces[label] = student_id
-                print(f"Added face sample. Total samples: {len(self.face_samples)}")
-                
-                return True
+                return self.add_face_roi(face_roi, student_id)
             else:
-                print("No faces detected in the image")
+                logger.info("No faces detected in the image for student %s", student_id)
                 return False
-        except Exception as e:
-            print(f"Error adding face: {e}")
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("Error adding face")
             return False
     
-    def train_model(self) -> bool:
+    def add_face_roi(self, face_roi: np.ndarray, student_id: str) -> bool:
         """
-        训练人脸识别模型
-        :return: 是否训练成功
+        把已提取的人脸区域添加到人脸库，等待增量训练
+        :param face_roi: 人脸区域图像
+        :param student_id: 学生ID
+        :return: 是否添加成功
         """
-        try:
-            if self.recognizer and len(self.face_samples) > 0 and len(self.ids) > 0:
-                self.recognizer.train(self.face_samples, np.array(self.ids))
-                self.trained = True
+        with self._lock:
+            # 存储人脸数据用于训练
+            self.face_samples.append(face_roi)
+            label = self._label_for(student_id)
+            self.ids.append(label)
+            self.known_faces[label] = student_id
+            self.removed_labels.discard(label)
+            self._masked_counts.pop(label, None)
+            # 记录为待增量训练的样本
+            self.pending_samples.append(face_roi)
+            self.pending_ids.append(label)
+            logger.debug("Added face sample. Total samples: %d", len(self.face_samples))
+        return True
+    
+    def train_model(self, wait: bool = False, timeout: Optional[float] = None) -> bool:
+        """
+        请求使用全部样本完整重建人脸识别模型，由后台训练线程执行
+        :param wait: 是否等待新模型替换完成
+        :param timeout: 等待的最长时间（秒）
+        :return: 是否提交（等待时为是否完成）了训练
+        """
+        with self._lock:
+            if not self.recognizer_available:
+                return False
+            self._rebuild_requested = True
+            return self._submit(wait, timeout)
+    
+    def update_model(self, wait: bool = False, timeout: Optional[float] = None) -> bool:
+        """
+        请求增量训练：只把新增的样本加入模型，耗时与新样本数量相关，与已有人脸库大小无关。
+        短时间内的多次请求会被后台训练线程合并为一次训练
+        :param wait: 是否等待新模型替换完成
+        :param timeout: 等待的最长时间（秒）
+        :return: 是否提交（等待时为是否完成）了训练
+        """
+        with self._lock:
+            if not self.recognizer_available:
+                return False
+            if not self.pending_samples and self.generation is not None:
                 return True
+            return self._submit(wait, timeout)
+    
+    def purge_removed(self, wait: bool = False, timeout: Optional[float] = None) -> bool:
+        """
+        已删除学生的残留样本需要清除时请求完整重建，与排队中的训练合并为一次
+        :param wait: 是否等待新模型替换完成
+        :param timeout: 等待的最长时间（秒）
+        :return: 是否提交了重建
+        """
+        with self._lock:
+            if not self.recognizer_available or not self._needs_purge():
+                return False
+            self._rebuild_requested = True
+            self._submit(wait, timeout)
+            return True
+    
+    def _needs_purge(self) -> bool:
+        """
+        当前模型中已删除学生的残留样本是否需要完整重建清除（调用方持有锁）。
+        opencv后端只返回最近的一个样本，残留样本可能遮住正确的学生，有残留就需要重建；
+        numpy后端按前k个候选跳过残留样本，超过MASKED_REBUILD_RATIO时才重建
+        """
+        masked = sum(self._masked_counts.values())
+        if not masked or self.generation is None:
             return False
-        except Exception as e:
-            print(f"Error training model: {e}")
-            return False
+        if self.matcher == 'opencv':
+            return True
+        return masked > len(self.generation.ids) * MASKED_REBUILD_RATIO
+    
+    def wait_for_model(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待已提交的训练全部完成
+        :param timeout: 等待的最长时间（秒）
+        :return: 是否全部完成
+        """
+        with self._lock:
+            target = self._queued_version
+            return self._train_cond.wait_for(lambda: self._applied_version >= target, timeout)
+    
+    def _submit(self, wait: bool, timeout: Optional[float]) -> bool:
+        """提交一次训练请求并唤醒后台训练线程（调用方持有锁）"""
+        self._queued_version += 1
+        target = self._queued_version
+        if self._trainer is None or not self._trainer.is_alive():
+            self._trainer = threading.Thread(target=self._train_loop, name='face-model-trainer', daemon=True)
+            self._trainer.start()
+        self._train_cond.notify_all()
+        if not wait:
+            return True
+        return self._train_cond.wait_for(lambda: self._applied_version >= target, timeout)
+    
+    def _train_loop(self):
+        """后台训练线程：合并排队的注册请求，构建新一代模型并原子替换"""
+        while True:
+            with self._lock:
+                self._train_cond.wait_for(lambda: self._queued_version > self._applied_version)
+            
+            # 等待一小段时间，把连续到达的注册合并为一次训练
+            time.sleep(self.coalesce_delay)
+            
+            with self._lock:
+                target = self._queued_version
+                rebuild = (self._rebuild_requested or self.generation is None or self._standby is None
+                           or self._needs_purge())
+                self._rebuild_requested = False
+                batch_samples, batch_ids = self.pending_samples, self.pending_ids
+                self.pending_samples, self.pending_ids = [], []
+                labels = self._label_table()
+                if rebuild:
+                    all_samples, all_ids = list(self.face_samples), list(self.ids)
+                    self.stale_samples = 0
+                    self._masked_counts = {}
+            
+            try:
+                if rebuild:
+                    self._build_full(all_samples, all_ids, labels)
+                else:
+                    self._apply_batch(batch_samples, batch_ids, labels)
+            except Exception:
+                logger.exception("Error training model")
+            
+            with self._lock:
+                self._applied_version = target
+                self._train_cond.notify_all()
+    
+    def _swap_generation(self, recognizer, labels: list, samples: list, ids: list):
+        """原子替换当前模型代，返回被替换的旧一代"""
+        old = self.generation
+        number = old.number + 1 if old else 1
+        with self._lock:
+            self.generation = ModelGeneration(number, recognizer, labels, samples, ids)
+            self.changes += 1
+        self.clear_result_cache()
+        for listener in self.generation_listeners:
+            try:
+                listener(self.generation)
+            except Exception:
+                logger.exception("Error in generation listener")
+        return old
+    
+    def _build_full(self, samples: list, ids: list, labels: list):
+        """用全部样本训练新一代模型，并同步训练备用识别器"""
+        if not samples:
+            # 没有样本时清空模型
+            old, self.generation = self.generation, None
+            self._standby, self._standby_lag = None, []
+            if old is not None:
+                old.retire()
+            return
+        
+        recognizer = create_recognizer(self.matcher)
+        recognizer.train(samples, np.array(ids))
+        old = self._swap_generation(recognizer, labels, samples, ids)
+        logger.info("Model rebuilt with %d samples (generation %d)", len(samples), self.generation.number)
+        
+        # 旧一代不再被读取后作为备用识别器重新训练
+        standby = None
+        if old is not None:
+            old.retire()
+            standby = old.recognizer
+        if standby is None:
+            standby = create_recognizer(self.matcher)
+        standby.train(samples, np.array(ids))
+        self._standby, self._standby_lag = standby, []
+    
+    def _apply_batch(self, samples: list, ids: list, labels: list):
+        """把新样本增量加入备用识别器，替换为新一代后再让旧一代补上这批样本"""
+        if not samples:
+            return
+        
+        standby = self._standby
+        for lag_samples, lag_ids in self._standby_lag:
+            standby.update(lag_samples, np.array(lag_ids))
+        standby.update(samples, np.array(ids))
+        
+        current = self.generation
+        old = self._swap_generation(standby, labels, current.samples + samples, current.ids + ids)
+        logger.info("Model updated with %d new samples (generation %d)", len(samples), self.generation.number)
+        
+        old.retire()
+        self._standby = old.recognizer
+        self._standby_lag = [(samples, ids)]
+    
+    def _acquire_generation(self) -> Optional[ModelGeneration]:
+        """获取当前模型代用于读取，调用方读取完毕后需要release"""
+        while True:
+            generation = self.generation
+            if generation is None or generation.acquire():
+                return generation
+    
+    def remove_face(self, student_id: str) -> bool:
+        """
+        从人脸库中移除学生。LBPH模型不支持删除样本，
+        这里只把标签从已知人脸中移除使其不再被识别，残留样本在下次完整重建时清除（见purge_removed）
+        :param student_id: 学生ID
+        :return: 是否移除了该学生的数据
+        """
+        with self._lock:
+            label = self.registry.get(student_id)
+            if label is None or label not in self.known_faces:
+                return False
+            
+            del self.known_faces[label]
+            self.removed_labels.add(label)
+            
+            # 从待训练样本中移除
+            keep = [i for i, l in enumerate(self.pending_ids) if l != label]
+            removed_pending = len(self.pending_ids) - len(keep)
+            self.pending_samples = [self.pending_samples[i] for i in keep]
+            self.pending_ids = [self.pending_ids[i] for i in keep]
+            
+            # 从全部样本中移除，已经进入模型的部分计为残留样本
+            keep = [i for i, l in enumerate(self.ids) if l != label]
+            removed = len(self.ids) - len(keep)
+            self.face_samples = [self.face_samples[i] for i in keep]
+            self.ids = [self.ids[i] for i in keep]
+            if self.generation is not None and removed > removed_pending:
+                self.stale_samples += removed - removed_pending
+                self._masked_counts[label] = self._masked_counts.get(label, 0) + removed - removed_pending
+            self.changes += 1
+        self.clear_result_cache()
+        return True
     
     def recognize_face(self, image_data: bytes) -> Optional[str]:
         """
@@ -172,81 +707,509 @@ class FaceRecognitionService:
         :param image_data: 图片数据
         :return: 匹配的学生ID，如果没有匹配则返回None
         """
+        frame = self.decode_frame(image_data)
+        if frame is None:
+            return None
+        return self.recognize_frame(frame)
+    
+    def recognize_frame(self, frame: Frame, faces=None) -> Optional[str]:
+        """
+        识别已解码帧中的第一张人脸
+        :param frame: 帧对象
+        :param faces: 已检测到的人脸边界框，为None时在这里检测
+        :return: 匹配的学生ID，如果没有匹配则返回None
+        """
         try:
-            # 将字节数据转换为numpy数组
-            nparr = np.frombuffer(image_data, np.uint8)
-            # 解码图像
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
             # 检测人脸
-            faces = self.detect_faces(img)
+            if faces is None:
+                faces = self.detect_faces(frame)
             
-            if len(faces) > 0 and self.recognizer and self.trained:
+            if len(faces) > 0 and self.trained:
                 # 取第一张人脸
-                face_roi = self.extract_face(img, faces[0])
+                face_roi = self.extract_face(frame, faces[0])
+                reason = self.quality_gate.check_face(face_roi, faces[0]) if self.quality_gate is not None else None
+                if reason:
+                    logger.info("Face rejected by quality gate: %s", reason)
+                    return None
                 
                 # 识别
-                label, confidence = self.recognizer.predict(face_roi)
-                
-                print(f"Recognized label: {label}, confidence: {confidence}")  # 调试信息
-                
-                # 置信度阈值
-                if confidence < 100:  # 置信度越低越好
-                    if label in self.known_faces:
-                        return self.known_faces[label]
+                student_id, _ = self.predict_face(face_roi)
+                return student_id
             
             return None
-        except Exception as e:
-            print(f"Error recognizing face: {e}")
+        except Exception:
+            logger.exception("Error recognizing face")
+            return None
+    
+    def course_gallery(self, course_id, student_ids: Iterable[str]) -> Optional[ModelGeneration]:
+        """
+        获取只包含某门课程选课学生的子人脸库。子人脸库按课程缓存，
+        选课名单变化或模型更新后在下次获取时重新构建
+        :param course_id: 课程ID
+        :param student_ids: 该课程的选课学生ID
+        :return: 子人脸库，模型尚未训练时返回None
+        """
+        generation = self.generation
+        if generation is None:
             return None
+        roster = frozenset(student_ids)
+        with self._lock:
+            cached = self._galleries.get(course_id)
+        if cached is not None and cached[0] == roster and cached[1] == generation.number:
+            return cached[2]
+        
+        with stage('gallery_build'):
+            gallery = self._build_gallery(roster, generation.number)
+        with self._lock:
+            self._galleries.pop(course_id, None)
+            self._galleries[course_id] = (roster, generation.number, gallery)
+            # 超出数量时丢弃最早构建的子人脸库
+            while len(self._galleries) > MAX_COURSE_GALLERIES:
+                del self._galleries[next(iter(self._galleries))]
+        return gallery
+    
+    def _build_gallery(self, roster: frozenset, number: int) -> ModelGeneration:
+        """用名单中学生的全部样本训练子人脸库，没有样本时返回空的子人脸库"""
+        with self._lock:
+            labels = self._label_table(roster)
+            keep = [i for i, label in enumerate(self.ids) if labels[label] is not None]
+            samples = [self.face_samples[i] for i in keep]
+            ids = [self.ids[i] for i in keep]
+        
+        recognizer = None
+        if samples:
+            recognizer = create_recognizer(self.matcher)
+            recognizer.train(samples, np.array(ids))
+        return ModelGeneration(number, recognizer, labels, samples, ids)
+    
+    def invalidate_galleries(self, course_id=None):
+        """丢弃某门课程（course_id为None时为全部课程）的子人脸库缓存"""
+        with self._lock:
+            if course_id is None:
+                self._galleries.clear()
+            else:
+                self._galleries.pop(course_id, None)
+        self.clear_result_cache()
+    
+    def clear_result_cache(self):
+        """丢弃全部缓存的识别结果"""
+        if self.result_cache is not None:
+            self._result_epoch += 1
+            self.result_cache.clear()
+    
+    def recognize_image(self, image_data, all_faces: bool = False,
+                        rosters: Optional[Dict[object, List[str]]] = None) -> Optional[List[dict]]:
+        """
+        从图片数据完成解码、检测和识别，识别进程池的工作进程也调用这个方法
+        :param image_data: 图片数据
+        :param all_faces: 是否识别所有人脸，False时只识别第一张
+        :param rosters: 课程ID到选课学生ID的映射，给出时只在这些课程的子人脸库中匹配
+        :return: 每张人脸的识别结果列表（没有检测到人脸时为空列表），解码失败返回None。
+                 all_faces为True时按课堂合照检查人脸质量（class_quality_gate）
+        """
+        frame = self.decode_frame(image_data)
+        if frame is None:
+            return None
+        faces = self.detect_faces(frame)
+        if not all_faces:
+            faces = faces[:1]
+        galleries = None
+        if rosters is not None:
+            galleries = [self.course_gallery(course_id, student_ids) for course_id, student_ids in rosters.items()]
+        # 缓存范围包括名单内容：工作进程中的缓存不会随主进程的选课变化清空，名单变化后不能再命中旧结果
+        cache_scope = None if rosters is None else frozenset(
+            (course_id, frozenset(student_ids)) for course_id, student_ids in rosters.items())
+        return self.recognize_faces(frame, faces, galleries=galleries, cache_scope=cache_scope, class_photo=all_faces)
+    
+    def predict_face(self, face_roi: np.ndarray) -> Tuple[Optional[str], float]:
+        """
+        识别已提取的人脸区域
+        :param face_roi: 人脸区域图像
+        :return: (匹配的学生ID或None, 置信度距离)
+        """
+        generation = self._acquire_generation()
+        if generation is None:
+            return None, None
+        try:
+            with stage('predict'):
+                label, confidence = generation.recognizer.predict(face_roi)
+        finally:
+            generation.release()
+        
+        logger.debug("Recognized label: %s, confidence: %s", label, confidence)
+        
+        # 置信度阈值
+        if confidence < MATCH_THRESHOLD:  # 置信度越低越好
+            student_id = generation.student_for(label)
+            if student_id and label not in self.removed_labels:
+                return student_id, confidence
+        return None, confidence
+    
+    def match_faces(self, face_rois: List[np.ndarray], k: int = 1,
+                    galleries: Optional[List[ModelGeneration]] = None) -> List[List[Tuple[str, float]]]:
+        """
+        批量匹配多个人脸区域，已删除的学生不参与。
+        numpy后端一次向量化计算全部人脸并返回前k个学生；opencv后端逐个预测，每个人脸最多一个候选
+        :param face_rois: 人脸区域图像列表
+        :param k: 每个人脸返回的候选数
+        :param galleries: 课程子人脸库，给出时只在这些子人脸库中匹配并合并结果，否则使用完整模型。
+            距离在course_match_threshold和MATCH_THRESHOLD之间的结果再在完整模型中确认，完整模型中更近的学生排在最前面
+        :return: 每个人脸的[(学生ID, 距离), ...]，按距离从小到大排列，不做阈值过滤
+        """
+        if not face_rois:
+            return []
+        if galleries is not None:
+            merged = [{} for _ in face_rois]
+            for gallery in galleries:
+                if gallery is None or gallery.recognizer is None:
+                    continue
+                for best, candidates in zip(merged, self._match_generation(gallery, face_rois, k)):
+                    for student_id, distance in candidates:
+                        if distance < best.get(student_id, float('inf')):
+                            best[student_id] = distance
+            results = [sorted(best.items(), key=lambda item: item[1])[:k] for best in merged]
+            return self._verify_in_full_model(face_rois, results, k)
+        
+        generation = self._acquire_generation()
+        if generation is None:
+            return [[] for _ in face_rois]
+        try:
+            return self._match_generation(generation, face_rois, k)
+        finally:
+            generation.release()
     
-    def load_face_data(self, face_data: str, student_id: str) -> bool:
+    def _verify_in_full_model(self, face_rois: List[np.ndarray], results: List[List[Tuple[str, float]]],
+                              k: int) -> List[List[Tuple[str, float]]]:
+        """
+        子人脸库只包含选课学生，没有选课的学生也会匹配到最像的选课学生（闭集匹配）。
+        距离小于course_match_threshold的匹配足够可靠，直接采用，不再访问完整模型；
+        在它和MATCH_THRESHOLD之间的结果在完整模型中查找最近的学生：不是同一个学生时把它放在最前面，
+        调用方按未选课处理；最近的是已删除学生的残留样本时无法确认，不返回候选
+        """
+        check = [i for i, candidates in enumerate(results)
+                 if candidates and self.course_match_threshold <= candidates[0][1] < MATCH_THRESHOLD]
+        if not check:
+            return results
+        generation = self._acquire_generation()
+        if generation is None:
+            return [[] if i in check else candidates for i, candidates in enumerate(results)]
+        try:
+            nearest = self._match_generation(generation, [face_rois[i] for i in check], 1)
+        finally:
+            generation.release()
+        for i, best in zip(check, nearest):
+            if not best:
+                results[i] = []
+            elif best[0][0] != results[i][0][0]:
+                results[i] = (best + [candidate for candidate in results[i] if candidate[0] != best[0][0]])[:k]
+        return results
+    
+    def _match_generation(self, generation: ModelGeneration, face_rois: List[np.ndarray],
+                          k: int) -> List[List[Tuple[str, float]]]:
+        """在一代模型（或子人脸库）中匹配，调用方保证读取期间模型不会被修改"""
+        with self._lock:
+            removed = set(self.removed_labels)
+            # 多取一些候选，过滤掉已删除学生和残留样本后仍有k个
+            extra = len(removed) + self.stale_samples
+        if isinstance(generation.recognizer, LBPHistogramMatcher):
+            ranked = generation.recognizer.predict_top_k(np.stack(face_rois), k + extra)
+        else:
+            ranked = [[generation.recognizer.predict(face_roi)] for face_roi in face_rois]
+        
+        return [[(generation.student_for(label), float(distance)) for label, distance in candidates
+                 if generation.student_for(label) and label not in removed][:k]
+                for candidates in ranked]
+    
+    def _match_cached(self, face_rois: List[np.ndarray], galleries, cache_scope) -> List[List[Tuple[str, float]]]:
+        """
+        先按人脸指纹查询识别结果缓存，只匹配没有命中的人脸，并缓存其中识别成功的结果。
+        指纹相同不能保证是同一个人，命中的结果先用缓存学生自己样本的直方图确认，确认不了时重新识别
+        """
+        scope = (self._result_epoch, cache_scope)
+        fingerprints = [face_fingerprint(face_roi) for face_roi in face_rois]
+        matches = [self._verify_cached(face_roi, self.result_cache.find(scope, fingerprint))
+                   for face_roi, fingerprint in zip(face_rois, fingerprints)]
+        
+        missing = [i for i, match in enumerate(matches) if match is None]
+        if missing:
+            for i, candidates in zip(missing, self.match_faces([face_rois[i] for i in missing], 1, galleries)):
+                matches[i] = candidates
+                if candidates and candidates[0][1] < MATCH_THRESHOLD:
+                    reference = self._student_histograms(candidates[0][0])
+                    if reference is not None:
+                        self.result_cache.put(scope, fingerprints[i], (candidates, reference))
+        return matches
+    
+    def _student_histograms(self, student_id: str):
+        """
+        学生全部样本的LBP直方图，用于确认缓存命中
+        :return: (按列存储的直方图, 每列之和)，学生没有样本时返回None
+        """
+        with self._lock:
+            label = self.registry.get(student_id)
+            samples = [sample for sample, sample_label in zip(self.face_samples + self.pending_samples,
+                                                              self.ids + self.pending_ids)
+                       if sample_label == label]
+        if label is None or not samples:
+            return None
+        histograms = lbp_histograms(np.stack(samples))
+        return np.ascontiguousarray(histograms.T), histograms.sum(axis=1, dtype=np.float64)
+    
+    @staticmethod
+    def _verify_cached(face_roi: np.ndarray, entry) -> Optional[List[Tuple[str, float]]]:
+        """
+        确认缓存的结果：人脸与缓存学生样本的距离在阈值内，并且比缓存时的距离最多大CACHE_VERIFY_MARGIN
+        :param entry: 缓存条目(候选结果, 学生样本的直方图)，为None时表示没有命中
+        :return: 确认后的候选结果（距离为重新计算的距离），不能确认时返回None
+        """
+        if entry is None:
+            return None
+        candidates, (columns, sums) = entry
+        student_id, cached_distance = candidates[0]
+        distance = float(chi_square_distances(lbp_histograms(face_roi), columns, sums).min())
+        if distance < MATCH_THRESHOLD and distance <= cached_distance + CACHE_VERIFY_MARGIN:
+            return [(student_id, distance)]
+        return None
+    
+    def recognize_faces(self, frame: Frame, faces=None, top_k: int = 1,
+                        galleries: Optional[List[ModelGeneration]] = None, cache_scope=None,
+                        class_photo: bool = False) -> List[dict]:
+        """
+        识别帧中的所有人脸（课堂合照模式），只检测一次，所有人脸一起匹配
+        :param frame: 帧对象
+        :param faces: 已检测到的人脸边界框，为None时在这里检测
+        :param top_k: 大于1时在结果中附带前k个候选（candidates），用于调整阈值和审核
+        :param galleries: 课程子人脸库，给出时只匹配这些课程的选课学生
+        :param cache_scope: 子人脸库对应的课程及其名单，用于识别结果缓存；给出galleries但没有给出时不使用缓存
+        :param class_photo: 是否为课堂合照，合照使用class_quality_gate检查人脸质量，否则使用quality_gate
+        :return: 每张人脸的识别结果列表，包含边界框、学生ID、置信度距离和质量检查不通过的原因（quality）
+        """
+        try:
+            if faces is None:
+                faces = self.detect_faces(frame)
+            
+            matches = [[] for _ in faces]
+            reasons = [None for _ in faces]
+            if self.trained and len(faces) > 0:
+                with stage('extract'):
+                    face_rois = [self.extract_face(frame, face) for face in faces]
+                # 质量不合格的人脸不参与识别
+                quality_gate = self.class_quality_gate if class_photo else self.quality_gate
+                if quality_gate is not None:
+                    with stage('quality'):
+                        reasons = [quality_gate.check_face(face_roi, face)
+                                   for face_roi, face in zip(face_rois, faces)]
+                passed = [i for i, reason in enumerate(reasons) if reason is None]
+                face_rois = [face_rois[i] for i in passed]
+                if not face_rois:
+                    passed_matches = []
+                else:
+                    with stage('predict'):
+                        if top_k == 1 and self.result_cache is not None and (galleries is None or cache_scope is not None):
+                            passed_matches = self._match_cached(face_rois, galleries, cache_scope)
+                        else:
+                            passed_matches = self.match_faces(face_rois, top_k, galleries)
+                for i, candidates in zip(passed, passed_matches):
+                    matches[i] = candidates
+            
+            results = []
+            for (x, y, w, h), candidates, reason in zip(faces, matches, reasons):
+                student_id, confidence = None, None
+                if candidates:
+                    best_id, confidence = candidates[0]
+                    if confidence < MATCH_THRESHOLD:
+                        student_id = best_id
+                result = {
+                    'box': (int(x), int(y), int(w), int(h)),
+                    'student_id': student_id,
+                    'confidence': confidence,
+                    'quality': reason
+                }
+                if top_k > 1:
+                    result['candidates'] = [{'student_id': candidate_id, 'confidence': distance}
+                                            for candidate_id, distance in candidates]
+                results.append(result)
+            return results
+        except Exception:
+            logger.exception("Error recognizing faces")
+            return []
+    
+    def load_face_data(self, face_data, student_id: str) -> bool:
         """
         从数据库加载的人脸数据中恢复人脸信息
-        :param face_data: 数据库中存储的人脸数据（JSON格式）
+        :param face_data: 数据库中存储的人脸数据（二进制格式或旧的JSON格式）
         :param student_id: 学生ID
         :return: 是否加载成功
         """
         try:
             # 解析存储的人脸数据
-            face_info = json.loads(face_data)
-            face_array = np.array(face_info['face'], dtype=np.uint8)
-            
-            # 重塑数组
-            shape = face_info.get('shape', (100, 100))  # 默认形状
-            face_roi = face_array.reshape(shape)
+            samples = decode_face_samples(face_data)
             
             # 添加到样本中
-            self.face_samples.append(face_roi)
-            label = hash(student_id) % 10000
-            self.ids.append(label)
-            self.known_faces[label] = student_id
+            with self._lock:
+                label = self._label_for(student_id)
+                for face_roi in samples:
+                    self.face_samples.append(face_roi)
+                    self.ids.append(label)
+                    self.pending_samples.append(face_roi)
+                    self.pending_ids.append(label)
+                self.known_faces[label] = student_id
+                self.removed_labels.discard(label)
+                self._masked_counts.pop(label, None)
             
             return True
         except Exception as e:
-            print(f"Error loading face data: {e}")
+            logger.warning("Error loading face data for student %s: %s", student_id, e)
             return False
     
-    def serialize_face(self, face_roi: np.ndarray) -> str:
+    def serialize_face(self, face_roi: np.ndarray) -> bytes:
         """
-        将人脸数据序列化为可存储的字符串
-        :param face_roi: 人脸图像数据
+        将人脸数据序列化为可存储的二进制数据
+        :param face_roi: 人脸图像数据，单个(h, w)或多个(n, h, w)
         :return: 序列化后的人脸数据
         """
         try:
             # 确保face_roi是numpy数组
             if not isinstance(face_roi, np.ndarray):
-                print(f"Error: face_roi is not numpy array, type: {type(face_roi)}")
-                return ""
+                logger.error("face_roi is not numpy array, type: %s", type(face_roi))
+                return b""
             
-            # 将人脸数据转换为列表并存储
-            face_info = {
-                'shape': face_roi.shape,
-                'face': face_roi.flatten().tolist()
-            }
-            serialized = json.dumps(face_info)
-            print(f"Serialized face data length: {len(serialized)}")
+            serialized = encode_face_samples(face_roi)
+            logger.debug("Serialized face data length: %d", len(serialized))
             return serialized
+        except Exception:
+            logger.exception("Error serializing face")
+            return b""
+    
+    def save_snapshot(self, directory: str, watermark: dict) -> bool:
+        """
+        把训练好的模型、样本和标签映射保存为带版本的磁盘快照
+        :param directory: 快照目录
+        :param watermark: 快照对应的数据库水位（最大updated_at、学生数量等）
+        :return: 是否保存成功
+        """
+        try:
+            # 保证模型包含全部已提交的样本
+            self.update_model(wait=True)
+            
+            # 模型代和修改次数一起读取，保存的快照与记录的修改次数一致
+            with self._lock:
+                changes = self.changes
+                generation = self._acquire_generation()
+            if generation is None:
+                return False
+            
+            try:
+                with self._lock:
+                    labels = [None if label in self.removed_labels else student_id
+                              for label, student_id in enumerate(generation.labels)]
+                    registry = self.registry.to_list()
+                
+                os.makedirs(directory, exist_ok=True)
+                name = f"snapshot-{int(time.time() * 1000)}"
+                path = os.path.join(directory, name)
+                os.makedirs(path)
+                
+                # base64格式的YAML比纯文本格式读写快得多（numpy后端忽略这个后缀）
+                generation.recognizer.write(os.path.join(path, RECOGNIZER_FILES[self.matcher]) + '?base64')
+                # 保存与模型一致的样本（包括已删除学生的残留样本，加载时按标签过滤）
+                samples = np.stack(generation.samples)
+                np.save(os.path.join(path, 'samples.npy'), samples)
+                np.save(os.path.join(path, 'ids.npy'), np.array(generation.ids, dtype=np.int32))
+            finally:
+                generation.release()
+            
+            meta = {
+                'version': SNAPSHOT_VERSION,
+                'snapshot': name,
+                'matcher': self.matcher,
+                'watermark': watermark,
+                'labels': labels,
+                'registry': registry,
+                'sample_count': len(samples)
+            }
+            
+            # 最后原子替换元数据文件，读取方不会看到写了一半的快照
+            tmp_meta = os.path.join(directory, 'current.json.tmp')
+            with open(tmp_meta, 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp_meta, os.path.join(directory, 'current.json'))
+            
+            self.snapshot_version = name
+            self.snapshot_generation = generation.number
+            self.snapshot_changes = changes
+            
+            # 清理旧快照（保留上一个，正在重新加载的工作进程可能还在读取）
+            old_snapshots = sorted(entry for entry in os.listdir(directory)
+                                   if entry.startswith('snapshot-') and entry != name)
+            for entry in old_snapshots[:-1]:
+                shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+            
+            logger.info("Saved model snapshot %s with %d samples", name, len(samples))
+            return True
+        except Exception:
+            logger.exception("Error saving snapshot")
+            return False
+    
+    def load_snapshot(self, directory: str, standby: bool = True) -> Optional[dict]:
+        """
+        从磁盘快照恢复模型、样本和标签映射
+        :param directory: 快照目录
+        :param standby: 是否同时加载备用识别器，只识别不训练的进程（识别工作进程）不需要
+        :return: 快照对应的数据库水位，快照不存在或版本不匹配时返回None
+        """
+        try:
+            meta_path = os.path.join(directory, 'current.json')
+            if not self.recognizer_available or not os.path.exists(meta_path):
+                return None
+            
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            
+            if meta.get('version') != SNAPSHOT_VERSION:
+                logger.info("Ignoring snapshot with version %s, expected %s", meta.get('version'), SNAPSHOT_VERSION)
+                return None
+            if meta.get('matcher', 'opencv') != self.matcher:
+                logger.info("Ignoring snapshot built with the %s matcher", meta.get('matcher', 'opencv'))
+                return None
+            
+            path = os.path.join(directory, meta['snapshot'])
+            recognizer = create_recognizer(self.matcher)
+            recognizer.read(os.path.join(path, RECOGNIZER_FILES[self.matcher]))
+            # 备用识别器从同一个文件再读一份，快照之后的第一次注册也只做增量训练
+            if standby:
+                standby = create_recognizer(self.matcher)
+                standby.read(os.path.join(path, RECOGNIZER_FILES[self.matcher]))
+            else:
+                standby = None
+            samples = list(np.load(os.path.join(path, 'samples.npy')))
+            ids = np.load(os.path.join(path, 'ids.npy')).tolist()
+            labels = meta['labels']
+            known_faces = {label: student_id for label, student_id in enumerate(labels) if student_id}
+            
+            with self._lock:
+                self.reset()
+                # 已删除学生的残留样本不再参与以后的完整重建
+                keep = [i for i, label in enumerate(ids) if label in known_faces]
+                self.face_samples = [samples[i] for i in keep]
+                self.ids = [ids[i] for i in keep]
+                self.stale_samples = len(ids) - len(keep)
+                self._masked_counts = {}
+                for label in ids:
+                    if label not in known_faces:
+                        self._masked_counts[label] = self._masked_counts.get(label, 0) + 1
+                self.known_faces = known_faces
+                self.registry = LabelRegistry(meta['registry'])
+                old = self._swap_generation(recognizer, labels, samples, ids)
+                self._standby, self._standby_lag = standby, []
+            if old is not None:
+                old.retire()
+            
+            self.snapshot_version = meta['snapshot']
+            self.snapshot_generation = self.generation.number
+            self.snapshot_changes = self.changes
+            logger.info("Loaded model snapshot %s with %d samples", meta['snapshot'], len(samples))
+            return meta['watermark']
         except Exception as e:
-            print(f"Error serializing face: {e}")
-            return ""
\ No newline at end of file
+            logger.warning("Error loading snapshot: %s", e)
+            return None
@@ -0,0 +1,186 @@
+import itertools
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from models.face_recognition_service import MATCH_THRESHOLD, Frame
+
+
+def box_iou(a, b) -> float:
+    """两个(x, y, w, h)边界框的交并比"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.0
+
+
+class FaceTrack:
+    """视频流中一张持续出现的人脸：位置、跟踪模板和逐帧的识别投票"""
+
+    def __init__(self, track_id: int, box: Tuple[int, int, int, int]):
+        self.track_id = track_id
+        self.box = box  # 原图坐标
+        self.template = None  # 帧坐标下的灰度模板，检测到人脸时更新
+        self.votes = Counter()  # 学生ID（未识别为None） -> 票数
+        self.missed = 0  # 连续丢失的帧数
+        self.updated = False  # 本帧是否找到了这张人脸
+        self.student_id = None  # 投票通过后确定的学生ID
+        self.confidence = None  # 最近一次识别的距离
+
+    @property
+    def leader(self) -> Tuple[Optional[str], int]:
+        """当前票数最多的学生及其票数（不计未识别的票）"""
+        for student_id, count in self.votes.most_common():
+            if student_id is not None:
+                return student_id, count
+        return None, 0
+
+    def to_dict(self) -> dict:
+        x, y, w, h = self.box
+        leader, count = self.leader
+        return {
+            'track_id': self.track_id,
+            'x': int(x),
+            'y': int(y),
+            'width': int(w),
+            'height': int(h),
+            'student_id': self.student_id or leader,
+            'votes': count,
+            'total_votes': sum(self.votes.values()),
+            'confidence': self.confidence,
+            'confirmed': self.student_id is not None
+        }
+
+
+class FaceTracker:
+    """
+    视频流人脸跟踪：每 detect_interval 帧做一次完整的Haar检测，中间帧在上一位置附近用模板匹配跟踪。
+    每帧的识别结果按跟踪目标累计投票，某个学生的票数达到 vote_threshold 并且占多数时确认身份，
+    确认后不再对该目标做识别
+    """
+
+    def __init__(self, service, detect_interval: int = 5, vote_threshold: int = 3,
+                 max_missed: int = 5, match_score: float = 0.6):
+        """
+        :param service: FaceRecognitionService
+        :param detect_interval: 每多少帧做一次完整检测
+        :param vote_threshold: 确认身份需要的最少票数
+        :param max_missed: 连续丢失多少帧后放弃跟踪目标
+        :param match_score: 模板匹配的最低相关系数，低于它视为丢失
+        """
+        self.service = service
+        self.detect_interval = max(1, detect_interval)
+        self.vote_threshold = vote_threshold
+        self.max_missed = max_missed
+        self.match_score = match_score
+        self.tracks: Dict[int, FaceTrack] = {}
+        self.frame_count = 0
+        self._ids = itertools.count(1)
+
+    def process(self, frame: Frame, galleries=None) -> List[FaceTrack]:
+        """
+        处理一帧
+        :param frame: 帧对象
+        :param galleries: 课程子人脸库，为None时使用完整模型
+        :return: 本帧新确认身份的跟踪目标
+        """
+        self.frame_count += 1
+        for track in self.tracks.values():
+            track.updated = False
+
+        if self.frame_count % self.detect_interval == 1 or self.detect_interval == 1 or not self.tracks:
+            self._detect(frame)
+        else:
+            for track in self.tracks.values():
+                self._follow(frame, track)
+
+        for track_id in [t.track_id for t in self.tracks.values() if not t.updated]:
+            track = self.tracks[track_id]
+            track.missed += 1
+            if track.missed > self.max_missed:
+                del self.tracks[track_id]
+
+        return self._vote(frame, galleries)
+
+    def _detect(self, frame: Frame):
+        """完整检测并与已有跟踪目标按交并比关联，没有关联上的检测结果成为新目标"""
+        detections = [tuple(int(v) for v in face) for face in self.service.detect_faces(frame)]
+        unmatched = set(self.tracks)
+        for box in detections:
+            best = max(unmatched, key=lambda track_id: box_iou(self.tracks[track_id].box, box), default=None)
+            if best is not None and box_iou(self.tracks[best].box, box) > 0.3:
+                track = self.tracks[best]
+                unmatched.discard(best)
+            else:
+                track = FaceTrack(next(self._ids), box)
+                self.tracks[track.track_id] = track
+            track.box = box
+            track.template = self._crop(frame, box)
+            track.missed = 0
+            track.updated = True
+
+    def _follow(self, frame: Frame, track: FaceTrack):
+        """在上一位置周围的搜索区域内用模板匹配跟踪人脸"""
+        if track.template is None or track.template.size == 0:
+            return
+        gray = frame.gray
+        scale = frame.scale
+        x, y, w, h = (int(v / scale) for v in track.box)
+        th, tw = track.template.shape
+        # 搜索区域：上一位置向四周各扩展半个人脸
+        x0, y0 = max(0, x - w // 2), max(0, y - h // 2)
+        x1, y1 = min(gray.shape[1], x + w + w // 2), min(gray.shape[0], y + h + h // 2)
+        search = gray[y0:y1, x0:x1]
+        if search.shape[0] < th or search.shape[1] < tw:
+            return
+        result = cv2.matchTemplate(search, track.template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (dx, dy) = cv2.minMaxLoc(result)
+        if score < self.match_score:
+            return
+        track.box = (int((x0 + dx) * scale), int((y0 + dy) * scale), track.box[2], track.box[3])
+        track.missed = 0
+        track.updated = True
+
+    @staticmethod
+    def _crop(frame: Frame, box) -> np.ndarray:
+        """从帧的灰度图中裁剪边界框（原图坐标）对应的区域"""
+        x, y, w, h = (int(v / frame.scale) for v in box)
+        return frame.gray[max(0, y):y + h, max(0, x):x + w].copy()
+
+    def _vote(self, frame: Frame, galleries) -> List[FaceTrack]:
+        """对本帧找到且尚未确认身份的目标一次性批量识别并投票"""
+        pending = [track for track in self.tracks.values() if track.updated and track.student_id is None]
+        if not pending or not self.service.trained:
+            return []
+
+        face_rois = [self.service.extract_face(frame, track.box) for track in pending]
+        # 模糊、过暗等不合格的帧不投票
+        gate = self.service.quality_gate
+        if gate is not None:
+            passed = [i for i, (track, face_roi) in enumerate(zip(pending, face_rois))
+                      if gate.check_face(face_roi, track.box) is None]
+            pending = [pending[i] for i in passed]
+            face_rois = [face_rois[i] for i in passed]
+            if not pending:
+                return []
+        matches = self.service.match_faces(face_rois, 1, galleries)
+
+        confirmed = []
+        for track, candidates in zip(pending, matches):
+            student_id = None
+            if candidates:
+                track.confidence = candidates[0][1]
+                if candidates[0][1] < MATCH_THRESHOLD:
+                    student_id = candidates[0][0]
+            track.votes[student_id] += 1
+
+            leader, count = track.leader
+            if leader is not None and count >= self.vote_threshold and count * 2 > sum(track.votes.values()):
+                track.student_id = leader
+                confirmed.append(track)
+        return confirmed
@@ -0,0 +1,47 @@
+from typing import Iterable, List, Optional
+
+
+class LabelRegistry:
+    """
+    学号与识别器标签的双向映射。标签是从0开始的连续整数，按首次注册的顺序分配且不会改变，
+    标签到学号的查找直接按下标读取数组。映射随模型快照一起保存，
+    重启后和各个识别工作进程中的标签都保持一致
+    """
+
+    def __init__(self, student_ids: Optional[Iterable[str]] = None):
+        """
+        :param student_ids: 按标签顺序排列的学号（从快照恢复时使用）
+        """
+        self._student_ids = list(student_ids or [])  # 下标即标签
+        self._labels = {student_id: label for label, student_id in enumerate(self._student_ids)}
+        if len(self._labels) != len(self._student_ids):
+            raise ValueError("Duplicate student id in label registry")
+
+    def __len__(self) -> int:
+        return len(self._student_ids)
+
+    def __contains__(self, student_id: str) -> bool:
+        return student_id in self._labels
+
+    def label_for(self, student_id: str) -> int:
+        """获取学生的标签，新学生分配下一个标签"""
+        label = self._labels.get(student_id)
+        if label is None:
+            label = len(self._student_ids)
+            self._student_ids.append(student_id)
+            self._labels[student_id] = label
+        return label
+
+    def get(self, student_id: str) -> Optional[int]:
+        """获取学生的标签，未注册时返回None"""
+        return self._labels.get(student_id)
+
+    def student_id(self, label: int) -> Optional[str]:
+        """获取标签对应的学号，未知标签返回None"""
+        if 0 <= label < len(self._student_ids):
+            return self._student_ids[label]
+        return None
+
+    def to_list(self) -> List[str]:
+        """按标签顺序排列的学号，用于持久化"""
+        return list(self._student_ids)
@@ -0,0 +1,233 @@
+"""
+向量化的LBP直方图匹配器，可以替代OpenCV的LBPH识别器
+
+人脸库的全部LBP直方图保存在一个连续的NumPy矩阵中（按bin存储，每列一个样本），一次调用即可计算一个或多个
+待识别人脸与整个人脸库的卡方距离，并返回前k个(标签, 距离)。
+直方图和距离的计算方式与OpenCV的LBPHFaceRecognizer一致（默认参数下结果相同，见tests/test_lbp_matcher.py）。
+"""
+import io
+from typing import List, Tuple
+
+import numpy as np
+
+# 计算卡方距离时每块临时矩阵的最大元素数，限制批量识别的内存占用
+CHUNK_ELEMENTS = 1 << 22
+
+
+def lbp_codes(images: np.ndarray, radius: int = 1, neighbors: int = 8) -> np.ndarray:
+    """
+    计算圆形LBP编码（双线性插值），与OpenCV LBPH的elbp一致
+    :param images: (n, h, w)的灰度图像
+    :return: (n, h-2r, w-2r)的LBP编码
+    """
+    images = np.asarray(images, dtype=np.float32)
+    _, height, width = images.shape
+    center = images[:, radius:height - radius, radius:width - radius]
+    codes = np.zeros(center.shape, dtype=np.int32)
+    eps = np.finfo(np.float32).eps
+
+    def shifted(dy, dx):
+        return images[:, radius + dy:height - radius + dy, radius + dx:width - radius + dx]
+
+    for n in range(neighbors):
+        # 与OpenCV相同，采样点坐标和插值权重都按float计算
+        x = np.float32(radius * np.cos(2.0 * np.pi * n / neighbors))
+        y = np.float32(-radius * np.sin(2.0 * np.pi * n / neighbors))
+        fx, fy = int(np.floor(x)), int(np.floor(y))
+        cx, cy = int(np.ceil(x)), int(np.ceil(y))
+        ty, tx = y - np.float32(fy), x - np.float32(fx)
+        one = np.float32(1)
+        w1, w2, w3, w4 = (one - tx) * (one - ty), tx * (one - ty), (one - tx) * ty, tx * ty
+        t = w1 * shifted(fy, fx) + w2 * shifted(fy, cx) + w3 * shifted(cy, fx) + w4 * shifted(cy, cx)
+        codes |= ((t > center) | (np.abs(t - center) < eps)).astype(np.int32) << n
+    return codes
+
+
+def lbp_histograms(images, radius: int = 1, neighbors: int = 8,
+                   grid_x: int = 8, grid_y: int = 8) -> np.ndarray:
+    """
+    计算分块归一化的LBP直方图
+    :param images: 单个(h, w)或多个(n, h, w)同尺寸灰度图像
+    :return: (n, grid_x * grid_y * 2^neighbors)的float32直方图矩阵
+    """
+    images = np.asarray(images)
+    if images.ndim == 2:
+        images = images[np.newaxis]
+    codes = lbp_codes(images, radius, neighbors)
+    count, height, width = codes.shape
+    bins = 1 << neighbors
+    cell_h, cell_w = height // grid_y, width // grid_x
+    cells = grid_x * grid_y
+
+    # 按网格切块（与OpenCV一样丢弃除不尽的边缘），每块的编码加上块偏移后一次bincount
+    codes = codes[:, :grid_y * cell_h, :grid_x * cell_w]
+    codes = codes.reshape(count, grid_y, cell_h, grid_x, cell_w).transpose(0, 1, 3, 2, 4)
+    codes = codes.reshape(count, cells, cell_h * cell_w)
+    offsets = (np.arange(count * cells, dtype=np.int64) * bins).reshape(count, cells, 1)
+    hist = np.bincount((codes + offsets).ravel(), minlength=count * cells * bins)
+    hist = hist.reshape(count, cells * bins).astype(np.float32)
+    return hist / np.float32(cell_h * cell_w)
+
+
+def chi_square_distances(probes: np.ndarray, columns: np.ndarray, sums: np.ndarray) -> np.ndarray:
+    """
+    计算卡方距离矩阵，与OpenCV的HISTCMP_CHISQR_ALT一致：2 * sum((p - g)^2 / (p + g))
+
+    (p - g)^2 / (p + g) = (p + g) - 4pg / (p + g)，因此距离等于
+    2 * (sum(p) + sum(g)) - 8 * sum(pg / (p + g))，后一项只需要在待识别直方图的非零bin上计算。
+    LBP直方图大部分bin为零，人脸库按bin存储（每行一个bin）后这些bin可以连续读取
+    :param probes: (m, d)的待识别直方图
+    :param columns: (d, n)的人脸库直方图，每列一个样本
+    :param sums: (n,)的人脸库直方图之和
+    :return: (m, n)的距离矩阵
+    """
+    count = columns.shape[1]
+    distances = np.empty((len(probes), count), dtype=np.float64)
+    for i, probe in enumerate(probes):
+        nonzero = np.flatnonzero(probe)
+        values = probe[nonzero, np.newaxis]
+        step = max(1, CHUNK_ELEMENTS // max(1, len(nonzero)))
+        shared = np.empty(count, dtype=np.float64)
+        for j in range(0, count, step):
+            block = columns[nonzero, j:j + step]
+            terms = block * values
+            terms /= block + values
+            shared[j:j + step] = terms.sum(axis=0, dtype=np.float64)
+        distances[i] = 2.0 * (probe.sum(dtype=np.float64) + sums) - 8.0 * shared
+    # 相同直方图的距离可能因舍入出现极小的负数
+    return np.maximum(distances, 0.0, out=distances)
+
+
+class LBPHistogramMatcher:
+    """
+    LBP直方图人脸匹配器，接口与OpenCV的LBPH识别器兼容（train、update、predict、write、read），
+    另外提供批量的前k个候选查询
+    """
+
+    def __init__(self, radius: int = 1, neighbors: int = 8, grid_x: int = 8, grid_y: int = 8):
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        self.dimensions = grid_x * grid_y * (1 << neighbors)
+        self._columns = np.empty((self.dimensions, 0), dtype=np.float32)  # (bin, 样本)
+        self._sums = np.empty(0, dtype=np.float64)  # 每个样本直方图之和
+        self._labels = np.empty(0, dtype=np.int32)
+        self._size = 0
+        self._label_index = None  # 按标签分组的缓存，样本变化时失效
+
+    @property
+    def histograms(self) -> np.ndarray:
+        """人脸库直方图矩阵，每行一个样本（只读视图）"""
+        return self._columns[:, :self._size].T
+
+    @property
+    def labels(self) -> np.ndarray:
+        """直方图对应的标签（只读视图）"""
+        return self._labels[:self._size]
+
+    def compute_histograms(self, images) -> np.ndarray:
+        """计算一个或多个人脸图像的LBP直方图"""
+        if isinstance(images, (list, tuple)):
+            if not images:
+                return np.empty((0, self.dimensions), dtype=np.float32)
+            if len({np.shape(image) for image in images}) > 1:
+                # 尺寸不同的图像逐个计算
+                return np.concatenate([self.compute_histograms(image) for image in images])
+            images = np.stack(images)
+        return lbp_histograms(images, self.radius, self.neighbors, self.grid_x, self.grid_y)
+
+    def train(self, samples, labels):
+        """用给定样本重新建立人脸库"""
+        self._size = 0
+        self.update(samples, labels)
+
+    def update(self, samples, labels):
+        """把新样本追加到人脸库，容量按倍数增长，避免每次追加都复制整个矩阵"""
+        histograms = self.compute_histograms(samples)
+        labels = np.asarray(labels, dtype=np.int32).ravel()
+        if len(histograms) != len(labels):
+            raise ValueError(f"Got {len(histograms)} samples but {len(labels)} labels")
+
+        needed = self._size + len(histograms)
+        if needed > len(self._labels):
+            capacity = max(needed, 2 * len(self._labels), 64)
+            columns = np.empty((self.dimensions, capacity), dtype=np.float32)
+            columns[:, :self._size] = self._columns[:, :self._size]
+            sums = np.empty(capacity, dtype=np.float64)
+            sums[:self._size] = self._sums[:self._size]
+            labels_buffer = np.empty(capacity, dtype=np.int32)
+            labels_buffer[:self._size] = self.labels
+            self._columns, self._sums, self._labels = columns, sums, labels_buffer
+        self._columns[:, self._size:needed] = histograms.T
+        self._sums[self._size:needed] = histograms.sum(axis=1, dtype=np.float64)
+        self._labels[self._size:needed] = labels
+        self._size = needed
+        self._label_index = None
+
+    def distances(self, face_rois) -> np.ndarray:
+        """计算一个或多个人脸与人脸库所有样本的卡方距离，返回(m, n)矩阵"""
+        return chi_square_distances(self.compute_histograms(face_rois),
+                                    self._columns[:, :self._size], self._sums[:self._size])
+
+    def predict(self, face_roi) -> Tuple[int, float]:
+        """识别单个人脸，返回(标签, 距离)；人脸库为空时与OpenCV一样返回(-1, DBL_MAX)"""
+        if self._size == 0:
+            return -1, float(np.finfo(np.float64).max)
+        distances = self.distances(face_roi)[0]
+        best = int(np.argmin(distances))
+        return int(self._labels[best]), float(distances[best])
+
+    def _grouped_labels(self):
+        """按标签排序的样本顺序、每个标签的起始位置和标签值"""
+        if self._label_index is None:
+            order = np.argsort(self.labels, kind='stable')
+            sorted_labels = self.labels[order]
+            starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+            self._label_index = (order, starts, sorted_labels[starts])
+        return self._label_index
+
+    def predict_top_k(self, face_rois, k: int = 5) -> List[List[Tuple[int, float]]]:
+        """
+        批量识别，每个人脸返回距离最近的前k个不同标签
+        :param face_rois: 单个(h, w)或多个(n, h, w)人脸图像
+        :param k: 每个人脸返回的候选数
+        :return: 每个人脸的[(标签, 距离), ...]，按距离从小到大排列
+        """
+        face_rois = np.asarray(face_rois)
+        if face_rois.ndim == 2:
+            face_rois = face_rois[np.newaxis]
+        if self._size == 0 or len(face_rois) == 0:
+            return [[] for _ in range(len(face_rois))]
+
+        # 每个标签取其所有样本中的最小距离
+        order, starts, unique_labels = self._grouped_labels()
+        per_label = np.minimum.reduceat(self.distances(face_rois)[:, order], starts, axis=1)
+
+        k = min(k, len(unique_labels))
+        top = np.argpartition(per_label, k - 1, axis=1)[:, :k]
+        top_distances = np.take_along_axis(per_label, top, axis=1)
+        ranked = np.take_along_axis(top, np.argsort(top_distances, axis=1, kind='stable'), axis=1)
+        return [[(int(unique_labels[i]), float(row[i])) for i in indices]
+                for row, indices in zip(per_label, ranked)]
+
+    def write(self, filename: str):
+        """保存人脸库（忽略OpenCV风格的?base64等后缀）"""
+        buffer = io.BytesIO()
+        np.savez(buffer, histograms=self.histograms, labels=self.labels,
+                 params=np.array([self.radius, self.neighbors, self.grid_x, self.grid_y]))
+        with open(filename.split('?')[0], 'wb') as f:
+            f.write(buffer.getvalue())
+
+    def read(self, filename: str):
+        """加载write保存的人脸库"""
+        with np.load(filename.split('?')[0]) as data:
+            self.radius, self.neighbors, self.grid_x, self.grid_y = (int(v) for v in data['params'])
+            histograms = np.asarray(data['histograms'], dtype=np.float32)
+            self._labels = np.ascontiguousarray(data['labels'], dtype=np.int32)
+        self.dimensions = histograms.shape[1]
+        self._columns = np.ascontiguousarray(histograms.T)
+        self._sums = histograms.sum(axis=1, dtype=np.float64)
+        self._size = len(self._labels)
+        self._label_index = None
+
@@ -0,0 +1,166 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+# 延迟直方图的桶上限（秒），覆盖1毫秒到5秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """按一个标签区分的计数器"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_value, value in values:
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {value:g}')
+        return lines
+
+
+class Histogram:
+    """按一个标签区分的直方图，每次观测只做一次二分查找和加法"""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._values: Dict[str, list] = {}  # 标签值 -> [各桶计数（不累计）, 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_value)
+            if entry is None:
+                entry = self._values[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = sorted((label_value, list(entry[0]), entry[1], entry[2])
+                            for label_value, entry in self._values.items())
+        for label_value, counts, total, count in values:
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+class Gauge:
+    """按一个标签区分的当前值，例如连接池中借出的连接数"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def set(self, label_value: str, value: float):
+        with self._lock:
+            self._values[label_value] = value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_value, value in values:
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {value:g}')
+        return lines
+
+
+# 识别流程各阶段的耗时：parse、base64、decode、quality、detect、extract、predict、gallery_build、
+# course_lookup、attendance_lookup、db_write，以及等待数据库连接的db_acquire
+STAGE_SECONDS = Histogram('attendance_stage_seconds', 'Latency of each recognition pipeline stage in seconds', 'stage')
+# 接口的总耗时
+REQUEST_SECONDS = Histogram('attendance_request_seconds', 'End-to-end request latency in seconds', 'endpoint')
+# 考勤结果：no_face、low_quality、unknown、not_enrolled、no_course、on_time、late、duplicate
+OUTCOMES = Counter('attendance_outcomes_total', 'Attendance recognition outcomes', 'outcome')
+
+# 数据库连接池：size、in_use、idle，以及created、discarded、acquired、waited、timeouts等累计值
+DB_POOL = Gauge('attendance_db_pool', 'Database connection pool usage', 'field')
+
+# 考勤延迟写入日志：pending（尚未写入数据库）、appended、flushed、batches、errors、replayed、checkpoint
+ATTENDANCE_JOURNAL = Gauge('attendance_journal', 'Write-behind attendance journal state', 'field')
+
+METRICS = [STAGE_SECONDS, REQUEST_SECONDS, OUTCOMES, DB_POOL, ATTENDANCE_JOURNAL]
+
+# 输出指标前调用的函数，用来刷新只在需要时读取的当前值（Gauge）
+_collectors = []
+
+# 当前线程正在收集的阶段耗时（识别进程池的工作进程把它们随结果返回主进程）
+_local = threading.local()
+
+
+@contextmanager
+def stage(name: str):
+    """记录一个阶段的耗时：with stage('detect'): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.observe(name, seconds)
+    captured = getattr(_local, 'captured', None)
+    if captured is not None:
+        captured.append((name, seconds))
+
+
+@contextmanager
+def capture_stages():
+    """收集当前线程在with块内记录的阶段耗时，返回[(阶段, 秒), ...]"""
+    previous = getattr(_local, 'captured', None)
+    _local.captured = captured = []
+    try:
+        yield captured
+    finally:
+        _local.captured = previous
+
+
+def record_outcome(outcome: str, amount: int = 1):
+    OUTCOMES.inc(outcome, amount)
+
+
+def register_collector(collector):
+    """注册一个在输出指标前调用的函数"""
+    _collectors.append(collector)
+
+
+def render_metrics() -> str:
+    """Prometheus文本格式的全部指标"""
+    for collector in _collectors:
+        collector()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
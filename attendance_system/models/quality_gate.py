@@ -0,0 +1,58 @@
+from typing import Optional
+
+import cv2
+import numpy as np
+
+# 质量检查不通过的原因及对应的提示信息
+QUALITY_MESSAGES = {
+    'too_dark': '画面太暗，请补充光线后重试',
+    'too_bright': '画面过曝，请避开强光后重试',
+    'too_blurry': '画面模糊，请保持不动后重试',
+    'face_too_small': '人脸太小，请靠近摄像头后重试',
+}
+
+
+class QualityGate:
+    """
+    识别前的图像质量检查：检测之后、识别之前检查每张人脸的尺寸、亮度和清晰度（100x100人脸区域的拉普拉斯方差），
+    不合格的人脸不做识别，并返回可供客户端判断的原因，考勤终端可以立即重拍。
+    亮度只在人脸区域计算，深色背景前光线正常的人脸不会被判为太暗。
+    考勤终端和课堂合照的人脸大小差别很大，各自使用一个QualityGate
+    """
+
+    def __init__(self, min_brightness: float = 40, max_brightness: float = 220,
+                 min_sharpness: float = 25, min_face_size: int = 48):
+        """
+        :param min_brightness: 最低平均亮度（0-255）
+        :param max_brightness: 最高平均亮度（0-255）
+        :param min_sharpness: 人脸区域拉普拉斯方差的最小值，越小越模糊，0表示不检查
+        :param min_face_size: 人脸边界框的最小边长（原图像素），0表示不检查
+        """
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.min_sharpness = min_sharpness
+        self.min_face_size = min_face_size
+
+    def _exposure(self, gray: np.ndarray) -> Optional[str]:
+        brightness = float(gray.mean())
+        if brightness < self.min_brightness:
+            return 'too_dark'
+        if brightness > self.max_brightness:
+            return 'too_bright'
+        return None
+
+    def check_face(self, face_roi: np.ndarray, face_coords) -> Optional[str]:
+        """
+        识别之前检查一张人脸
+        :param face_roi: extract_face提取的100x100人脸区域
+        :param face_coords: 人脸边界框 (x, y, w, h)，原图坐标
+        :return: 不合格的原因，合格时返回None
+        """
+        if self.min_face_size and min(face_coords[2], face_coords[3]) < self.min_face_size:
+            return 'face_too_small'
+        reason = self._exposure(face_roi)
+        if reason:
+            return reason
+        if self.min_sharpness and cv2.Laplacian(face_roi, cv2.CV_64F).var() < self.min_sharpness:
+            return 'too_blurry'
+        return None
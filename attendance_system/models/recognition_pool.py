@@ -0,0 +1,195 @@
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional
+
+from models.face_recognition_service import FaceRecognitionService
+from models.metrics import capture_stages, observe_stage
+
+logger = logging.getLogger(__name__)
+
+
+class RecognitionPoolBusy(Exception):
+    """识别队列已满"""
+
+
+class RecognitionTimeout(Exception):
+    """识别任务超时"""
+
+
+class RecognitionPoolStale(Exception):
+    """工作进程还没有加载主进程要求的模型快照，调用方应在本进程中识别"""
+
+
+# 工作进程内的人脸识别服务，后台线程加载新快照后整体替换
+_worker_service = None
+
+
+def _current_snapshot(snapshot_dir: str) -> Optional[str]:
+    """快照目录中当前快照的名称，没有快照时返回None"""
+    try:
+        with open(os.path.join(snapshot_dir, 'current.json'), encoding='utf-8') as f:
+            return json.load(f).get('snapshot')
+    except (OSError, ValueError):
+        return None
+
+
+def _watch_snapshots(snapshot_dir: str, detection_config: dict, interval: float):
+    """工作进程的后台线程：快照变化后在新的识别服务中加载，加载完成后再替换，识别任务不等待加载"""
+    global _worker_service
+    while True:
+        time.sleep(interval)
+        current = _current_snapshot(snapshot_dir)
+        if current is None or current == _worker_service.snapshot_version:
+            continue
+        service = FaceRecognitionService(**detection_config)
+        if service.load_snapshot(snapshot_dir, standby=False) is not None:
+            _worker_service = service
+
+
+def _init_worker(snapshot_dir: str, detection_config: dict, reload_interval: float):
+    """工作进程初始化：创建识别服务，预加载模型快照，并启动重新加载快照的后台线程"""
+    global _worker_service
+    _worker_service = FaceRecognitionService(**detection_config)
+    _worker_service.load_snapshot(snapshot_dir, standby=False)
+    threading.Thread(target=_watch_snapshots, args=(snapshot_dir, detection_config, reload_interval),
+                     name='snapshot-watcher', daemon=True).start()
+
+
+def _ready_task() -> Optional[str]:
+    """启动时提交给每个工作进程的空任务，返回已加载的快照版本"""
+    return _worker_service.snapshot_version
+
+
+def _recognize_task(image_data: bytes, snapshot_version: Optional[str], all_faces: bool,
+                    rosters: Optional[Dict[object, List[str]]] = None):
+    """
+    在工作进程中解码、检测并识别；课程子人脸库在每个工作进程中各自缓存。
+    工作进程还没有加载snapshot_version时不识别（后台线程正在加载），由主进程自己识别
+    :return: (识别结果, 各阶段耗时)，阶段耗时由主进程记录到指标中；快照版本不一致时返回None
+    """
+    service = _worker_service
+    if snapshot_version != service.snapshot_version:
+        return None
+    with capture_stages() as stages:
+        results = service.recognize_image(image_data, all_faces, rosters)
+    return results, stages
+
+
+class RecognitionPool:
+    """
+    识别进程池：把CPU密集的解码、检测和识别分发到多个预加载模型的工作进程，
+    不受单个进程的GIL限制。模型通过快照目录共享：工作进程在启动时加载快照，
+    之后由后台线程发现新快照并加载，识别任务从不等待加载；还没有加载到主进程要求的版本时
+    任务抛出RecognitionPoolStale，调用方在本进程中识别
+    """
+
+    def __init__(self, snapshot_dir: str, workers: int, detection_config: dict,
+                 max_pending: int = 0, task_timeout: float = 5.0, queue_timeout: float = 1.0,
+                 reload_interval: float = 0.5):
+        """
+        :param snapshot_dir: 模型快照目录
+        :param workers: 工作进程数量
+        :param detection_config: 人脸检测配置，与主进程保持一致
+        :param max_pending: 最多同时排队和执行的任务数，0表示工作进程数的4倍
+        :param task_timeout: 单个任务的超时时间（秒）
+        :param queue_timeout: 队列已满时等待空位的时间（秒）
+        :param reload_interval: 工作进程检查新快照的间隔（秒）
+        """
+        self.snapshot_dir = snapshot_dir
+        self.workers = workers
+        self.detection_config = detection_config
+        self.task_timeout = task_timeout
+        self.queue_timeout = queue_timeout
+        self.max_pending = max_pending or workers * 4
+        self.reload_interval = reload_interval
+        self.snapshot_version = None  # 工作进程应使用的快照版本
+        self.ready = False  # 全部工作进程已经启动并加载了快照
+        self._started = False
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # 主进程有后台线程，使用spawn避免fork带来的锁状态问题
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.snapshot_dir, self.detection_config, self.reload_interval)
+                )
+            return self._executor
+
+    def start(self):
+        """
+        在后台启动全部工作进程并加载快照（只启动一次），启动完成后ready为True。
+        启动和加载不计入第一个识别任务的超时时间
+        """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        executor = self._get_executor()
+        # spawn方式下每提交一个任务（没有空闲的工作进程时）启动一个工作进程
+        futures = [executor.submit(_ready_task) for _ in range(self.workers)]
+
+        def wait_ready():
+            try:
+                for future in futures:
+                    future.result()
+                self.ready = True
+            except Exception:
+                logger.exception("Recognition workers failed to start")
+
+        threading.Thread(target=wait_ready, name='recognition-pool-start', daemon=True).start()
+
+    def set_snapshot_version(self, snapshot_version: str):
+        """通知工作进程使用新的快照（工作进程在后台加载），没有启动时启动工作进程"""
+        self.snapshot_version = snapshot_version
+        self.start()
+
+    def recognize_image(self, image_data: bytes, all_faces: bool = False,
+                        rosters: Optional[Dict[object, List[str]]] = None) -> Optional[List[dict]]:
+        """
+        在工作进程中识别图片
+        :param image_data: 图片数据
+        :param all_faces: 是否识别所有人脸，False时只识别第一张
+        :param rosters: 课程ID到选课学生ID的映射，给出时只在这些课程的子人脸库中匹配
+        :return: 与FaceRecognitionService.recognize_image相同的结果
+        :raises RecognitionPoolStale: 工作进程还没有加载最新的快照
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise RecognitionPoolBusy('识别队列已满，请稍后再试')
+        try:
+            future = self._get_executor().submit(_recognize_task, bytes(image_data), self.snapshot_version,
+                                                all_faces, rosters)
+        except Exception:
+            self._slots.release()
+            raise
+        # 任务真正结束（包括超时后仍在运行的任务）才释放名额，保证队列有界
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            outcome = future.result(timeout=self.task_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise RecognitionTimeout('识别超时')
+        if outcome is None:
+            raise RecognitionPoolStale('工作进程尚未加载最新的模型快照')
+        results, stages = outcome
+        for name, seconds in stages:
+            observe_stage(name, seconds)
+        return results
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            self._started = False
+            self.ready = False
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def face_fingerprint(face_roi: np.ndarray) -> int:
+    """
+    人脸区域的64位感知指纹（差值哈希）：缩小到9x8后比较相邻像素的明暗。
+    重复提交的同一张图片和几乎静止的连续拍摄指纹相同
+    """
+    small = cv2.resize(face_roi, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class TTLCache:
+    """
+    线程安全的LRU缓存：条目在ttl秒后过期，超过max_entries时淘汰最久未使用的条目
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # 键 -> (过期时间, 值)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """查询未过期的条目，命中时移到最近使用的位置"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """写入条目，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FingerprintCache(TTLCache):
+    """
+    按人脸指纹缓存识别结果，只在指纹完全相同时命中。
+    64位指纹区分不同的人不够可靠（不同学生的指纹可能只差几位），按汉明距离近似查找会把
+    短时间内先后提交的另一个学生当作缓存中的学生
+    """
+
+    def find(self, scope, fingerprint: int):
+        """
+        :param scope: 结果的适用范围（模型代、课程名单等），不同范围的结果互不命中
+        :param fingerprint: face_fingerprint计算的指纹
+        :return: 缓存的结果，没有时返回None
+        """
+        return self.get((scope, fingerprint))
+
+    def put(self, scope, fingerprint: int, value):
+        self.set((scope, fingerprint), value)
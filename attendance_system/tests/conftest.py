@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试从attendance_system目录导入models、backend和benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,78 @@
+"""批量注册接口：压缩包可以超过应用的MAX_CONTENT_LENGTH，但不能超过BULK_MAX_UPLOAD_SIZE"""
+import io
+import json
+import zipfile
+
+import pytest
+
+import backend.routes as routes
+from app import create_app
+from benchmarks.face_service_bench import SyntheticFaces
+
+
+@pytest.fixture
+def client(monkeypatch):
+    written = {}
+
+    def write_bulk_students(samples, manifest, default_class):
+        written.update(samples=samples, manifest=manifest, default_class=default_class)
+        return len(samples), 0
+
+    # 不连接数据库，也不在测试中启动预热线程
+    monkeypatch.setitem(routes.warmup_state, 'status', 'ready')
+    monkeypatch.setattr(routes, 'write_bulk_students', write_bulk_students)
+    monkeypatch.setattr(routes, 'note_applied_faces', lambda student_ids: None)
+    monkeypatch.setattr(routes.face_service, 'add_face_roi', lambda face_roi, student_id: True)
+    monkeypatch.setattr(routes.face_service, 'update_model', lambda: True)
+
+    app = create_app()
+    app.config['MAX_CONTENT_LENGTH'] = 4 * 1024
+    client = app.test_client()
+    client.written = written
+    return client
+
+
+def make_archive():
+    faces = SyntheticFaces()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('students.csv', 'student_id,name,class_name\nS001,张三,一班\n')
+        archive.writestr('S001/front.jpg', faces.frame(face_index=1))
+        archive.writestr('S002/front.jpg', b'not an image')
+    return buffer.getvalue()
+
+
+def post_archive(client, data):
+    return client.post('/api/students/bulk', data={'archive': (io.BytesIO(data), 'cohort.zip'), 'class_name': '二班'},
+                       content_type='multipart/form-data')
+
+
+def test_bulk_archive_larger_than_max_content_length_is_enrolled(client):
+    data = make_archive()
+    assert len(data) > 4 * 1024
+
+    response = post_archive(client, data)
+
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    photos = {line['photo']: line['result'] for line in lines if 'photo' in line}
+    assert photos == {'S001/front.jpg': 'ok', 'S002/front.jpg': 'decode_failed'}
+    assert lines[-1]['summary'] and lines[-1]['success']
+    assert list(client.written['samples']) == ['S001']
+    assert client.written['manifest'] == {'S001': ('张三', '一班')}
+    assert client.written['default_class'] == '二班'
+
+
+def test_bulk_archive_larger_than_bulk_limit_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(routes, 'BULK_MAX_UPLOAD_SIZE', 8 * 1024)
+
+    response = post_archive(client, make_archive() + b'\0' * 8 * 1024)
+
+    assert response.status_code == 413
+    assert response.get_json()['success'] is False
+
+
+def test_other_endpoints_keep_max_content_length(client):
+    response = client.post('/api/test_recognize', data=b'\0' * 8 * 1024, content_type='application/octet-stream')
+
+    assert response.status_code == 413
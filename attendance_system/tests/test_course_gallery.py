@@ -0,0 +1,52 @@
+"""课程子人脸库识别：只有选课学生可以被识别为选课学生"""
+import pytest
+
+from benchmarks.face_service_bench import SyntheticFaces
+from models.face_recognition_service import MATCH_THRESHOLD, FaceRecognitionService, Frame
+
+STUDENTS = 40
+ENROLLED = [f'S{i}' for i in range(STUDENTS // 2)]
+
+
+@pytest.fixture(scope='module', params=['opencv', 'numpy'])
+def service(request):
+    faces = SyntheticFaces()
+    service = FaceRecognitionService(matcher=request.param)
+    service.coalesce_delay = 0
+    for i in range(STUDENTS):
+        for variant in range(3):
+            service.add_face_roi(faces.sample(i, variant), f'S{i}')
+    assert service.train_model(wait=True)
+    return service
+
+
+def recognize(service, face_roi):
+    gallery = service.course_gallery(1, ENROLLED)
+    frame = Frame(face_roi)
+    return service.recognize_faces(frame, [(0, 0, 100, 100)], galleries=[gallery])[0]['student_id']
+
+
+def test_enrolled_students_are_recognized(service):
+    faces = SyntheticFaces()
+    for i in range(len(ENROLLED)):
+        assert recognize(service, faces.sample(i, 5)) == f'S{i}'
+
+
+def test_non_enrolled_face_is_not_matched_to_an_enrolled_student(service):
+    faces = SyntheticFaces()
+    for i in range(len(ENROLLED), STUDENTS):
+        assert recognize(service, faces.sample(i, 5)) not in ENROLLED
+
+
+def test_confident_course_match_skips_the_full_model(service, monkeypatch):
+    faces = SyntheticFaces()
+    monkeypatch.setattr(service, 'course_match_threshold', MATCH_THRESHOLD)
+    monkeypatch.setattr(service, '_acquire_generation', lambda: pytest.fail('full model searched'))
+    assert recognize(service, faces.sample(0, 5)) == 'S0'
+
+
+def test_borderline_course_match_is_confirmed_in_the_full_model(service, monkeypatch):
+    faces = SyntheticFaces()
+    monkeypatch.setattr(service, 'course_match_threshold', 0)
+    for i in range(len(ENROLLED), STUDENTS):
+        assert recognize(service, faces.sample(i, 5)) not in ENROLLED
@@ -0,0 +1,57 @@
+"""向量化的LBP直方图匹配器：识别结果与OpenCV的LBPH识别器一致"""
+import cv2
+import numpy as np
+import pytest
+
+from models.lbp_matcher import LBPHistogramMatcher
+
+SAMPLES = 60
+PROBES = 20
+SIZE = 100
+
+pytestmark = pytest.mark.skipif(not hasattr(cv2, 'face'), reason='需要opencv-contrib-python（cv2.face）')
+
+
+@pytest.fixture(scope='module')
+def data():
+    rng = np.random.default_rng(0)
+    # 平滑后的随机图像，纹理比纯噪声更接近人脸
+    images = [cv2.GaussianBlur(rng.integers(0, 256, (SIZE, SIZE), dtype=np.uint8), (5, 5), 0)
+              for _ in range(SAMPLES)]
+    labels = np.arange(SAMPLES, dtype=np.int32) % (SAMPLES // 3) + 1
+    queries = [cv2.add(images[i], rng.integers(0, 20, (SIZE, SIZE), dtype=np.uint8))
+               for i in rng.integers(0, SAMPLES, PROBES)]
+    return images, labels, queries
+
+
+@pytest.fixture(scope='module')
+def recognizers(data):
+    images, labels, _ = data
+    half = SAMPLES // 2
+    opencv = cv2.face.LBPHFaceRecognizer_create()
+    opencv.train(images[:half], labels[:half])
+    opencv.update(images[half:], labels[half:])
+    matcher = LBPHistogramMatcher()
+    matcher.train(images[:half], labels[:half])
+    matcher.update(images[half:], labels[half:])
+    return opencv, matcher
+
+
+def test_predict_matches_opencv_lbph(data, recognizers):
+    _, _, queries = data
+    opencv, matcher = recognizers
+    for query in queries:
+        expected_label, expected_distance = opencv.predict(query)
+        label, distance = matcher.predict(query)
+        assert label == expected_label
+        assert distance == pytest.approx(expected_distance, rel=1e-4, abs=1e-4)
+
+
+def test_top_k_starts_with_predict(data, recognizers):
+    _, _, queries = data
+    _, matcher = recognizers
+    top = matcher.predict_top_k(np.stack(queries), k=3)
+    for query, candidates in zip(queries, top):
+        label, distance = matcher.predict(query)
+        assert candidates[0][0] == label
+        assert candidates[0][1] == pytest.approx(distance)
@@ -0,0 +1,58 @@
+"""人脸质量检查：亮度只在人脸区域计算，课堂合照和考勤终端使用各自的阈值"""
+import cv2
+import numpy as np
+import pytest
+
+from benchmarks.face_service_bench import SyntheticFaces
+from models.face_recognition_service import FaceRecognitionService, Frame
+from models.quality_gate import QualityGate
+
+FACE_SIZE = 32
+
+
+def small(face_roi):
+    """合照中的小人脸：缩小到FACE_SIZE像素"""
+    return cv2.resize(face_roi, (FACE_SIZE, FACE_SIZE), interpolation=cv2.INTER_AREA)
+
+
+@pytest.fixture(scope='module')
+def service():
+    faces = SyntheticFaces()
+    service = FaceRecognitionService(
+        matcher='numpy',
+        quality_gate=QualityGate(),
+        class_quality_gate=QualityGate(min_sharpness=0, min_face_size=0)
+    )
+    service.coalesce_delay = 0
+    for i in range(5):
+        for variant in range(3):
+            # 注册样本也取自合照，与识别时的小人脸分辨率相同
+            service.add_face_roi(cv2.resize(small(faces.sample(i, variant)), (100, 100)), f'S{i}')
+    assert service.train_model(wait=True)
+    return service
+
+
+def dark_frame():
+    """深色背景上的一张小人脸，整帧平均亮度远低于min_brightness"""
+    image = np.full((480, 640), 10, dtype=np.uint8)
+    image[200:200 + FACE_SIZE, 300:300 + FACE_SIZE] = small(SyntheticFaces().sample(0, 5))
+    return Frame(image), (300, 200, FACE_SIZE, FACE_SIZE)
+
+
+def test_small_face_on_dark_background_is_recognized_in_class_photo(service):
+    frame, box = dark_frame()
+    assert frame.gray.mean() < QualityGate().min_brightness
+
+    result = service.recognize_faces(frame, [box], class_photo=True)[0]
+
+    assert result['quality'] is None
+    assert result['student_id'] == 'S0'
+
+
+def test_kiosk_gate_rejects_small_face(service):
+    frame, box = dark_frame()
+
+    result = service.recognize_faces(frame, [box])[0]
+
+    assert result['quality'] == 'face_too_small'
+    assert result['student_id'] is None
@@ -0,0 +1,56 @@
+"""识别进程池：工作进程预先加载快照，快照更新期间在本进程识别，之后使用新快照"""
+import time
+
+import pytest
+
+from benchmarks.face_service_bench import SyntheticFaces
+from models.face_recognition_service import FaceRecognitionService
+from models.recognition_pool import RecognitionPool, RecognitionPoolStale
+
+CONFIG = {'matcher': 'numpy'}
+
+
+def wait_for(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = RecognitionPool(str(tmp_path), 1, CONFIG, task_timeout=5, reload_interval=0.05)
+    yield pool
+    pool.shutdown()
+
+
+def enrolled_service(snapshot_dir, students):
+    faces = SyntheticFaces()
+    service = FaceRecognitionService(**CONFIG)
+    service.coalesce_delay = 0
+    for i in students:
+        service.add_face_roi(faces.sample(i, 0), f'S{i}')
+    assert service.train_model(wait=True)
+    assert service.save_snapshot(snapshot_dir, {})
+    return service
+
+
+def recognized(pool, frame):
+    try:
+        return pool.recognize_image(frame)[0]['student_id']
+    except RecognitionPoolStale:
+        return None
+
+
+def test_workers_load_new_snapshots_in_the_background(pool, tmp_path):
+    frame = SyntheticFaces().frame(face_index=1)
+    service = enrolled_service(str(tmp_path), [0, 2])
+    pool.set_snapshot_version(service.snapshot_version)
+    wait_for(lambda: pool.ready)
+
+    assert pool.recognize_image(frame)[0]['student_id'] != 'S1'
+
+    service = enrolled_service(str(tmp_path), [0, 1, 2])
+    pool.set_snapshot_version(service.snapshot_version)
+    # 工作进程加载新快照之前拒绝识别（调用方在本进程中识别），加载之后识别出新注册的学生
+    wait_for(lambda: recognized(pool, frame) == 'S1')
@@ -0,0 +1,41 @@
+"""识别结果缓存：指纹相同的不同学生不能命中另一个学生的缓存结果"""
+import pytest
+
+import models.face_recognition_service as face_recognition_service
+from benchmarks.face_service_bench import SyntheticFaces
+from models.face_recognition_service import FaceRecognitionService, Frame
+
+STUDENTS = 10
+
+
+@pytest.fixture(params=['opencv', 'numpy'])
+def service(request, monkeypatch):
+    # 所有人脸的指纹都相同，每次查询都会命中缓存中的结果
+    monkeypatch.setattr(face_recognition_service, 'face_fingerprint', lambda face_roi: 0)
+    faces = SyntheticFaces()
+    service = FaceRecognitionService(matcher=request.param, result_cache_ttl=60)
+    service.coalesce_delay = 0
+    for i in range(STUDENTS):
+        for variant in range(3):
+            service.add_face_roi(faces.sample(i, variant), f'S{i}')
+    assert service.train_model(wait=True)
+    return service
+
+
+def recognize(service, face_roi):
+    return service.recognize_faces(Frame(face_roi), [(0, 0, 100, 100)])[0]['student_id']
+
+
+def test_repeated_face_is_served_from_the_cache(service, monkeypatch):
+    probe = SyntheticFaces().sample(0, 5)
+    assert recognize(service, probe) == 'S0'
+
+    monkeypatch.setattr(service, 'match_faces', lambda *args: pytest.fail('cache not used'))
+    assert recognize(service, probe) == 'S0'
+
+
+def test_other_student_with_the_same_fingerprint_is_recognized_again(service):
+    faces = SyntheticFaces()
+    assert recognize(service, faces.sample(0, 5)) == 'S0'
+    for i in range(1, STUDENTS):
+        assert recognize(service, faces.sample(i, 5)) == f'S{i}'